@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Profile, API
+from .models import Profile, API, APIBudget, ImportJob
 
 
 class ProfileAdmin(admin.ModelAdmin):
@@ -13,5 +13,15 @@ class URLAdmin(admin.ModelAdmin):
     fields = ["name", "base", "_active", "_last_fail", "fail_reason", "fail_length"]
 
 
+class APIBudgetAdmin(admin.ModelAdmin):
+    list_display = ("name", "key", "day", "calls")
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ("user", "kind", "phase", "rows", "applied", "created")
+
+
 admin.site.register(Profile, ProfileAdmin)
 admin.site.register(API, URLAdmin)
+admin.site.register(APIBudget, APIBudgetAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
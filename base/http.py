@@ -0,0 +1,95 @@
+"""
+The HTTP client behind base.models.API.get.   One pooled requests.Session per API (so keep-alive connections are
+reused),  connect/read timeouts on every call,  a bounded number of retries with jittered backoff and per API
+latency/error counters (see stats).
+"""
+import logging
+import random
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from time import monotonic, sleep
+from typing import Dict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = (getattr(settings, 'API_CONNECT_TIMEOUT', 5), getattr(settings, 'API_READ_TIMEOUT', 30))  # Seconds
+RETRIES = getattr(settings, 'API_RETRIES', 2)  # Attempts after the first one
+BACKOFF = getattr(settings, 'API_BACKOFF', 0.5)  # Seconds,  doubled on each retry
+POOL_SIZE = getattr(settings, 'API_POOL_SIZE', 8)  # Connections kept per API
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_sessions: Dict[str, requests.Session] = {}
+_counters: Dict[str, Dict[str, float]] = {}
+_lock = threading.Lock()
+
+
+def session(name: str) -> requests.Session:
+    """
+    The shared Session for an API
+    """
+    with _lock:
+        if name not in _sessions:
+            this = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            this.mount('https://', adapter)
+            this.mount('http://', adapter)
+            _sessions[name] = this
+        return _sessions[name]
+
+
+def _record(name: str, elapsed: float, failed: bool, retry: bool):
+    with _lock:
+        counters = _counters.setdefault(name, {'calls': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'slowest': 0.0})
+        counters['calls'] += 1
+        counters['errors'] += 1 if failed else 0
+        counters['retries'] += 1 if retry else 0
+        counters['seconds'] += elapsed
+        counters['slowest'] = max(counters['slowest'], elapsed)
+
+
+def get(name: str, url: str) -> requests.Response:
+    """
+    GET url through the name API's session.   Connection errors,  timeouts and RETRY_STATUS responses are retried
+    up to RETRIES times,  the last response is returned (or the last exception raised)
+    """
+    response = error = None
+    for attempt in range(RETRIES + 1):
+        start = monotonic()
+        try:
+            response = session(name).get(url, timeout=TIMEOUT)
+            error = None
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            response = None
+            error = e
+        failed = error is not None or response.status_code in RETRY_STATUS
+        retry = failed and attempt < RETRIES
+        _record(name, monotonic() - start, failed, retry)
+        if not failed:
+            return response
+        if retry:
+            delay = random.uniform(0, BACKOFF * 2 ** attempt)  # Full jitter
+            logger.debug('%s failed (%s),  retry in %.2fs' % (name, error if error else response.status_code, delay))
+            sleep(delay)
+    if error:
+        raise error
+    return response
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """
+    A copy of the counters per API: calls,  errors,  retries,  seconds (total),  slowest and average (seconds per call)
+    """
+    with _lock:
+        result = {name: dict(counters) for name, counters in _counters.items()}
+    for counters in result.values():
+        counters['average'] = counters['seconds'] / counters['calls'] if counters['calls'] else 0
+    return result
+
+
+def reset_stats():
+    with _lock:
+        _counters.clear()
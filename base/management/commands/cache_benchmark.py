@@ -0,0 +1,62 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from base.utils import CACHE_CODECS, CACHE_COMPRESSORS, encode_dataframe, decode_dataframe
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Compare the DataFrame cache codecs (encode/decode time and payload size) against the original JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Rows in the test DataFrame (an equity DF shape)')
+        parser.add_argument('--repeat', type=int, default=5, help='Best of this many runs')
+
+    @staticmethod
+    def sample(rows: int) -> pd.DataFrame:
+        """
+        Something that looks like an account e_pd,  a few dozen equities over many months
+        """
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'Date': pd.date_range('2000-01-01', periods=rows, freq='D').normalize(),
+                           'Equity': rng.choice([f'EQ{n}.TO' for n in range(40)], rows),
+                           'Object_ID': rng.integers(1, 40, rows),
+                           'Object_Type': 'Equity'})
+        for column in ['Shares', 'Cost', 'Price', 'Dividends', 'TotalDividends', 'Value', 'TBuy', 'TSell', 'RelGain',
+                       'UnRelGain', 'RelGainPct', 'UnRelGainPct', 'AvgCost']:
+            df[column] = rng.random(rows) * 1000
+        return df
+
+    @staticmethod
+    def best(repeat: int, function):
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            result = function()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None or elapsed < best else best
+        return best, result
+
+    def handle(self, *args, **options):
+        df = self.sample(options['rows'])
+        repeat = options['repeat']
+
+        encode_time, payload = self.best(repeat, lambda: df.to_json())
+        decode_time, _ = self.best(repeat, lambda: decode_dataframe(payload))
+        results = [('json', encode_time, decode_time, len(payload.encode()))]
+        for codec in CACHE_CODECS:
+            for compression in CACHE_COMPRESSORS:
+                encode_time, payload = self.best(repeat, lambda: encode_dataframe(df, codec, compression))
+                decode_time, _ = self.best(repeat, lambda: decode_dataframe(payload))
+                results.append((f'{codec}/{compression}', encode_time, decode_time, len(payload)))
+
+        self.stdout.write(f'{options["rows"]} rows,  best of {repeat}')
+        self.stdout.write(f'{"codec":<16}{"encode ms":>12}{"decode ms":>12}{"bytes":>12}')
+        for name, encode_time, decode_time, size in results:
+            self.stdout.write(f'{name:<16}{encode_time * 1000:>12.2f}{decode_time * 1000:>12.2f}{size:>12}')
@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_alter_profile_country_alter_profile_phone_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='APIBudget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32)),
+                ('key', models.CharField(max_length=16)),
+                ('day', models.DateField()),
+                ('calls', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('name', 'key', 'day')},
+            },
+        ),
+    ]
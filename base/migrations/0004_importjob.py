@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 18:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('base', '0003_apibudget'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('stocks', 'Stocks'), ('expenses', 'Expenses')], max_length=10)),
+                ('file', models.CharField(max_length=256)),
+                ('options', models.JSONField(default=dict)),
+                ('phase', models.CharField(choices=[('queued', 'Waiting to start'), ('parsing', 'Reading the file'), ('applying', 'Importing'), ('recomputing', 'Updating accounts'), ('done', 'Finished'), ('failed', 'Failed')], default='queued', max_length=12)),
+                ('rows', models.IntegerField(default=0)),
+                ('applied', models.IntegerField(default=0)),
+                ('warnings', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -1,15 +1,20 @@
+import hashlib
 import logging
-import requests
 
 from datetime import datetime, timedelta, UTC, date
 from phonenumber_field.modelfields import PhoneNumberField
-from requests.exceptions import ConnectTimeout, ConnectionError
+from requests.exceptions import ConnectTimeout, ConnectionError, Timeout
 from requests.models import Response
+from time import monotonic
+from typing import Dict, Tuple
 from tzlocal import get_localzone
+from django.conf import settings
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
 
-from .utils import BoolReason
+from . import http
+from .utils import BoolReason, bump_cache_version, get_cache_version
 
 # We can not import CURRENCIES since it will be an import loop - from stocks.models import CURRENCIES
 CURRENCIES = (
@@ -69,9 +74,13 @@ class Profile(models.Model):
 
 class API(models.Model):
     """
-    Support making an API offline and catch some traps and return a valid / invalid response
+    Support making an API offline and catch some traps and return a valid / invalid response.
+    The rows are held in memory for STATUS_TTL seconds,  or until another process changes one (a pause) and bumps
+    its version in the shared cache.   The calls go through the pooled client in base.http
     """
     DEFAULT_FAIL_LENGTH: int = 60 * 60 * 3  # 3 Hours
+    STATUS_TTL = getattr(settings, 'API_STATUS_TTL', 0 if settings.NO_CACHE else 30)  # Seconds,  0 reads the table every time
+    LOADED: Dict[str, Tuple[float, object, 'API']] = {}  # name -> (loaded at, version, row)
     name = models.CharField(primary_key=True, null=False, blank=False, max_length=32)
     base = models.CharField(null=True, blank=True, max_length=132)
     fail_reason = models.CharField(null=False, blank=False, max_length=132, default='Manual Suspension')  # Via the admin tool
@@ -79,18 +88,40 @@ class API(models.Model):
     _active = models.BooleanField(default=True)
     _last_fail: date = models.DateTimeField(null=True, blank=True)
 
+    @staticmethod
+    def version_key(name) -> str:
+        return f'API:{name}:version'
+
+    @classmethod
+    def lookup(cls, name) -> 'API':
+        """
+        The named row,  from memory if it was read in the last STATUS_TTL seconds and no process changed it since
+        (raises API.DoesNotExist)
+        """
+        now = monotonic()
+        if cls.STATUS_TTL and name in cls.LOADED:
+            loaded, version, api = cls.LOADED[name]
+            if now - loaded < cls.STATUS_TTL and version == get_cache_version(cls.version_key(name)):
+                return api
+        version = get_cache_version(cls.version_key(name))
+        api = cls.objects.get(name=name)
+        cls.LOADED[name] = (now, version, api)
+        return api
+
     @classmethod
     def get(cls, name, extra=None):   # return a get.result or None
         try:
-            url = cls.objects.get(name=name)
+            url = cls.lookup(name)
             test = url.ready_or_reset()
             if test:
                 try:
-                    return requests.get(url.base + extra)
+                    return http.get(name, url.base + extra)
                 except ConnectTimeout:
                     reason = 'Connection Timeout'
                 except ConnectionError:
                     reason = 'Connection Error'
+                except Timeout:
+                    reason = 'Read Timeout'
                 cls.pause(name, reason)
             else:
                 reason = str(test)
@@ -102,6 +133,18 @@ class API(models.Model):
         result.reason = reason
         return result
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        API.LOADED.pop(self.name, None)
+        bump_cache_version(API.version_key(self.name))  # Every other process reloads it
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, float]]:
+        """
+        Latency and error counters per API (this process),  see base.http.stats
+        """
+        return http.stats()
+
     @property
     def is_active(self):
         return self._active
@@ -112,6 +155,8 @@ class API(models.Model):
 
     @classmethod
     def pause(cls, name, reason='Undefined'):
+        cls.LOADED.pop(name, None)
+        bump_cache_version(cls.version_key(name))  # Even if it was already paused,  a process may still have it active
         try:
             url = cls.objects.get(name=name)
             if url._active:
@@ -136,7 +181,94 @@ class API(models.Model):
     @classmethod
     def status(cls, name):
         try:
-            api = cls.objects.get(name=name)
+            api = cls.lookup(name)
             return api.ready_or_reset()
         except cls.DoesNotExist:
             return BoolReason(False, 'Configuration Error')
+
+
+class APIBudget(models.Model):
+    """
+    The calls made with a rate limited API key per day,  so a daily allowance is not spent twice across restarts and
+    workers (see stocks.refresh.av_schedule).   The key itself is never stored,  just a fingerprint of it
+    """
+    name = models.CharField(max_length=32)  # API.name
+    key = models.CharField(max_length=16)
+    day: date = models.DateField()
+    calls: int = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('name', 'key', 'day'),)
+
+    def __str__(self):
+        return f'{self.name}({self.key}) {self.day}: {self.calls}'
+
+    @staticmethod
+    def fingerprint(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    @classmethod
+    def remaining(cls, name: str, key: str, limit: int) -> int:
+        used = cls.objects.filter(name=name, key=cls.fingerprint(key), day=datetime.now().date()).values_list('calls', flat=True).first()
+        return max(0, limit - (used if used else 0))
+
+    @classmethod
+    def spend(cls, name: str, key: str, limit: int) -> bool:
+        """
+        Record one call against today's allowance,  False (and nothing recorded) when it is used up
+        """
+        budget, _ = cls.objects.get_or_create(name=name, key=cls.fingerprint(key), day=datetime.now().date())
+        return cls.objects.filter(id=budget.id, calls__lt=limit).update(calls=F('calls') + 1) == 1
+
+
+class ImportJob(models.Model):
+    """
+    An uploaded file being imported by a celery task (stocks.tasks.stock_import or expenses.tasks.expense_import),  the
+    browser polls its status (base.views.import_job_status) while the rows are applied and the accounts recomputed
+    """
+    QUEUED = 'queued'
+    PARSING = 'parsing'
+    APPLYING = 'applying'
+    RECOMPUTING = 'recomputing'
+    DONE = 'done'
+    FAILED = 'failed'
+    PHASES = ((QUEUED, 'Waiting to start'),
+              (PARSING, 'Reading the file'),
+              (APPLYING, 'Importing'),
+              (RECOMPUTING, 'Updating accounts'),
+              (DONE, 'Finished'),
+              (FAILED, 'Failed'))
+    KINDS = (('stocks', 'Stocks'), ('expenses', 'Expenses'))
+
+    user: User = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    file = models.CharField(max_length=256)  # Relative to MEDIA_ROOT
+    options = models.JSONField(default=dict)  # What the importer needs beyond the file,  like the csv type
+    phase = models.CharField(max_length=12, choices=PHASES, default=QUEUED)
+    rows: int = models.IntegerField(default=0)  # In the file
+    applied: int = models.IntegerField(default=0)  # Rows imported
+    warnings = models.JSONField(default=list)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user}:{self.kind}:{self.file} {self.phase}'
+
+    @property
+    def finished(self) -> bool:
+        return self.phase in (self.DONE, self.FAILED)
+
+    def set_phase(self, phase: str, **kwargs):
+        """
+        Move to phase,  kwargs are other fields to update with it
+        """
+        self.phase = phase
+        for field, value in kwargs.items():
+            setattr(self, field, value)
+        self.save(update_fields=['phase', 'updated'] + list(kwargs))
+
+    def status(self) -> dict:
+        return {'id': self.id, 'kind': self.kind, 'phase': self.phase, 'phase_text': self.get_phase_display(),
+                'finished': self.finished, 'rows': self.rows, 'applied': self.applied, 'warnings': self.warnings,
+                'error': self.error}
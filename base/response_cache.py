@@ -0,0 +1,137 @@
+"""
+An on-disk cache of the external market data responses (under MEDIA_ROOT/tmp) so development,  backfills and
+benchmarks do not download the same history again (Alphavantage only allows 25 calls a day).   It is off unless
+RESPONSE_CACHE is set,  a cached history would hide the provider's corrections to past months until the month rolls
+over.   A forced update (refresh) never reads it,  it reloads and rewrites the entry.
+
+A response is cached as two parts,  the months before this one (they do not change,  kept for the rest of the month)
+and this month (kept for the endpoint's TTL).   When only this month's part has expired the loader is asked for just
+this month.   The directory is capped at RESPONSE_CACHE_MB,  the least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+from datetime import date
+from pathlib import Path
+from time import time
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+
+from .utils import normalize_today
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'RESPONSE_CACHE', False)
+DIRECTORY = Path(getattr(settings, 'RESPONSE_CACHE_DIR', settings.MEDIA_ROOT / 'tmp' / 'responses'))
+MAX_BYTES = getattr(settings, 'RESPONSE_CACHE_MB', 200) * 1024 * 1024
+HISTORY_TTL = 60 * 60 * 24 * 31  # Seconds,  the history part is also dropped when the month changes
+TTLS = {'ypfinance': 60 * 60,  # Seconds the current month is good for,  per endpoint
+        'alphavantage': 60 * 60 * 12,
+        'boc': 60 * 60 * 6,
+        **getattr(settings, 'RESPONSE_CACHE_TTLS', {})}
+
+
+def entry_path(endpoint: str, params: dict, part: str) -> Path:
+    name = hashlib.sha256(json.dumps([endpoint, params, part], sort_keys=True, default=str).encode()).hexdigest()
+    return DIRECTORY / f'{name}.pickle'
+
+
+def read(endpoint: str, params: dict, part: str):
+    """
+    The cached value or None if it is missing or expired,  a hit makes the entry the most recently used
+    """
+    path = entry_path(endpoint, params, part)
+    try:
+        with open(path, 'rb') as entry:
+            expires, value = pickle.load(entry)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if expires < time():
+        path.unlink(missing_ok=True)
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return value
+
+
+def write(endpoint: str, params: dict, part: str, value, ttl: int):
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    handle, name = tempfile.mkstemp(dir=DIRECTORY, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as entry:
+        pickle.dump((time() + ttl, value), entry)
+    os.replace(name, entry_path(endpoint, params, part))  # Readers never see a partial file
+    evict()
+
+
+def evict():
+    """
+    Delete the least recently used entries until the directory is under MAX_BYTES
+    """
+    entries = []
+    for path in DIRECTORY.glob('*.pickle'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def clear():
+    for path in DIRECTORY.glob('*.pickle'):
+        path.unlink(missing_ok=True)
+
+
+def is_cached(endpoint: str, params: dict) -> bool:
+    """
+    True when cached_series would answer without calling the loader
+    """
+    if not ENABLED:
+        return False
+    return read(endpoint, params, f'history:{normalize_today()}') is not None and read(endpoint, params, 'current') is not None
+
+
+def cached_series(endpoint: str, params: dict, load: Callable[[Optional[date]], Dict[date, Any]], refresh: bool = False) -> Dict[date, Any]:
+    """
+    A provider's monthly series keyed on date,  from the cache when we can.
+    args:
+        endpoint: str - the provider,  a key of TTLS
+        params: dict - what identifies the request (never the API key)
+        load: function(since) - fetch the series,  all of it when since is None else from the since month on
+              (a loader that can not fetch part of the series may return all of it).   An empty result is not cached.
+    kwargs:
+        refresh: bool - skip the cache,  load all of it and rewrite both parts (a forced update)
+    """
+    if not ENABLED:
+        return load(None)
+
+    month = normalize_today()
+    history_part = f'history:{month}'
+    history = None if refresh else read(endpoint, params, history_part)
+    current = None if refresh else read(endpoint, params, 'current')
+    if history is not None and current is not None:
+        return {**history, **current}
+
+    data = load(month if history is not None else None)
+    if not data:
+        return data
+    older = {key: value for key, value in data.items() if key < month}
+    if history is None or older:  # A partial load (like Yahoo's last month) is merged into the history we have
+        history = {**(history or {}), **older}
+        write(endpoint, params, history_part, history, HISTORY_TTL)
+    current = {key: value for key, value in data.items() if key >= month}
+    write(endpoint, params, 'current', current, TTLS[endpoint])
+    logger.debug('%s %s cached' % (endpoint, params))
+    return {**history, **current}
@@ -8,4 +8,7 @@ urlpatterns = [
     path(r'profile/', views.profile_edit, name='profile'),
     path(r'main/', views.diy_main, name='diy_main'),
     path(r'get_states/', views.get_state, name='get_states'),
+    path(r'api_stats/', views.api_stats, name='api_stats'),
+    path(r'import/<int:pk>/', views.import_job, name='import_job'),
+    path(r'import/<int:pk>/status/', views.import_job_status, name='import_job_status'),
 ]
\ No newline at end of file
@@ -1,21 +1,40 @@
 import logging
+import numpy as np
 import os
+import pickle
 import platform
 import pandas as pd
 import tempfile
+import threading
+import time
+import zlib
 
+from collections import OrderedDict
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 from io import StringIO
 from pathlib import Path
 from pandas import Period
-from typing import Dict, List
+from typing import Dict, Iterable, List
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.mail import send_mail
 from django.template import loader
 
+try:  # Optional,  faster DataFrame cache codecs
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
 logger = logging.getLogger(__name__)
 
 class ReadonlyFieldsMixin:
@@ -278,6 +297,208 @@ def clear_simple_cache(key):
         cache.delete(key)
 
 
+def get_simple_cache_many(keys) -> dict:
+    data = {}
+    if not settings.NO_CACHE and keys:
+        data = cache.get_many(keys)
+    return data
+
+
+def set_simple_cache_many(data: dict, timeout=36000):
+    if not settings.NO_CACHE and data:
+        cache.set_many(data, timeout)
+
+
+def get_cache_version(key):
+    """
+    The version stamp stored at key,  used by the per-process caches to know another process changed the data
+    """
+    return get_simple_cache(key)
+
+
+def bump_cache_version(key):
+    """
+    Tell every process that the data behind key changed
+    """
+    set_simple_cache(key, time.time_ns(), timeout=None)
+
+
+# DataFrame cache codecs.   A cached frame is HEADER + payload,  where the header is
+#   MAGIC, FORMAT_VERSION, codec id, compression id
+# Anything without the header is a JSON string from before the codecs existed.
+CACHE_MAGIC = b'DIYF'
+CACHE_FORMAT_VERSION = 1
+
+
+def _pickle_encode(dataframe: pd.DataFrame) -> bytes:
+    return pickle.dumps(dataframe, protocol=5)
+
+
+def _pickle_decode(payload: bytes) -> pd.DataFrame:
+    return pickle.loads(payload)
+
+
+def _arrow_encode(dataframe: pd.DataFrame) -> bytes:
+    table = pa.Table.from_pandas(dataframe)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _arrow_decode(payload: bytes) -> pd.DataFrame:
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+CACHE_CODECS = {'pickle': (1, _pickle_encode, _pickle_decode)}
+if pa:
+    CACHE_CODECS['arrow'] = (2, _arrow_encode, _arrow_decode)
+
+CACHE_COMPRESSORS = {'none': (0, lambda data: data, lambda data: data),
+                     'zlib': (1, lambda data: zlib.compress(data, 1), zlib.decompress)}
+if lz4:
+    CACHE_COMPRESSORS['lz4'] = (2, lz4.frame.compress, lz4.frame.decompress)
+if zstd:
+    CACHE_COMPRESSORS['zstd'] = (3, lambda data: zstd.ZstdCompressor().compress(data), lambda data: zstd.ZstdDecompressor().decompress(data))
+
+
+unavailable_codecs = set()  # The configured codecs/compressions we already warned about
+
+
+def warn_unavailable(kind: str, name: str, fallback: str):
+    """
+    Log (once per process) that a configured DataFrame codec or compression is not installed
+    """
+    if (kind, name) not in unavailable_codecs:
+        unavailable_codecs.add((kind, name))
+        logger.warning('DataFrame %s %s is not available,  using %s' % (kind, name, fallback))
+
+
+def encode_dataframe(dataframe: pd.DataFrame, codec: str = None, compression: str = None) -> bytes:
+    """
+    Serialize a DataFrame for the cache,  dtypes (and the index) are kept.
+    codec/compression default to settings.DATAFRAME_CACHE_CODEC / DATAFRAME_CACHE_COMPRESSION,  an unavailable choice
+    (or a frame Arrow can not handle) falls back to pickle / zlib with a warning
+    """
+    codec = codec or getattr(settings, 'DATAFRAME_CACHE_CODEC', 'pickle')
+    compression = compression or getattr(settings, 'DATAFRAME_CACHE_COMPRESSION', 'zlib')
+    if codec not in CACHE_CODECS:
+        warn_unavailable('codec', codec, 'pickle')
+        codec = 'pickle'
+    if compression not in CACHE_COMPRESSORS:
+        warn_unavailable('compression', compression, 'zlib')
+        compression = 'zlib'
+
+    codec_id, encoder, _ = CACHE_CODECS[codec]
+    try:
+        payload = encoder(dataframe)
+    except Exception as e:  # Arrow is strict about mixed object columns
+        logger.debug('DataFrame codec %s failed (%s),  using pickle' % (codec, e))
+        codec_id, encoder, _ = CACHE_CODECS['pickle']
+        payload = encoder(dataframe)
+    compression_id, compressor, _ = CACHE_COMPRESSORS[compression]
+    return CACHE_MAGIC + bytes([CACHE_FORMAT_VERSION, codec_id, compression_id]) + compressor(payload)
+
+
+def decode_dataframe(data) -> pd.DataFrame:
+    """
+    The reverse of encode_dataframe,  legacy JSON strings are still understood
+    """
+    if isinstance(data, str):
+        return pd.read_json(StringIO(data))
+    header = len(CACHE_MAGIC) + 3
+    if not isinstance(data, bytes) or not data.startswith(CACHE_MAGIC) or len(data) < header:
+        raise TypeError('Unknown cached DataFrame format')
+    version, codec_id, compression_id = data[len(CACHE_MAGIC):header]
+    if version != CACHE_FORMAT_VERSION:
+        raise TypeError('Unknown cached DataFrame version %s' % version)
+    decompressor = next((codec[2] for codec in CACHE_COMPRESSORS.values() if codec[0] == compression_id), None)
+    decoder = next((codec[2] for codec in CACHE_CODECS.values() if codec[0] == codec_id), None)
+    if not decompressor or not decoder:
+        raise TypeError('Cached DataFrame codec %s/%s is not available' % (codec_id, compression_id))
+    return decoder(decompressor(data[header:]))
+
+
+class FrameLRU:
+    """
+    A bounded,  per process,  cache of decoded DataFrames in front of Redis.   Each entry remembers the version it
+    was cached under,  the version key in Redis is checked on every get so other workers can still invalidate it.
+    Size is accounted in bytes (DataFrame.memory_usage),  the least recently used frames are dropped first.
+    """
+
+    def __init__(self):
+        self.frames: OrderedDict = OrderedDict()  # key -> (version, DataFrame, bytes)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def max_bytes(self) -> int:
+        return getattr(settings, 'DATAFRAME_LRU_BYTES', 64 * 1024 * 1024)
+
+    def get(self, key: str, version):
+        """
+        The frame if we have it for this version,  a deep copy (still far cheaper than decoding it) so callers may
+        change it any way they like,  in place included,  without touching the cached frame
+        """
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is None or version is None or entry[0] != version:
+                return None
+            self.frames.move_to_end(key)
+            return entry[1].copy()
+
+    def put(self, key: str, version, dataframe: pd.DataFrame):
+        size = int(dataframe.memory_usage(index=True, deep=False).sum())
+        with self.lock:
+            self._drop(key)
+            if version is None or size > self.max_bytes:
+                return
+            self.frames[key] = (version, dataframe, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, dropped) = self.frames.popitem(last=False)
+                self.bytes -= dropped
+
+    def discard(self, key: str):
+        with self.lock:
+            self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self.frames.pop(key, None)
+        if entry:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+
+
+frame_lru = FrameLRU()
+
+
+FRAME_STALE = 0  # The version of a cleared frame,  an entry without any version predates versions and is still read
+
+
+def frame_version_key(key: str) -> str:
+    return f'{key}:version'
+
+
+def frame_dirty_key(key: str) -> str:
+    return f'{key}:dirty'
+
+
+def frame_lease_key(key: str) -> str:
+    return f'{key}:lease'
+
+
+def stale_grace() -> int:
+    """
+    Seconds a cleared frame is still served to readers while another worker rebuilds it
+    """
+    return getattr(settings, 'DATAFRAME_STALE_GRACE', 60)
+
+
 def cache_dataframe(key: str, dataframe: pd.DataFrame, timeout=36000):
     """
     Cache a Pandas DataFrame.
@@ -285,43 +506,161 @@ def cache_dataframe(key: str, dataframe: pd.DataFrame, timeout=36000):
     Args:
         key (str): The cache key.
         dataframe (pd.DataFrame): The DataFrame to cache.
-        timeout (int): Cache expiration time in seconds (default: 1 hour).
+        timeout (int): Cache expiration time in seconds (default: 10 hours).
     """
-    # Serialize the DataFrame to a binary format
     if not settings.NO_CACHE:
-        dataframe = dataframe.reset_index(drop=True)
         #  Used when debugging.
         if key.endswith('Components') and 'TBuy' not in list(dataframe.columns):
             logger.error('Saving corrupt Dataframe for %s' % key)
-        cache.set(key, dataframe.to_json(), timeout)
+        version = time.time_ns()
+        cache.set_many({key: encode_dataframe(dataframe), frame_version_key(key): version}, timeout)
+        frame_lru.put(key, version, dataframe.copy())  # The caller still owns dataframe
 
 
 def clear_cached_dataframe(key):
+    """
+    A FRAME_STALE version means the frame is no longer current,  the payload is kept for the grace window as the stale copy
+    """
     if not settings.NO_CACHE:
-        cache.delete(key)
+        cache.delete(frame_dirty_key(key))
+        cache.touch(key, stale_grace())
+        cache.set(frame_version_key(key), FRAME_STALE, stale_grace())  # After the touch,  so it outlives the payload
+        frame_lru.discard(key)
+
+
+def invalidate_cached_dataframes(drop: Iterable[str] = (), dirty: Dict[str, date] = None, timeout=36000):
+    """
+    Drop the frames in drop and mark the frames in dirty as stale from the given month onwards.   A dirty mark that
+    is already earlier is kept.   This is one read (the existing marks) and at most two writes however many keys.
+
+    Args:
+        drop: cache keys to delete
+        dirty: cache key -> first month that needs to be recomputed
+    """
+    if settings.NO_CACHE:
+        return
+    dirty = {key: month for key, month in (dirty or {}).items() if key not in drop}
+    if dirty:
+        marks = cache.get_many([frame_dirty_key(key) for key in dirty])
+        updates = {}
+        for key, month in dirty.items():
+            existing = marks.get(frame_dirty_key(key))
+            updates[frame_dirty_key(key)] = min(existing, month) if existing else month
+        cache.set_many(updates, timeout)
+    for key in drop:
+        frame_lru.discard(key)
+        cache.touch(key, stale_grace())  # Kept for the grace window as the stale copy,  like clear_cached_dataframe
+    if drop:
+        cache.set_many({frame_version_key(key): FRAME_STALE for key in drop}, stale_grace())  # After the touch,  so it outlives the payload
+        cache.delete_many([frame_dirty_key(key) for key in drop])
+
+
+def get_stale_dataframe(key):
+    """
+    The last frame stored at key even if it was cleared since (within the grace window),  empty if there is none
+    """
+    if not settings.NO_CACHE:
+        try:
+            data = cache.get(key)
+            if data:
+                return decode_dataframe(data)
+        except (TypeError, ValueError, pickle.UnpicklingError, zlib.error):
+            logger.debug('Had some strange stale data with key %s' % key)
+    return pd.DataFrame(columns=[])
+
+
+def acquire_frame_lease(key: str) -> bool:
+    """
+    Try to become the one worker (re)building the frame at key,  the lease expires on its own if the worker dies
+    """
+    if settings.NO_CACHE:
+        return True
+    return cache.add(frame_lease_key(key), os.getpid(), getattr(settings, 'DATAFRAME_BUILD_LEASE', 30))
+
+
+def release_frame_lease(key: str):
+    clear_simple_cache(frame_lease_key(key))
+
+
+def get_or_build_dataframe(key: str, build) -> pd.DataFrame:
+    """
+    Return the cached frame at key,  on a miss only one worker runs build() (which caches its result) at a time.
+    The others serve the stale copy if there is one,  otherwise they wait for the builder for up to the lease time
+    and build it themselves if it never shows up.
+    """
+    dataframe = get_cached_dataframe(key)
+    if not dataframe.empty:
+        return dataframe
+    if settings.NO_CACHE:
+        return build()
+
+    if not acquire_frame_lease(key):
+        dataframe = get_stale_dataframe(key)
+        if not dataframe.empty:
+            logger.debug('Serving stale %s while it is rebuilt' % key)
+            return dataframe
+        deadline = time.monotonic() + getattr(settings, 'DATAFRAME_BUILD_LEASE', 30)
+        while not acquire_frame_lease(key):
+            if time.monotonic() > deadline:
+                logger.warning('Gave up waiting on the build of %s' % key)
+                return build()
+            time.sleep(0.05)
+            dataframe = get_cached_dataframe(key)
+            if not dataframe.empty:
+                return dataframe
+    try:
+        dataframe = get_cached_dataframe(key)  # The last builder may have finished while we got the lease
+        return dataframe if not dataframe.empty else build()
+    finally:
+        release_frame_lease(key)
+
+
+def get_dirty_month(key: str):
+    """
+    The first month of the frame at key that is stale,  None when the frame is current
+    """
+    return get_simple_cache(frame_dirty_key(key))
+
+
+def clear_dirty_month(key: str):
+    clear_simple_cache(frame_dirty_key(key))
 
 
 def get_cached_dataframe(key):
     """
-    Retrieve a Pandas DataFrame from the cache.
+    Retrieve a Pandas DataFrame from the cache,  the per process copy (frame_lru) is used while its version
+    matches the one in Redis.   A frame cached before versions existed is read and given a version.
 
     Args:
         key (str): The cache key.
 
     Returns:
-        pd.DataFrame or None: The cached DataFrame, or None if not found.
+        pd.DataFrame: The cached DataFrame, or an empty DataFrame if not found.
     """
-    # Retrieve the binary data from the cache
     if not settings.NO_CACHE:
+        version = cache.get(frame_version_key(key))
+        if version == FRAME_STALE:
+            logger.debug('No cache for %s' % key)
+            return pd.DataFrame(columns=[])
+        if version is not None:
+            dataframe = frame_lru.get(key, version)
+            if dataframe is not None:
+                return dataframe
         try:
-            json_data = cache.get(key)
-            if json_data:
+            values = cache.get_many([key, frame_version_key(key)])
+            data = values.get(key)
+            version = values.get(frame_version_key(key))
+            if data and version != FRAME_STALE:
                 logger.debug('Retrieved %s from cache' % key)
-                # Deserialize the binary data back into a DataFrame
-                return pd.read_json(StringIO(json_data))
+                dataframe = decode_dataframe(data)
+                if version is None:  # A legacy entry
+                    version = time.time_ns()
+                    cache.add(frame_version_key(key), version, 36000)
+                frame_lru.put(key, version, dataframe)
+                return dataframe.copy()
             else:
                 logger.debug('No cache for %s' % key)
-        except TypeError:
+        except (TypeError, ValueError, pickle.UnpicklingError, zlib.error):
             logger.debug('Had some strange data with key %s -> clearing the data' % key)
             clear_cached_dataframe(key)
     return pd.DataFrame(columns=[])  # Return a .empty dataframe
@@ -349,6 +688,21 @@ def normalize_today() -> datetime.date:
     return datetime.today().replace(day=1).date()
 
 
+def month_range(start: date, end: date) -> pd.DatetimeIndex:
+    """
+    Every normalized month from start to end (inclusive),  this is the row axis of the account/equity dataframes
+    """
+    return pd.date_range(normalize_date(start), normalize_date(end), freq='MS')
+
+
+def month_ordinal(months) -> np.ndarray:
+    """
+    year * 12 + month,  for a date or any date like array (DatetimeIndex, Series, list of dates).  Used to index monthly NumPy tables
+    """
+    months = pd.DatetimeIndex(pd.to_datetime([months] if isinstance(months, date) else months))
+    return (months.year * 12 + months.month - 1).to_numpy()
+
+
 def tempdir() -> Path:
     return Path("/tmp" if platform.system() == "Darwin" else tempfile.gettempdir())
 
@@ -1,5 +1,6 @@
 import logging
 
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
@@ -10,7 +11,7 @@ from django.contrib.sites.shortcuts import get_current_site
 
 from django.core.mail import EmailMultiAlternatives
 from django.http import HttpResponseRedirect, JsonResponse
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
 from django.template import loader
 from django.urls import reverse
 from django.utils.http import urlsafe_base64_encode
@@ -25,7 +26,7 @@ from localflavor.us.us_states import STATE_CHOICES
 
 
 from base.forms import MainForm, ProfileForm, BaseProfileForm
-from base.models import Profile
+from base.models import Profile, API, ImportJob
 from stocks.tasks import add_to_cache
 
 logger = logging.getLogger(__name__)
@@ -95,6 +96,31 @@ class NewAccountComplete(PasswordResetCompleteView):
 def diy_check(request):
     return JsonResponse({'success': True})
 
+
+@staff_member_required
+def api_stats(request):
+    """
+    The external API counters of the process serving the request
+    """
+    return JsonResponse({'stats': API.stats()})
+
+
+@login_required
+def import_job(request, pk):
+    """
+    Follow an upload being imported,  the page polls import_job_status
+    """
+    job = get_object_or_404(ImportJob, pk=pk, user=request.user)
+    next_url = reverse('stocks_main') if job.kind == 'stocks' else reverse('expense_main')
+    return render(request, 'base/import_job.html', {'job': job, 'next_url': next_url})
+
+
+@login_required
+def import_job_status(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk, user=request.user)
+    return JsonResponse(job.status())
+
+
 def profile_create(request):
     if request.method == 'POST':
         form = BaseProfileForm(request.POST)
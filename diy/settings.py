@@ -51,10 +51,11 @@ DATABASES = {
     }
 }
 
-if ('test' in sys.argv  # set with manage.py test
-        or 'test' in sys.argv[0]  # set with pytest
-        or ('PYTEST_RUN_CONFIG' in os.environ and os.environ['PYTEST_RUN_CONFIG'])
-        or DIY_LOCALDB):  # set with local pycharm tests
+TESTING = ('test' in sys.argv  # set with manage.py test
+           or 'test' in sys.argv[0]  # set with pytest
+           or bool('PYTEST_RUN_CONFIG' in os.environ and os.environ['PYTEST_RUN_CONFIG']))
+
+if TESTING or DIY_LOCALDB:  # DIY_LOCALDB is set with local pycharm tests
     # print(f'Using a local DB - {DIY_LOCALDB}')
     DATABASES = {
         'default': {
@@ -233,3 +234,12 @@ else:
             'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}',
         }
     }
+
+# Provider responses kept on disk,  see base.response_cache.   Only for development,  backfills and benchmarks
+# (RESPONSE_CACHE=True),  never while testing,  the tests mock the providers
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'False') == 'True' and not TESTING
+RESPONSE_CACHE_MB = 200
+
+# How cached DataFrames are stored,  see base.utils.encode_dataframe (python manage.py cache_benchmark to compare)
+DATAFRAME_CACHE_CODEC = os.environ.get('DATAFRAME_CACHE_CODEC', 'pickle')  # pickle or arrow (needs pyarrow)
+DATAFRAME_CACHE_COMPRESSION = os.environ.get('DATAFRAME_CACHE_COMPRESSION', 'zlib')  # none, zlib, lz4 (needs lz4) or zstd (needs zstandard),  zlib if missing
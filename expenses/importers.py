@@ -2,7 +2,7 @@ import csv
 import logging
 
 from datetime import date, datetime
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import pandas as pd
 from django.contrib.auth.models import User
@@ -27,18 +27,56 @@ EXTRA = {
 }
 
 
-def import_dataframe(df: pd.DataFrame, owner: User):
+def unseen_rows(df: pd.DataFrame, owner: User) -> pd.DataFrame:
     """
-    Import based on a DataFrame
+    The rows of an uploaded file (Date, Description, Amount...) that owner does not have an Item for yet
+    """
+    columns = df.columns.to_list()
+    df = df.drop_duplicates()
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')  # import_dataframe reports the bad ones
+    df = df.round(2)  # Fix up any crazy rounding issues.
+
+    existing = pd.DataFrame.from_records(Item.objects.filter(user=owner).values_list('date', 'description', 'amount'))
+    if existing.empty:
+        return df
+    existing.columns = ['Date', 'Description', 'Amount']
+    existing['Date'] = pd.to_datetime(existing['Date'])
+    existing['abs_amount'] = pd.to_numeric(existing['Amount']).astype(float).abs().round(2)  # Decimal to Float
+
+    keys = df[['Date', 'Description']].assign(abs_amount=pd.to_numeric(df['Amount'], errors='coerce').abs().round(2))
+    merged = keys.merge(existing[['Date', 'Description', 'abs_amount']].drop_duplicates(), on=['Date', 'Description', 'abs_amount'],
+                        how='left', indicator=True)
+    return df.loc[(merged['_merge'] == 'left_only').to_numpy(), columns]
+
+
+def header_errors_text(headers: List[str]) -> str:
+    """
+    The messages from find_headers_errors as one line,  empty when the headers are valid
+    """
+    return ',  '.join(message for messages in find_headers_errors(headers) if messages for message in messages)
+
+
+def import_dataframe(df: pd.DataFrame, owner: User) -> Tuple[int, List[str]]:
+    """
+    Import based on a DataFrame,  rows without a valid date,  description or amount are skipped.
+    Returns the number of items created and a warning for each line that was not imported
     """
 
     if df.empty:
         logger.warning("Attempted to import an empty dataframe")
-        return
+        return 0, []
 
     if find_headers_errors(df.columns.to_list()):
         logger.error('Invalid Columns in DataFrame %s' % ','.join(df.columns.to_list()))
-        return
+        return 0, [header_errors_text(df.columns.to_list())]
+
+    warnings = []
+    dates = pd.to_datetime(df['Date'], errors='coerce')
+    amounts = pd.to_numeric(df['Amount'], errors='coerce')
+    valid = dates.notna() & amounts.notna() & df['Description'].notna()
+    for row in df.loc[~valid].itertuples(index=False):
+        warnings.append(f'{row.Date}:{row.Description} - Invalid date,  description or amount')
+    df = df.loc[valid]
 
     categories = dict(Category.objects.all().values_list('name', 'id'))
     for category in categories:
@@ -72,6 +110,7 @@ def import_dataframe(df: pd.DataFrame, owner: User):
 
         objects.append(item)
     Item.objects.bulk_create(objects, batch_size=100)
+    return len(objects), warnings
 
 
 def find_headers_errors(headers: List[str]) -> List[List[str]]:
@@ -0,0 +1,34 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+from base.models import ImportJob
+from base.utils import load_dataframe
+from expenses.importers import header_errors_text, import_dataframe, unseen_rows
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def expense_import(job_id: int):
+    """
+    Import the rows of an expenses ImportJob that are not already items
+    """
+    job = ImportJob.objects.get(id=job_id)
+    try:
+        job.set_phase(ImportJob.PARSING)
+        df = load_dataframe(settings.MEDIA_ROOT.joinpath(job.file), True)
+        errors = header_errors_text(df.columns.to_list()) if not df.empty else ''
+        if errors:
+            job.set_phase(ImportJob.FAILED, rows=len(df), error=errors)
+            return
+        job.set_phase(ImportJob.APPLYING, rows=len(df))
+        if not df.empty:
+            to_process = unseen_rows(df, job.user)
+            if len(to_process) > 0:
+                job.applied, job.warnings = import_dataframe(to_process, job.user)
+        job.set_phase(ImportJob.DONE, applied=job.applied, warnings=job.warnings)
+    except Exception as e:
+        logger.exception('Import job %s failed' % job_id)
+        job.set_phase(ImportJob.FAILED, error=f'Unexpected error: {e}')
@@ -9,9 +9,12 @@ from django.test import Client, TestCase, SimpleTestCase
 from django.urls.base import reverse
 
 from typing import List
+from unittest.mock import patch
 
+from base.models import ImportJob
 from expenses.importers import import_dataframe, find_headers_errors
 from expenses.models import Item, Category, SubCategory, Template
+from expenses.tasks import expense_import
 
 
 class ImporterTests(TestCase):
@@ -51,7 +54,7 @@ class ImporterTests(TestCase):
         with self.assertLogs(level='ERROR') as captured:
             my_dict = [{'Foo': '2017-12-29', 'Bar': 'FARM BOY #90 NEPEAN, ON', 'FooBar': 21.69, }]
             df = pd.DataFrame.from_records(data=my_dict)
-            import_dataframe(df, self.user)
+            self.assertEqual(import_dataframe(df, self.user)[0], 0)
             self.assertEqual(len(captured.records), 1, 'Error with invalid columns')
             self.assertEqual(captured.records[0].levelname, 'ERROR', 'Attempted to import an empty dataframe')
             self.assertEqual(captured.records[0].message, 'Invalid Columns in DataFrame Foo,Bar,FooBar')
@@ -214,6 +217,33 @@ class UploadViewTest(BasicSetup):
         file_path = default_storage.base_location.joinpath('uploads', result.url.split('/')[3])
         os.remove(file_path)
 
+    def test_process(self):
+        file_path = default_storage.base_location.joinpath('uploads', 'job.csv')
+        self.create_csv(['Date,Description,Amount', '2017-12-29,FARM BOY,21.69', '2017-12-30,THE HOME DEPOT,-21.29', '2017-12-31,LCBO,lots'], file_path)
+        Item.objects.create(user=self.user, date='2017-12-30', description='THE HOME DEPOT', amount=-21.29)  # Already imported
+        with patch('expenses.views.expense_import.delay') as delay:
+            result = self.client.get(reverse('upload_process', kwargs={'uuid': 'job.csv'}))
+        job = ImportJob.objects.get(user=self.user)
+        self.assertEqual(result.url, reverse('import_job', kwargs={'pk': job.id}))
+        delay.assert_called_once_with(job.id)
+
+        expense_import(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.phase, job.rows, job.applied), (ImportJob.DONE, 3, 1))
+        self.assertEqual(job.warnings, ['2017-12-31 00:00:00:LCBO - Invalid date,  description or amount'])
+        self.assertEqual(Item.objects.filter(user=self.user).count(), 2)
+        os.remove(file_path)
+
+    def test_process_bad_headers(self):
+        file_path = default_storage.base_location.joinpath('uploads', 'job.csv')
+        self.create_csv(['Date,Details,Amount', '2017-12-29,FARM BOY,21.69'], file_path)
+        job = ImportJob.objects.create(user=self.user, kind='expenses', file='uploads/job.csv')
+        expense_import(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.phase, job.error, job.applied), (ImportJob.FAILED, 'A Description column is required', 0))
+        self.assertFalse(Item.objects.filter(user=self.user).exists())
+        os.remove(file_path)
+
 
 class ColumnCorrectTest(BasicSetup):
 
@@ -221,6 +251,7 @@ class ColumnCorrectTest(BasicSetup):
         super().setUp()
         self.file_name = 'testing.csv'
         self.file_path = default_storage.base_location.joinpath('uploads', self.file_name)
+        self.addCleanup(lambda: self.file_path.unlink(missing_ok=True))  # Not every test removes it
 
     def test_get(self):
 
@@ -24,12 +24,13 @@ from django.shortcuts import render, HttpResponseRedirect, reverse, get_object_o
 from django.urls import reverse_lazy
 from django.views.generic import CreateView, DeleteView, UpdateView, FormView, ListView
 
-from base.models import COLORS, PALETTE
+from base.models import COLORS, PALETTE, ImportJob
 from base.utils import DateUtil, label_to_values, date_to_label, set_simple_cache, load_dataframe
 from base.views import BaseDeleteView
 from expenses.importers import import_dataframe, find_headers_errors
 from expenses.forms import SubCategoryForm, ItemForm, ItemAddForm, ItemEditForm, TemplateForm, ItemListEditForm, SearchForm, UploadFileForm, UploadColumnForm, TagForm
 from expenses.models import Item, Category, SubCategory, ItemTag, Template, DEFAULT_CATEGORIES
+from expenses.tasks import expense_import
 
 from django.http import JsonResponse
 from django.views.decorators.http import require_POST
@@ -552,32 +553,13 @@ def upload_confirm(request, uuid: uuid, headings):
 
 @login_required
 def upload_process(request, uuid: uuid):
-    file_path = default_storage.base_location.joinpath('uploads', uuid)
-    df = load_dataframe(file_path, True)
-
-    if not df.empty:
-        df['Date'] = pd.to_datetime(df['Date'])
-        df['abs_amount'] = df['Amount'].astype(float).abs()
-        df = df.round(2)  # Fix up any crazy rounding issues.
-
-        existing = pd.DataFrame.from_records(Item.objects.filter(user=request.user).values_list('date', 'description', 'amount'))
-        if not existing.empty:
-            existing.columns = ['Date', 'Description', 'Amount']
-            existing['Date'] = pd.to_datetime(existing['Date'])
-            existing['Amount'] = pd.to_numeric(existing['Amount'])  # Decimal to Float
-
-            existing['abs_amount'] = existing['Amount'].astype(float).abs()
-            existing = existing.round(2)
-
-            # todo: I won't pretend to understand this, but it works and it's darn fast.
-            to_process = df.drop_duplicates().merge(existing.drop_duplicates(), on=['Date', 'Description', 'abs_amount'], how='left', indicator=True)
-            to_process = to_process.loc[to_process._merge == 'left_only', to_process.columns != '_merge']
-        else:
-            to_process = df
+    """
+    Queue the (confirmed) file as an ImportJob (expenses.tasks.expense_import),  the browser follows the job's progress
+    """
+    job = ImportJob.objects.create(user=request.user, kind='expenses', file=os.path.join('uploads', uuid))
+    expense_import.delay(job.id)
+    return HttpResponseRedirect(reverse('import_job', kwargs={'pk': job.id}))
 
-        if len(to_process) > 0:
-            errors = import_dataframe(to_process, request.user)
-    return HttpResponseRedirect(reverse('expense_main'))
 
 @login_required
 def export_expense_page(request):
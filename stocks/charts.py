@@ -137,7 +137,7 @@ def cost_value_chart(request):
         df['Cost'] = df['Funds'] - df['Redeemed']
         if my_object.end:
             df = df.loc[df['Date'] <= pd.to_datetime(my_object.end)]
-        df.fillna(0, inplace=True)
+        df = df.fillna(0)
         label1 = 'Funding'
 
     if df.empty:
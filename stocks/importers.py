@@ -3,12 +3,18 @@ import csv
 import logging
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db.models import Q
 
-from .models import Equity, EquityAlias, Account, EquityValue, EquityEvent, Transaction, DataSource, AV_API_KEY
+from django.db.transaction import atomic
+
+from .models import Equity, EquityAlias, Account, EquityValue, EquityEvent, ExchangeRate, Transaction, DataSource, CacheDependencies, AV_API_KEY
+from .refresh import refresh_equities
 from base.utils import normalize_date, DIYImportException
 
 
@@ -39,6 +45,110 @@ HEADERS = {
 SPLIT_MESSAGE = 'Stock split detected,  only the admin can update prior dividends.   They have been contacted'
 
 
+def importer_for(csv_type: str, currency: str, reader: csv.reader, user: User) -> 'StockImporter':
+    """
+    The importer for an UploadFileForm csv_type,  the generic (HEADERS) one by default
+    """
+    if csv_type == 'QuestTrade':
+        return QuestTrade(currency, reader, user)
+    elif csv_type == 'Manulife':
+        return Manulife(currency, reader, user)
+    elif csv_type == 'Wealth':
+        return ManulifeWealth(currency, reader, user)
+    return StockImporter(currency, reader, user, HEADERS, managed=False)
+
+
+class SymbolResolver:
+    """
+    Resolve every equity an import mentions in one pass.   The distinct (symbol, description, region) of the file are
+    matched against an in-memory index of Equity and EquityAlias (two queries),  only the symbols still unknown are
+    searched for (Equity.lookup,  in parallel) and the new aliases are written with one bulk_create (save).
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers if workers else getattr(settings, 'SYMBOL_LOOKUP_WORKERS', 4)
+        self.symbols: Dict[str, Equity] = {}  # Equity.symbol,  then EquityAlias.symbol
+        self.names: Dict[Tuple[str, str], Equity] = {}  # (EquityAlias.name, region)
+        self.aliases = set()  # (symbol, name, region) with an EquityAlias
+        self.new_aliases: List[EquityAlias] = []
+
+    def index(self, wanted: Iterable[Tuple[str, str, str]]):
+        """
+        Load the equities and aliases that can match wanted,  (symbol, name, region) tuples
+        """
+        wanted = list(wanted)
+        symbols = {symbol for symbol, _, _ in wanted if symbol}
+        symbols |= {f'{symbol}.{region}' for symbol, _, region in wanted if symbol}  # What get_or_create_equity aliases as
+        names = {name for _, name, _ in wanted if name}
+        for equity in Equity.objects.filter(symbol__in=symbols):
+            self.symbols[equity.symbol] = equity
+        for alias in EquityAlias.objects.filter(Q(symbol__in=symbols) | Q(name__in=names)).select_related('equity').order_by('id'):
+            self.symbols.setdefault(alias.symbol, alias.equity)
+            self.names.setdefault((alias.name, alias.region), alias.equity)
+            self.aliases.add((alias.symbol, alias.name, alias.region))
+
+    def find(self, symbol: str, name: str, region: str) -> Optional[Equity]:
+        """
+        By symbol (or an alias symbol),  then by the alias name in the region (see EquityAlias.find_equity)
+        """
+        return self.symbols.get(symbol) or self.names.get((name, region))
+
+    def equities(self) -> List[Equity]:
+        return list({equity.id: equity for equity in list(self.symbols.values()) + list(self.names.values())}.values())
+
+    def create(self, new: Iterable[Tuple[str, str, str, str]], managed: bool):
+        """
+        Create the equities for the (symbol, name, currency, region) that find does not know,  searching for their
+        real symbols in parallel
+        """
+        unknown = list({item for item in new if not self.find(item[0], item[1], item[3])})
+        if not unknown:
+            return
+        searches = list({(symbol, region) for symbol, _, _, region in unknown})
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            found = dict(zip(searches, pool.map(lambda search: Equity.lookup(*search), searches)))
+        existing = {equity.symbol: equity for equity in Equity.objects.filter(symbol__in=set(found.values()))}
+        for symbol, name, currency, region in unknown:
+            l_symbol = found[(symbol, region)]
+            if symbol in self.symbols:  # Another description of the same symbol
+                continue
+            equity = existing.get(l_symbol)
+            if not equity:
+                equity = Equity.objects.create(symbol=l_symbol, name=name, region=region, currency=currency)
+                if not equity.equity_type:
+                    if equity.name.find(' ETF') != -1:
+                        equity.equity_type = 'Equity'
+                elif not managed:
+                    equity.equity_type = 'Equity'
+                elif name.find('%') != -1 or name.find('SAVINGS') != -1:
+                    equity.equity_type = 'Cash'
+                else:
+                    equity.equity_type = 'MF'
+                equity.save()
+                existing[l_symbol] = equity
+            self.symbols[symbol] = equity
+
+    def alias(self, symbol: str, name: str, region: str, equity: Equity):
+        """
+        Queue an EquityAlias unless there is one already
+        """
+        if (symbol, name, region) not in self.aliases:
+            self.aliases.add((symbol, name, region))
+            self.new_aliases.append(EquityAlias(symbol=symbol, name=name, region=region, equity=equity))
+        self.symbols.setdefault(symbol, equity)
+        self.names.setdefault((name, region), equity)
+
+    def save(self):
+        """
+        Write the queued aliases,  less any that were not indexed but do exist
+        """
+        if self.new_aliases:
+            existing = set(EquityAlias.objects.filter(symbol__in={alias.symbol for alias in self.new_aliases}).values_list('symbol', 'name', 'region'))
+            EquityAlias.objects.bulk_create([alias for alias in self.new_aliases if (alias.symbol, alias.name, alias.region) not in existing],
+                                            batch_size=500)
+        self.new_aliases = []
+
+
 class StockImporter:
     """
     Pull the CSV file into a pd structure, so we can sort it.   Sorting is required, so we can calculate the dividends
@@ -57,12 +167,17 @@ class StockImporter:
         self.added_columns = set(self.headers.keys()) - set(self._columns)
         for new_column in self.added_columns:
             self._columns.append(new_column)
-        self.pd = pd.DataFrame(columns=self._columns)
         self.accounts: Dict[str, Account] = {}
-        self.equities: Dict[str, Equity] = {}
+        self.resolver = SymbolResolver()
+        self.applied = 0  # Rows not imported before
+        self.bulk = False
+        self.pending: List[Transaction] = []  # Bulk mode,  waiting on flush
+        self.values: List[Tuple[Equity, date, float]] = []
+        self.prices: Dict[Tuple[int, date], float] = {}
         self.new_account_currency = currency
         self.mappings = self.get_headers(reader)
 
+        rows = []  # Build the frame once,  appending to a DataFrame copies it on every row
         for row in reader:
             xa_date: date = self.csv_date(row)  # Normalize and format date (need to override if date format is off)
             if xa_date:  # Skip blank lines
@@ -76,19 +191,30 @@ class StockImporter:
                 quantity: float = self.csv_quantity(row)
                 amount: float = self.csv_amount(row)
                 if xa_type:
-                    self.pd.loc[len(self.pd.index)] = self.add_extra_data(row,[xa_date, account_name, account_key,
-                                                                       symbol, description, xa_type, currency,
-                                                                      quantity, price, amount])
+                    rows.append(self.add_extra_data(row, [xa_date, account_name, account_key, symbol, description, xa_type,
+                                                          currency, quantity, price, amount]))
                 else:
                     self.warnings.append(f'{xa_date}:{symbol} - Can not determine transaction type')
 
+        self.pd = pd.DataFrame(rows, columns=self._columns)
         self.pd['Date'] = pd.to_datetime(self.pd['Date'])
         self.pd = self.pd.sort_values(['Date', 'AccountKey', 'XAType'], ascending=[True, True, True])
 
-    def process(self):
+    def process(self, bulk: bool = False, recompute: bool = True):
+        """
+        Apply the sorted rows.
+        kwargs:
+            bulk: bool - resolve accounts,  equities and prices up front and write the transactions and prices in bulk
+                         (flush) rather than saving them row by row
+            recompute: bool - finish with recompute(),  leave it to the caller when False
+        """
         equity_totals = {}  # Needed to calculate dividends on a specific date
         last_import = None
-        for _, prow in self.pd.iterrows():
+        self.bulk = bulk
+        self.resolve()
+        if bulk:
+            self.preload()
+        for prow in self.pd.itertuples(index=False):
             do_process: bool = True
             this_date: date = self.pd_date(prow)
             norm_date = normalize_date(this_date)
@@ -109,23 +235,24 @@ class StockImporter:
             if not account.last_import or (this_date > account.last_import):
 
                 last_import = this_date  # This has been pre-ordered by date
+                self.applied += 1
 
                 if xa_action == FUND:
-                    Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=FUND, quantity=0, price=0).save(source=DataSource.UPLOAD.value)
+                    self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=FUND, quantity=0, price=0))
                 elif xa_action == REDEEM:
-                    Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=REDEEM, quantity=0, price=0).save(source=DataSource.UPLOAD.value)
+                    self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=REDEEM, quantity=0, price=0))
                 elif xa_action == JUNK:
                     pass
                 elif xa_action == INT:
-                    Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=INT, quantity=quantity, price=price).save(source=DataSource.UPLOAD.value)
+                    self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=INT, quantity=quantity, price=price))
                 elif xa_action == FEES:
-                    Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=FEES, quantity=quantity, price=price).save(source=DataSource.UPLOAD.value)
+                    self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=FEES, quantity=quantity, price=price))
 
                 elif xa_action in [DIV, DIV_VALUE, VALUE]:
                     equity = self.equity_lookup(symbol, self.pd_description(prow), region)
                     if not equity.searchable:
                         if xa_action == VALUE:
-                            EquityValue.get_or_create(equity=equity, real_date=this_date, price=price, source=DataSource.UPLOAD.value)
+                            self.record_value(equity, this_date, price)
                         elif xa_action == DIV_VALUE:
                             EquityEvent.get_or_create(equity=equity, real_date=this_date, value=value, event_type='Dividend', source=DataSource.UPLOAD.value)
                         else:
@@ -133,7 +260,7 @@ class StockImporter:
                             if value != 0:  # CIBC stock split.  Best to handled it manually because dividends are screwy
                                 EquityEvent.get_or_create(equity=equity, real_date=this_date, value=value, event_type='Dividend', source=DataSource.UPLOAD.value)
                             if price != 0:
-                                EquityValue.get_or_create(equity=equity, real_date=this_date, price=price, source=DataSource.UPLOAD.value)
+                                self.record_value(equity, this_date, price)
                 else:  # Things that deal with equities
                     if symbol:
                         equity = self.get_or_create_equity(symbol, name, currency, region, False)
@@ -146,50 +273,152 @@ class StockImporter:
                                 if amount and quantity:
                                     price = amount / quantity  # Sometimes amount includes fees!
                                 else:
-                                    price = price if price else EquityValue.lookup_price(equity, this_date)
+                                    price = price if price else self.price_on(equity, this_date)
                             else:
                                 price = 0
 
                             action = Transaction.BUY if xa_action != REINVESTED else Transaction.REDIV
                             amount = amount if amount else price * quantity
-                            Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount, xa_action=action, quantity=quantity, price=price).save(source=DataSource.UPLOAD.value)
+                            self.record(Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount, xa_action=action, quantity=quantity, price=price))
 
                         elif xa_action in [SELL, TRANSFER_OUT]:
                             if amount and quantity:
                                 price = amount / quantity  # Sometimes amount includes fees!,  quantity will be negative
                             else:
-                                price = price if price else EquityValue.lookup_price(equity, this_date)
+                                price = price if price else self.price_on(equity, this_date)
 
                             amount = amount if amount else price * quantity
-                            Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount * -1, xa_action=SELL, quantity=quantity * -1, price=price).save(source=DataSource.UPLOAD.value)
+                            self.record(Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount * -1, xa_action=SELL, quantity=quantity * -1, price=price))
                         elif xa_action == TFSA_TRANSFER:
-                            price = EquityValue.lookup_price(equity, normalize_date(this_date))
+                            price = self.price_on(equity, normalize_date(this_date))
                             amount = amount if amount else price * quantity
                             if quantity < 0:
-                                Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount * -1 , xa_action=SELL,
-                                                            quantity=quantity * -1, price=price).save(source=DataSource.UPLOAD.value)
-                                Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=REDEEM).save(source=DataSource.UPLOAD.value)
+                                self.record(Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount * -1 , xa_action=SELL,
+                                                            quantity=quantity * -1, price=price))
+                                self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount * -1, xa_action=REDEEM))
                             elif quantity > 0:
-                                Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount, xa_action=BUY,
-                                                           quantity=quantity, price=price).save(source=DataSource.UPLOAD.value)
-                                Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=FUND).save(source=DataSource.UPLOAD.value)
+                                self.record(Transaction(real_date=this_date, account=account, equity=equity, user=self.user, value=amount, xa_action=BUY,
+                                                           quantity=quantity, price=price))
+                                self.record(Transaction(real_date=this_date, account=account, user=self.user, value=amount, xa_action=FUND))
                         else:
                             raise DIYImportException(f'Unexpected Activity type {xa_action}')
 
-        # Finally update everything possible
+        if bulk:
+            self.flush()
+        self.resolver.save()
+
         for account in self.accounts:
             if (not self.accounts[account].last_import) or (last_import and (self.accounts[account].last_import < last_import)):
                 self.accounts[account].last_import = last_import
                 self.accounts[account].save()  # Will update last import if anything was done,  if not then not harm.
+        if recompute:
+            self.recompute()
 
+    def recompute(self):
+        """
+        Update the equities of the imported accounts (once each) and then the accounts,  the slow part of an import
+        """
+        equities = {}
+        for account in self.accounts:
             for equity in self.accounts[account].equities:
-                if self.user.is_superuser or self.user.profile.av_api_key:
-                    key = self.user.profile.av_api_key if self.user.profile.av_api_key else AV_API_KEY
-                    equity.update(force=False, key=key)
-                else:
-                    equity.fill_equity_value_holes()
+                equities[equity.id] = equity  # Once,  even when held in more than one of the accounts
+        if self.user.is_superuser or self.user.profile.av_api_key:
+            key = self.user.profile.av_api_key if self.user.profile.av_api_key else AV_API_KEY
+            refresh_equities(list(equities.values()), key=key, daily=False)  # Alphavantage calls are budgeted by av_schedule
+        else:
+            for equity in equities.values():
+                equity.fill_holes()
+        for account in self.accounts:
             self.accounts[account].update_static_values()
 
+    def resolve(self):
+        """
+        Look up the accounts and every equity the rows (not already imported) mention,  creating the equities that
+        will be traded but are not known yet.   See SymbolResolver
+        """
+        for account in Account.objects.filter(user=self.user, account_name__in=set(self.pd['AccountKey'])):
+            self.accounts[account.account_name] = account
+
+        wanted = set()
+        new = set()
+        for row in self.pd.itertuples(index=False):
+            account = self.accounts.get(self.pd_account_key(row))
+            if account and account.last_import and self.pd_date(row) <= account.last_import:
+                continue  # process() will skip it
+            symbol = self.pd_symbol(row)
+            name = self.pd_description(row)
+            currency = self.pd_currency(row)
+            region = 'Canada' if currency == 'CAD' else 'US'
+            wanted.add((symbol, name, region))
+            if symbol and self.pd_xa_type(row) in [BUY, REINVESTED, TRANSFER_IN, SPLIT, SELL, TRANSFER_OUT, TFSA_TRANSFER]:
+                new.add((symbol, name, currency, region))
+        self.resolver.index(wanted)
+        self.resolver.create(new, False)
+
+    def preload(self):
+        """
+        Bulk mode,  look up the prices of the known equities over the months of the file in one query
+        """
+        equities = self.resolver.equities()
+        if equities and len(self.pd):
+            values = EquityValue.objects.filter(equity__in=equities, date__gte=normalize_date(self.pd['Date'].min()),
+                                                date__lte=normalize_date(self.pd['Date'].max()))
+            for equity_id, this_date, price in values.values_list('equity_id', 'date', 'price'):
+                self.prices[(equity_id, this_date)] = price
+
+    def record(self, transaction: Transaction):
+        """
+        Save transaction,  in bulk mode keep it for flush (noting the price it will give a not searchable equity)
+        """
+        if not self.bulk:
+            transaction.save(source=DataSource.UPLOAD.value)
+            return
+        self.pending.append(transaction)
+        if transaction.price and transaction.xa_action != Transaction.REDIV and transaction.equity and not transaction.equity.searchable:
+            self.prices[(transaction.equity.id, normalize_date(transaction.real_date))] = abs(transaction.price)
+
+    def record_value(self, equity: Equity, real_date: date, price: float):
+        if not self.bulk:
+            EquityValue.get_or_create(equity=equity, real_date=real_date, price=price, source=DataSource.UPLOAD.value)
+            return
+        self.values.append((equity, real_date, price))
+        self.prices[(equity.id, normalize_date(real_date))] = price
+
+    def price_on(self, equity: Equity, this_date: date) -> float:
+        if not self.bulk:
+            return EquityValue.lookup_price(equity, this_date)
+        return self.prices.get((equity.id, this_date), 0)
+
+    def flush(self) -> List[Tuple[Equity, date]]:
+        """
+        Bulk mode,  write the recorded transactions and the prices they imply in one database transaction.   Currency
+        factors are looked up once per currency pair.   Returns the (equity, date) prices changed
+        """
+        pairs: Dict[Tuple[str, str], List[Transaction]] = {}
+        for transaction in self.pending:
+            if transaction.equity:
+                pairs.setdefault((transaction.equity.currency, transaction.account.currency), []).append(transaction)
+        factors = {}
+        for (from_currency, to_currency), transactions in pairs.items():
+            dates = [normalize_date(transaction.real_date) for transaction in transactions]
+            for transaction, factor in zip(transactions, ExchangeRate.factors(dates, from_currency, to_currency)):
+                factors[id(transaction)] = float(factor)
+
+        values = list(self.values)
+        for transaction in self.pending:
+            transaction.normalize(factors.get(id(transaction)))
+            if transaction.price != 0 and transaction.equity and not transaction.equity.searchable:
+                values.append((transaction.equity, transaction.real_date, transaction.price))
+        with atomic():
+            Transaction.objects.bulk_create(self.pending, batch_size=500)
+            changed = EquityValue.bulk_upsert(values, DataSource.UPLOAD.value)
+        for equity_id, account_id in {(transaction.equity.id, transaction.account.id) for transaction in self.pending if transaction.equity}:
+            CacheDependencies.note(equity_id, account_id)
+        logger.debug('Bulk import of %s transactions and %s prices' % (len(self.pending), len(changed)))
+        self.pending = []
+        self.values = []
+        return changed
+
     def get_headers(self, csv_reader):
         if set(self._columns) - set(self.headers.keys()):
             missing = str(set(self._columns) - set(self.headers.keys()))
@@ -288,7 +517,7 @@ class StockImporter:
 
     @staticmethod
     def pd_get(row, key):
-        return row[key]
+        return getattr(row, key)
 
     def pd_symbol(self, row) -> str:
         return self.pd_get(row, 'Symbol')
@@ -315,7 +544,7 @@ class StockImporter:
         return abs(float(self.pd_get(row, 'Amount')))
 
     def pd_xa_type(self, row) -> int:
-        return self.pd_get(row, 'XAType')
+        return int(self.pd_get(row, 'XAType'))
 
     def pd_currency(self, row) -> str:
         return self.pd_get(row, 'Currency')
@@ -332,19 +561,10 @@ class StockImporter:
         return existing
 
     def equity_lookup(self, symbol: str, name: str, region: str):
-        if symbol not in self.equities:
-            try:
-                equity = Equity.objects.get(symbol=symbol)
-            except Equity.DoesNotExist:
-                try:
-                    alias = EquityAlias.objects.get(symbol=symbol)
-                    equity = alias.equity
-                except EquityAlias.DoesNotExist:
-                    equity = EquityAlias.find_equity(name, region)
-                    if not equity:
-                        raise DIYImportException(f'Failed to lookup {symbol} - {name} @ {region}')
-            self.equities[equity] = equity
-        return self.equities[equity]
+        equity = self.resolver.find(symbol, name, region)
+        if not equity:
+            raise DIYImportException(f'Failed to lookup {symbol} - {name} @ {region}')
+        return equity
 
     def get_or_create_equity(self, symbol: str, name: str, currency: str, region: str, managed: bool):
         """
@@ -356,32 +576,18 @@ class StockImporter:
         :return:
         """
 
-        try:
-            equity = self.equity_lookup(symbol, name, region)
-        except DIYImportException:
-            l_symbol = Equity.lookup(symbol, region)
-            equity = Equity.objects.create(symbol=l_symbol, name=name, region=region, currency=currency)
-            if not equity.equity_type:
-                if equity.name.find(' ETF') != -1:
-                    equity.equity_type = 'Equity'
-            elif not managed:
-                equity.equity_type = 'Equity'
-            elif name.find('%') != -1 or name.find('SAVINGS') != -1:
-                equity.equity_type = 'Cash'
-            else:
-                equity.equity_type = 'MF'
-            equity.save()
+        equity = self.resolver.find(symbol, name, region)
+        if not equity:  # Not seen by resolve()
+            self.resolver.create([(symbol, name, currency, region)], managed)
+            equity = self.resolver.find(symbol, name, region)
 
         if not equity:  # pragma: no cover
             raise DIYImportException(f'Could not create/lookup equity {symbol} - {name}')
 
-        lookup = symbol + '.' + region
-        if not EquityAlias.objects.filter(symbol=lookup, name=name, region=region).exists():
-            EquityAlias.objects.create(symbol=lookup, name=name, equity=equity, region=region)
+        self.resolver.alias(symbol + '.' + region, name, region, equity)
 
         # equity.update_external_equity_data(force=False)   # This will only happen once a day.
-        self.equities[lookup] = equity
-        return self.equities[lookup]
+        return equity
 
     def get_or_create_account(self, user, name, account_id, base_currency):
         """
@@ -411,7 +617,7 @@ class StockImporter:
         :return:
         """
         for equity in Equity.objects.all():
-            equity.fill_equity_value_holes()
+            equity.fill_holes()
 
 
 class Manulife(StockImporter):
@@ -0,0 +1,101 @@
+import csv
+import io
+import numpy as np
+
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from stocks.importers import Manulife, QuestTrade
+
+
+class Command(BaseCommand):
+    help = 'Time parsing (and walking) a synthetic QuestTrade / Manulife export,  nothing is written to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Rows in each synthetic export')
+        parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs')
+
+    @staticmethod
+    def questtrade(rows: int) -> str:
+        """
+        A QuestTrade activity export,  buys,  sells and dividends on a few dozen symbols in two accounts
+        """
+        rng = np.random.default_rng(0)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Transaction Date', 'Settlement Date', 'Action', 'Symbol', 'Description', 'Quantity', 'Price',
+                         'Gross Amount', 'Commission', 'Net Amount', 'Currency', 'Account #', 'Activity Type', 'Account Type'])
+        start = datetime(2010, 1, 4)
+        for n in range(rows):
+            when = (start + timedelta(days=int(n * 5000 / rows))).strftime('%Y-%m-%d %H:%M:%S %p')
+            symbol = f'EQ{rng.integers(40)}'
+            price = round(float(rng.uniform(5, 200)), 2)
+            kind = rng.integers(3)
+            if kind == 0:
+                quantity = int(rng.integers(1, 100))
+                row = ['Buy', symbol, f'{symbol} BOUGHT', quantity, price, -9.95, f'{-quantity * price - 9.95:.2f}', 'Trades']
+            elif kind == 1:
+                quantity = -int(rng.integers(1, 100))
+                row = ['Sell', symbol, f'{symbol} SOLD', quantity, price, -9.95, f'{-quantity * price - 9.95:.2f}', 'Trades']
+            else:
+                row = ['', '.' + symbol, f'{symbol} CASH DIV ON 100 SHS', 0, 0, 0, f'{price / 10:.2f}', 'Dividends']
+            action, symbol, description, quantity, price, fees, amount, activity = row
+            writer.writerow([when, when, action, symbol, description, quantity, price, amount, fees, amount, 'CAD',
+                             f'{n % 2 + 1000}', activity, 'Individual TFSA'])
+        return output.getvalue()
+
+    @staticmethod
+    def manulife(rows: int) -> str:
+        """
+        A Manulife transaction export,  purchases,  redemptions and reinvested dividends on a dozen funds
+        """
+        rng = np.random.default_rng(0)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Account', 'Account Number', 'Investment Name', 'Symbol', 'Transaction Type', 'Currency',
+                         'Unit Quantity', 'Price', 'Net Amount', 'Process Date'])
+        start = datetime(2010, 1, 4)
+        for n in range(rows):
+            when = (start + timedelta(days=int(n * 5000 / rows))).strftime('%Y-%m-%d')
+            fund = int(rng.integers(12))
+            quantity = round(float(rng.uniform(1, 500)), 4)
+            price = round(float(rng.uniform(5, 50)), 4)
+            action = ('Purchase', 'Redemption', 'Reinvested Dividend/Interest')[int(rng.integers(3))]
+            writer.writerow(['RRSP', '555', f'Fund {fund} Series F', f'MLF{fund}', action, 'CAD', quantity, price,
+                             f'{quantity * price:.2f}', when])
+        return output.getvalue()
+
+    @staticmethod
+    def best(repeat: int, function):
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            result = function()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None or elapsed < best else best
+        return best, result
+
+    @staticmethod
+    def walk(importer) -> int:
+        """
+        What process() does to every row before it touches the database
+        """
+        count = 0
+        for row in importer.pd.itertuples(index=False):
+            importer.pd_date(row), importer.pd_symbol(row), importer.pd_xa_type(row), importer.pd_amount(row)
+            importer.pd_price(row), importer.pd_quantity(row), importer.pd_account_key(row)
+            count += 1
+        return count
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        repeat = options['repeat']
+
+        self.stdout.write(f'{rows} rows,  best of {repeat}')
+        self.stdout.write(f'{"importer":<16}{"parse ms":>12}{"walk ms":>12}{"rows":>12}')
+        for name, importer, text in (('QuestTrade', QuestTrade, self.questtrade(rows)), ('Manulife', Manulife, self.manulife(rows))):
+            parse_time, result = self.best(repeat, lambda: importer('CAD', csv.reader(io.StringIO(text)), None))
+            walk_time, count = self.best(repeat, lambda: self.walk(result))
+            self.stdout.write(f'{name:<16}{parse_time * 1000:>12.2f}{walk_time * 1000:>12.2f}{count:>12}')
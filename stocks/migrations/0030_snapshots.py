@@ -0,0 +1,68 @@
+# Generated by Django 4.2 on 2026-10-18 17:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0029_rename_deactived_date_equity_deactivated_date_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EquitySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shares', models.FloatField(null=True)),
+                ('cost', models.FloatField(null=True)),
+                ('price', models.FloatField(null=True)),
+                ('dividends', models.FloatField(null=True)),
+                ('total_dividends', models.FloatField(null=True)),
+                ('value', models.FloatField(null=True)),
+                ('total_buy', models.FloatField(null=True)),
+                ('total_sell', models.FloatField(null=True)),
+                ('realized_gain', models.FloatField(null=True)),
+                ('unrealized_gain', models.FloatField(null=True)),
+                ('realized_gain_pct', models.FloatField(null=True)),
+                ('unrealized_gain_pct', models.FloatField(null=True)),
+                ('avg_cost', models.FloatField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stocks.account')),
+                ('equity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stocks.equity')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('funds', models.FloatField(null=True)),
+                ('redeemed', models.FloatField(null=True)),
+                ('trans_in', models.FloatField(null=True)),
+                ('trans_out', models.FloatField(null=True)),
+                ('new_cash', models.FloatField(null=True)),
+                ('cash', models.FloatField(null=True)),
+                ('effective', models.FloatField(null=True)),
+                ('cost', models.FloatField(null=True)),
+                ('total_dividends', models.FloatField(null=True)),
+                ('dividends', models.FloatField(null=True)),
+                ('value', models.FloatField(null=True)),
+                ('actual', models.FloatField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stocks.account')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='equitysnapshot',
+            index=models.Index(fields=['account', 'date'], name='stocks_equi_account_fafbba_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='equitysnapshot',
+            unique_together={('account', 'equity', 'date')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountsnapshot',
+            unique_together={('account', 'date')},
+        ),
+    ]
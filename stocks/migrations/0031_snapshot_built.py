@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 18:05
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0030_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountsnapshot',
+            name='built',
+            field=models.DateTimeField(auto_now_add=True, default=datetime.datetime(2000, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='equitysnapshot',
+            name='built',
+            field=models.DateTimeField(auto_now_add=True, default=datetime.datetime(2000, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+            preserve_default=False,
+        ),
+    ]
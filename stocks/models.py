@@ -56,22 +56,27 @@ from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from enum import Enum
 from functools import cached_property
-from typing import List, Dict, Union
-from datetime import datetime, date
-from time import sleep
+from typing import List, Dict, Tuple, Union
+from datetime import datetime, date, timedelta
+from time import monotonic
 from pandas import DataFrame
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models import QuerySet, Sum, Avg, Q, Count
+from django.db.transaction import atomic
+from django.db.models import QuerySet, Sum, Avg, Q, Count, Min, Max
 from django.db.models.functions import TruncMonth, TruncQuarter, TruncYear
 
 from django.urls import reverse
+from django.utils import timezone
 
 from base.models import API, DIY_EPOCH
-from base.utils import BoolReason,  normalize_date, normalize_today, next_date, cache_dataframe, clear_cached_dataframe,  get_cached_dataframe, clear_simple_cache, get_simple_cache, set_simple_cache
+from base.utils import BoolReason,  normalize_date, normalize_today, next_date, month_range, cache_dataframe, clear_cached_dataframe,  get_cached_dataframe, clear_simple_cache, get_simple_cache, set_simple_cache, \
+    get_simple_cache_many, set_simple_cache_many, get_cache_version, bump_cache_version, month_ordinal, invalidate_cached_dataframes, get_dirty_month, clear_dirty_month, \
+    get_or_build_dataframe, acquire_frame_lease, release_frame_lease
+from base.response_cache import cached_series
 
 logger = logging.getLogger(__name__)
 logging.getLogger('yfinance').setLevel(logging.CRITICAL)  # Quiet damn you.
@@ -119,6 +124,8 @@ CURRENCIES = (
 )
 
 EPOCH = DIY_EPOCH
+BOC_OVERLAP = getattr(settings, 'BOC_OVERLAP_MONTHS', 2)  # Months re-read from BOC before the last one we have,  to catch revisions
+SNAPSHOT_TTL = getattr(settings, 'SNAPSHOT_TTL', 2 * 24 * 60 * 60)  # Seconds,  an account snapshot older than this is rebuilt
 
 AV_REGIONS = {'Toronto': {'suffix': 'TRT'},
               'United States': {'suffix': None},
@@ -162,31 +169,126 @@ def currency_factor(exchange_date: date, input_currency: str, my_currency: str)
     :param input_currency:
     :return:
     """
-    # todo:  why do I have the twice
-    if input_currency and my_currency:
-        if not input_currency == my_currency:
-            if input_currency == 'USD':
-                return ExchangeRate.us_to_can_rate(exchange_date)
-            elif input_currency == 'CAD':
-                return ExchangeRate.can_to_us_rate(exchange_date)
-            else:
-                raise Exception(f'Unexpected input_currency {input_currency}')
-    return 1
-
-
-def clear_duplicates(equity_object, equity, event_object=False):
-    equity_object_query = equity_object.objects.filter(equity=equity).values('date')
-    if event_object:
-        equity_object_query = equity_object_query.filter(event_type='Dividend')
-    for dup in equity_object_query.values('date').annotate(date_count=Count('id')).filter(date_count__gt=1):
-        results = equity_object.objects.filter(equity=equity, date=dup['date'])
-        best_record = results[0]
-        for record in results[1:]:
-            if record.source < best_record.source or record.real_date > best_record.real_date:
-                best_record.delete()
-                best_record = record
-            else:
-                record.delete()
+    return float(ExchangeRate.factors(exchange_date, input_currency, my_currency)[0])
+
+
+def floored_cumsum(values: np.ndarray, initial: float = 0.0) -> np.ndarray:
+    """
+    A running total that is never allowed to go below 0 (like our Cash balance),  without the month by month loop.
+        total[n] = max(0, total[n-1] + values[n])
+    """
+    running = initial + np.cumsum(values, dtype=float)
+    return running - np.minimum(np.minimum.accumulate(running), 0)
+
+
+def compounded_cumsum(values: np.ndarray, ratios: np.ndarray, initial: float = 0.0) -> np.ndarray:
+    """
+    A running total where the prior total is grown by ratios[n] before values[n] is added (like our Effective cost)
+        total[n] = total[n-1] * ratios[n] + values[n]
+    """
+    growth = np.cumprod(ratios, dtype=float)
+    return growth * (initial + np.cumsum(np.asarray(values, dtype=float) / growth))
+
+
+# The running totals for an equity,  what we carry from one month to the next
+HOLDING_STATE = {'shares': 0.0, 'cost': 0.0, 'total_dividends': 0.0, 'realized_gain': 0.0, 'total_spend': 0.0, 'total_redeem': 0.0, 'avg_cost': 0.0}
+
+
+def holdings_scan(monthly: Dict[str, np.ndarray], managed: bool, state: Dict[str, float] = None) -> Tuple[Dict[str, np.ndarray], Dict[str, float]]:
+    """
+    The month by month bookkeeping for one equity,  every input is a NumPy array over the month axis
+        quantity, spend, redeem, sold_qty, sold_at_price - BUY/SELL/TRANS_IN/TRANS_OUT summed for the month
+        rediv_qty, rediv_value - reinvested dividends (only used on managed accounts)
+        dividends - cash dividends earned (only used on non-managed accounts)
+        price, factor - the equity price and the currency factor for the month
+    Realized gains depend on last months average cost,  which depends on the shares held,  so the running totals are
+    a single loop over plain floats,  the remaining columns are derived with NumPy.
+    state is the carry forward from an earlier scan,  the ending state is returned with the columns.
+    """
+    state = dict(HOLDING_STATE if state is None else state)
+    size = len(monthly['price'])
+    columns = {name: np.zeros(size) for name in ['Shares', 'Cost', 'Dividends', 'TotalDividends', 'TBuy', 'TSell', 'RelGain', 'AvgCost', 'StartCost']}
+    closed = np.zeros(size, dtype=bool)
+
+    shares, cost, avg_cost = state['shares'], state['cost'], state['avg_cost']
+    total_dividends, realized_gain = state['total_dividends'], state['realized_gain']
+    total_spend, total_redeem = state['total_spend'], state['total_redeem']
+    for n in range(size):
+        start_cost = cost
+        start_shares = shares
+
+        # Step 1,  Update shares based on trades,  sales are measured against the average cost going into the month
+        shares += monthly['quantity'][n]
+        total_spend += monthly['spend'][n]
+        total_redeem += monthly['redeem'][n]
+        cost += monthly['spend'][n] - monthly['redeem'][n]
+        if avg_cost != 0:
+            realized_gain += monthly['redeem'][n] - monthly['sold_qty'][n] * avg_cost
+        else:
+            realized_gain += monthly['redeem'][n] - monthly['sold_at_price'][n]
+
+        # Step 2, Dividends for non-managed, Step 3 reinvested dividends for managed
+        dividend = 0.0
+        if not managed:
+            dividend = monthly['dividends'][n]
+            total_dividends += dividend
+            realized_gain += dividend
+        else:
+            shares += monthly['rediv_qty'][n]
+            total_spend += monthly['rediv_value'][n]
+            realized_gain += monthly['rediv_value'][n]
+            cost += monthly['rediv_value'][n]
+
+        if shares < 1 and start_shares != 0:  # Do this once, less than 1 because floats sometimes give crazy .000000001 values for 0
+            closed[n] = True
+            shares = dividend = cost = 0
+
+        avg_cost = total_spend / shares if shares else 0  # Update average cost
+        columns['Shares'][n], columns['Cost'][n], columns['Dividends'][n], columns['TotalDividends'][n] = shares, cost, dividend, total_dividends
+        columns['TBuy'][n], columns['TSell'][n], columns['RelGain'][n], columns['AvgCost'][n] = total_spend, total_redeem, realized_gain, avg_cost
+        columns['StartCost'][n] = start_cost
+
+    start_cost = columns.pop('StartCost')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = np.where(closed, 0, monthly['price'] * columns['Shares'] * monthly['factor'])
+        unrealized_gain = np.where(closed, columns['TSell'] - columns['TBuy'],
+                                   np.where(value != 0, value - columns['TBuy'] + columns['TSell'], 0))
+        base = np.where(closed, start_cost, columns['Cost'])  # Once sold out,  the percentages are against the cost going in
+        relgp = np.where(closed, (base - columns['RelGain']) * 100 / base, 100 - (base - columns['RelGain']) * 100 / base)
+        columns['RelGainPct'] = np.where(base != 0, relgp, 0)
+        columns['UnRelGainPct'] = np.where((base != 0) & (closed | (unrealized_gain != 0)), unrealized_gain * 100 / base, 0)
+    columns['Price'] = np.asarray(monthly['price'], dtype=float)
+    columns['Value'] = value
+    columns['UnRelGain'] = unrealized_gain
+
+    state.update({'shares': shares, 'cost': cost, 'total_dividends': total_dividends, 'realized_gain': realized_gain,
+                  'total_spend': total_spend, 'total_redeem': total_redeem, 'avg_cost': avg_cost})
+    return columns, state
+
+
+def remove_duplicates() -> Dict[str, int]:
+    """
+    Delete the duplicate EquityValue,  FundValue and dividend EquityEvent rows for every equity,  one pass per table.
+    For each equity/date the row with the best (lowest) source is kept,  then the latest real_date,  then the oldest row.
+    Returns the number of rows deleted per model
+    """
+    removed = {}
+    for model, query in ((EquityValue, EquityValue.objects.all()), (FundValue, FundValue.objects.all()),
+                         (EquityEvent, EquityEvent.objects.filter(event_type='Dividend'))):
+        duplicated = {row['equity'] for row in query.order_by().values('equity', 'date').annotate(date_count=Count('id')).filter(date_count__gt=1)}
+        removed[model.__name__] = 0
+        if not duplicated:
+            continue
+        columns = ['id', 'equity_id', 'date', 'source', 'real_date']
+        rows = pd.DataFrame.from_records(query.filter(equity_id__in=duplicated).values(*columns), columns=columns)
+        rows['real_date'] = pd.to_datetime(rows['real_date'])
+        rows = rows.sort_values(['source', 'real_date', 'id'], ascending=[True, False, True], na_position='last')
+        extra = rows.loc[rows.duplicated(['equity_id', 'date']), 'id'].tolist()
+        for start in range(0, len(extra), 500):
+            model.objects.filter(id__in=extra[start:start + 500]).delete()
+        removed[model.__name__] = len(extra)
+        logger.info('Removed %s duplicate %s rows from %s equities' % (len(extra), model.__name__, len(duplicated)))
+    return removed
 
 
 class ExchangeRate(models.Model):
@@ -200,40 +302,83 @@ class ExchangeRate(models.Model):
     can_to_us: float = models.FloatField()
     source: int = models.PositiveIntegerField(choices=DataSource.choices(), default=DataSource.ESTIMATE.value)
 
-    # Class variables - a simple cache
-    US_TO_CAN: Dict[datetime.date, float] = {}
-    CAN_TO_US: Dict[datetime.date, float] = {}
+    # Class variables - the rate table,  see rate_table
+    RATES: Union[np.ndarray, None] = None  # One row per month ordinal (from RATES_START),  columns are us_to_can, can_to_us
+    RATES_START: int = 0
+    RATES_VERSION = None
+    RATES_CHECKED: float = 0
+    RATES_CHECK = 60  # Seconds between checks of the shared version stamp
 
     def __str__(self):  # pragma: no cover
         return f'{self.date}({DataSource(self.source).name}) US:{self.us_to_can} CAN:{self.can_to_us}'
 
+    @classmethod
+    def rate_table(cls) -> np.ndarray:
+        """
+        Loaded once per process,  reloaded when the shared version stamp changes (checked every RATES_CHECK seconds)
+        Months we do not have a rate for are 1
+        """
+        now = monotonic()
+        if cls.RATES is not None and now - cls.RATES_CHECKED > cls.RATES_CHECK:
+            cls.RATES_CHECKED = now
+            if get_cache_version('ioom_exchange') != cls.RATES_VERSION:
+                cls._reset()
+        if cls.RATES is None:
+            cls.RATES_VERSION = get_cache_version('ioom_exchange')
+            cls.RATES_CHECKED = now
+            rates = pd.DataFrame(list(ExchangeRate.objects.all().values_list('date', 'us_to_can', 'can_to_us')), columns=['date', 'us_to_can', 'can_to_us'])
+            if rates.empty:
+                cls.RATES = np.ones((0, 2))
+            else:
+                ordinals = month_ordinal(rates['date'])
+                cls.RATES_START = ordinals.min()
+                cls.RATES = np.ones((ordinals.max() - cls.RATES_START + 1, 2))
+                cls.RATES[ordinals - cls.RATES_START] = rates[['us_to_can', 'can_to_us']].to_numpy(dtype=float)
+        return cls.RATES
+
+    @classmethod
+    def rates(cls, dates, column: int) -> np.ndarray:
+        table = cls.rate_table()
+        position = month_ordinal(dates) - cls.RATES_START
+        valid = (position >= 0) & (position < len(table))
+        return np.where(valid, table[np.where(valid, position, 0), column] if len(table) else 1, 1)
+
+    @classmethod
+    def factors(cls, dates, from_currency: str, to_currency: str) -> np.ndarray:
+        """
+        The factor to convert from_currency into to_currency on each of dates (a date or any date like array)
+        """
+        if not from_currency or not to_currency or from_currency == to_currency:
+            return np.ones(len(month_ordinal(dates)))
+        if from_currency == 'USD':
+            return cls.rates(dates, 0)
+        elif from_currency == 'CAD':
+            return cls.rates(dates, 1)
+        raise Exception(f'Unexpected input_currency {from_currency}')
+
+    @classmethod
+    def convert(cls, values, dates, from_currency: str, to_currency: str) -> np.ndarray:
+        """
+        Vectorized - values (one per date) in from_currency converted into to_currency
+        """
+        return np.asarray(values, dtype=float) * cls.factors(dates, from_currency, to_currency)
+
     @classmethod
     def us_to_can_rate(cls, target_date) -> float:
-        if len(cls.US_TO_CAN) == 0:
-            logger.debug('Fetching exchange rates for us_to_can')
-            cls.US_TO_CAN = dict(ExchangeRate.objects.all().values_list('date', 'us_to_can'))
-        try:
-            return cls.US_TO_CAN[target_date]
-        except KeyError:
-            cls.US_TO_CAN[target_date] = 1
-            return 1
+        return float(cls.rates(target_date, 0)[0])
 
     @classmethod
     def can_to_us_rate(cls, target_date) -> float:
-        if len(cls.CAN_TO_US) == 0:
-            logger.debug('Fetching exchange rates for us_to_can')
-            cls.CAN_TO_US = dict(ExchangeRate.objects.all().values_list('date', 'can_to_us'))
-        try:
-            return cls.CAN_TO_US[target_date]
-        except KeyError:
-            # logger.debug('CAN_TO_US - KeyError on date:%s' % target_date)
-            cls.CAN_TO_US[target_date] = 1
-            return 1
+        return float(cls.rates(target_date, 1)[0])
 
     @classmethod
     def _reset(cls):
-        cls.CAN_TO_US = {}
-        cls.US_TO_CAN = {}
+        cls.RATES = None
+        cls.RATES_VERSION = None
+
+    def save(self, *args, **kwargs):
+        super(ExchangeRate, self).save(*args, **kwargs)
+        ExchangeRate._reset()
 
     @classmethod
     def create_or_update(cls, **kwargs):
@@ -267,32 +412,57 @@ class ExchangeRate(models.Model):
             cls.objects.create(**kwargs)
 
     @classmethod
-    def update(cls):
+    def since(cls, force: bool = False) -> date:
         """
-        Update Exchange Rates,   since this is daily,  I will take the first rate of the month as the normalized
-        value for the last month
+        The first month the next update asks BOC for,  BOC_OVERLAP months before the last one we have from the API
         """
-        first_str = EPOCH.strftime('%Y-%m-%d')
-        result = API.get('BOC', f'FXUSDCAD,FXCADUSD/json?start_date={first_str}&order_dir=desc')
-
-        if not result.status_code == 200:  # pragma: no cover
-            logger.error('BOC: failure: %s - %s' % (result.status_code, result.reason))
-            return
-
-        data = result.json()
-        months = {}
-
-        for record in range(len(data['observations'])):
-            this_date = datetime.strptime(data['observations'][record]['d'], '%Y-%m-%d').date()
-            record_date = datetime(this_date.year, this_date.month, 1).date()
-            if record_date not in months:  # This will be the last day of the month so use it.
-                can_rate = data['observations'][record]['FXCADUSD']['v']
-                us_rate = data['observations'][record]['FXUSDCAD']['v']
-                ExchangeRate.create_or_update(date=record_date, can_to_us=can_rate, us_to_can=us_rate,
-                                              source=DataSource.API.value)
-                months[record_date] = this_date
+        latest = cls.objects.filter(source=DataSource.API.value).aggregate(Max('date'))['date__max']
+        return EPOCH if force or not latest else latest - relativedelta(months=BOC_OVERLAP)
 
-        ExchangeRate._reset()  # Clear any cached values
+    @classmethod
+    def update(cls, force: bool = False) -> int:
+        """
+        Update Exchange Rates,   since this is daily,  I will take the first rate of the month as the normalized
+        value for the last month.   Only the months from since() are fetched (all of them with force),  new and
+        changed months are written in bulk.   Returns the number of rows written
+        """
+        first_str = cls.since(force).strftime('%Y-%m-%d')
+
+        def load(since):
+            loaded: Dict[date, Tuple[float, float]] = {}
+            start_str = since.strftime('%Y-%m-%d') if since else first_str
+            result = API.get('BOC', f'FXUSDCAD,FXCADUSD/json?start_date={start_str}&order_dir=desc')
+            if not result.status_code == 200:  # pragma: no cover
+                logger.error('BOC: failure: %s - %s' % (result.status_code, result.reason))
+                return loaded
+            for observation in result.json()['observations']:
+                record_date = normalize_date(datetime.strptime(observation['d'], '%Y-%m-%d').date())
+                if record_date not in loaded:  # This will be the last day of the month so use it.
+                    loaded[record_date] = (float(observation['FXCADUSD']['v']), float(observation['FXUSDCAD']['v']))
+            return loaded
+
+        months = cached_series('boc', {'series': 'FXUSDCAD,FXCADUSD', 'start_date': first_str}, load, refresh=force)
+
+        created = []
+        updated = []
+        existing = {rate.date: rate for rate in cls.objects.filter(date__in=months)}
+        for record_date, (can_rate, us_rate) in months.items():
+            rate = existing.get(record_date)
+            if not rate:
+                created.append(cls(date=record_date, can_to_us=can_rate, us_to_can=us_rate, source=DataSource.API.value))
+            elif rate.source > DataSource.API.value or rate.can_to_us != can_rate or rate.us_to_can != us_rate:
+                rate.source = min(rate.source, DataSource.API.value)
+                rate.can_to_us = can_rate
+                rate.us_to_can = us_rate
+                updated.append(rate)
+        if created or updated:
+            with atomic():
+                cls.objects.bulk_create(created)
+                cls.objects.bulk_update(updated, ['source', 'can_to_us', 'us_to_can'])
+            bump_cache_version('ioom_exchange')  # Every process reloads its rate table
+            ExchangeRate._reset()
+        logger.debug('Exchange rates from %s: %s created,  %s updated' % (first_str, len(created), len(updated)))
+        return len(created) + len(updated)
 
 
 class Inflation(models.Model):
@@ -305,6 +475,13 @@ class Inflation(models.Model):
     inflation = models.FloatField()
     source: int = models.PositiveIntegerField(choices=DataSource.choices(), default=DataSource.ESTIMATE.value)
 
+    # Class variables - the CPI index,  see cpi_index
+    CPI: Union[np.ndarray, None] = None
+    CPI_START: int = 0
+    CPI_VERSION = None
+    CPI_CHECKED: float = 0
+    CPI_CHECK = 60  # Seconds between checks of the shared version stamp
+
     def __str__(self):
         return f'{self.date}({DataSource(self.source).name}) {self.inflation}'
 
@@ -329,50 +506,143 @@ class Inflation(models.Model):
         return obj, created
 
     @classmethod
-    def update(cls, force: bool = False):
+    def since(cls, force: bool = False) -> date:
+        """
+        The first month the next update asks BOC for,  BOC_OVERLAP months before the last one we have from the API
+        """
+        latest = cls.objects.filter(source=DataSource.API.value).aggregate(Max('date'))['date__max']
+        return EPOCH if force or not latest else latest - relativedelta(months=BOC_OVERLAP)
+
+    @classmethod
+    def update(cls, force: bool = False) -> int:
         """
         Update Inflation values
         Since the current month is not in the value we need to add it at the end
+        Only the months from since() are fetched (all of them with force),  new and changed months are written in bulk.
+        Returns the number of rows written
         """
-        first = EPOCH
+        first = cls.since(force)
         first_str = first.strftime('%Y-%m-%d')
 
-        result = API.get('BOC', f'STATIC_INFLATIONCALC/json?start_date={first_str}')
-        if not result.status_code == 200:
-            logger.error('BOC failure: %s - %s' % (result.status_code, result.reason))
-        else:
-            # Pass 1 - Get all the inflation CPI values
-            data = result.json()
-            this_inflation = 0
-            last_cost = None
-            for record in range(len(data['observations'])):
-                this_date = datetime.strptime(data['observations'][record]['d'], '%Y-%m-%d').date()
-                this_cost = float(data['observations'][record]['STATIC_INFLATIONCALC']['v'])
-                if last_cost:
-                    this_inflation = ((this_cost - last_cost) * 100) / last_cost
-
-                Inflation.get_or_create(date=this_date, cost=this_cost, inflation=this_inflation, source=DataSource.API.value)
-                last_cost = this_cost
-
-            Inflation.get_or_create(date=normalize_today(), cost=this_cost, inflation=0, source=DataSource.ESTIMATE.value)
-            clear_simple_cache('ioom_inflation')
+        def load(since):
+            start_str = since.strftime('%Y-%m-%d') if since else first_str
+            result = API.get('BOC', f'STATIC_INFLATIONCALC/json?start_date={start_str}')
+            if not result.status_code == 200:
+                logger.error('BOC failure: %s - %s' % (result.status_code, result.reason))
+                return {}
+            return {datetime.strptime(observation['d'], '%Y-%m-%d').date(): float(observation['STATIC_INFLATIONCALC']['v'])
+                    for observation in result.json()['observations']}
+
+        # Pass 1 - Get all the inflation CPI values,  the month before first is the base for the first change
+        costs = cached_series('boc', {'series': 'STATIC_INFLATIONCALC', 'start_date': first_str}, load, refresh=force)
+        if not costs:
+            return 0
+        previous = cls.objects.filter(date__lt=first, source=DataSource.API.value).order_by('-date').first()
+        last_cost = previous.cost if previous else None
+        this_cost = last_cost
+        months: Dict[date, Tuple[float, float]] = {}
+        for this_date in sorted(costs):
+            this_cost = costs[this_date]
+            months[this_date] = (this_cost, ((this_cost - last_cost) * 100) / last_cost if last_cost else 0)
+            last_cost = this_cost
+
+        # Pass 2 - Write what is new or changed
+        created = []
+        updated = []
+        existing = {inflation.date: inflation for inflation in cls.objects.filter(date__in=list(months) + [normalize_today()])}
+        for this_date, (cost, inflation) in months.items():
+            record = existing.get(this_date)
+            if not record:
+                created.append(cls(date=this_date, cost=cost, inflation=inflation, source=DataSource.API.value))
+            elif record.source > DataSource.API.value or (record.source == DataSource.API.value and (record.cost != cost or record.inflation != inflation)):
+                record.source = DataSource.API.value
+                record.cost = cost
+                record.inflation = inflation
+                updated.append(record)
+        if this_cost is not None and normalize_today() not in months and normalize_today() not in existing:
+            created.append(cls(date=normalize_today(), cost=this_cost, inflation=0, source=DataSource.ESTIMATE.value))
+
+        if created or updated:
+            with atomic():
+                cls.objects.bulk_create(created)
+                cls.objects.bulk_update(updated, ['source', 'cost', 'inflation'])
+            bump_cache_version('ioom_inflation')  # Every process reloads its inflation index
+            Inflation._reset()
+        logger.debug('Inflation from %s: %s created,  %s updated' % (first_str, len(created), len(updated)))
+        return len(created) + len(updated)
+
+    @classmethod
+    def cpi_index(cls) -> np.ndarray:
+        """
+        The CPI cost for every month (by month ordinal starting at CPI_START),  0 where we have no value.
+        Loaded once per process,  reloaded when the shared version stamp changes (checked every CPI_CHECK seconds)
+        """
+        now = monotonic()
+        if cls.CPI is not None and now - cls.CPI_CHECKED > cls.CPI_CHECK:
+            cls.CPI_CHECKED = now
+            if get_cache_version('ioom_inflation') != cls.CPI_VERSION:
+                cls._reset()
+        if cls.CPI is None:
+            cls.CPI_VERSION = get_cache_version('ioom_inflation')
+            cls.CPI_CHECKED = now
+            costs = pd.DataFrame(list(Inflation.objects.all().values_list('date', 'cost')), columns=['date', 'cost'])
+            if costs.empty:
+                cls.CPI = np.zeros(0)
+            else:
+                ordinals = month_ordinal(costs['date'])
+                cls.CPI_START = ordinals.min()
+                cls.CPI = np.zeros(ordinals.max() - cls.CPI_START + 1)
+                cls.CPI[ordinals - cls.CPI_START] = costs['cost'].to_numpy(dtype=float)
+        return cls.CPI
+
+    @classmethod
+    def costs(cls, months) -> np.ndarray:
+        """
+        The CPI cost for each of months (0 when we do not have it)
+        """
+        index = cls.cpi_index()
+        position = month_ordinal(months) - cls.CPI_START
+        valid = (position >= 0) & (position < len(index))
+        return np.where(valid, index[np.where(valid, position, 0)] if len(index) else 0, 0)
+
+    @classmethod
+    def inflate(cls, values, from_months, to_months) -> np.ndarray:
+        """
+        Vectorized - inflate each value from from_months to to_months,  values are unchanged if either CPI is unknown.
+        from_months / to_months may be a single date or one per value
+        """
+        values, to_value, from_value = np.broadcast_arrays(np.asarray(values, dtype=float), cls.costs(to_months), cls.costs(from_months))
+        valid = (to_value != 0) & (from_value != 0)
+        return np.where(valid, values + values * (to_value - from_value) / np.where(valid, from_value, 1), values)
 
     @classmethod
     def inflated(cls, value: float, from_date: date, to_date: date) -> float:
         """
         calculate the cost based on inflation of value,  between date and date,
         """
-        all_values = get_simple_cache('ioom_inflation')
-        if all_values == None:
-            all_values = dict(Inflation.objects.all().values_list('date', 'cost'))
-            set_simple_cache('ioom_inflation', all_values)
+        return float(cls.inflate(value, from_date, to_date)[0]) if value else value
 
-        to_value = all_values[to_date] if to_date in all_values else 0
-        from_value = all_values[from_date] if from_date in all_values else 0
-        if to_value == 0 or from_value == 0:
-            return value
-        result = value + value * (to_value - from_value) / from_value
-        return result
+    @classmethod
+    def monthly_ratios(cls, months: pd.DatetimeIndex) -> np.ndarray:
+        """
+        For each month,  the factor that inflates last months value to this month (1 when we do not have the CPI)
+        The first month is always 1
+        """
+        cost = cls.costs(months).astype(float)
+        previous = np.roll(cost, 1)
+        if len(previous):
+            previous[0] = 0
+        valid = (cost != 0) & (previous != 0)
+        return np.where(valid, cost / np.where(valid, previous, 1), 1)
+
+    @classmethod
+    def _reset(cls):
+        cls.CPI = None
+        cls.CPI_VERSION = None
+
+    def save(self, *args, **kwargs):
+        super(Inflation, self).save(*args, **kwargs)
+        Inflation._reset()
 
 
 class Equity(models.Model):
@@ -516,47 +786,46 @@ class Equity(models.Model):
         self.validated = True
 
     def fill_holes(self):
+        """
+        Estimate the months without a real (non ESTIMATE) record.   Months between two real records are linearly
+        interpolated,  months after the last one carry its value forward to today (or the deactivated date).
+        Only the ESTIMATE rows that are missing or have changed are written,  in bulk.
+        """
         model = EquityValue
         data = 'price'
         if self.equity_type in ('Value', 'Cash'):
             model = FundValue
             data = 'value'
-        try:
-            first_record = model.objects.filter(equity=self).earliest('date')
-        except model.DoesNotExist:
+
+        records = pd.DataFrame.from_records(model.objects.filter(equity=self).values('id', 'date', data, 'source'), columns=['id', 'date', data, 'source'])
+        if records.empty:
             logger.error('Can not fill holes on %s - No records found' % self)
             return
-        start_date = first_record.date
         end_date = self.deactivated_date if self.deactivated_date else normalize_today()
-        break_date = model.objects.filter(equity=self).latest('date').date
-
-        all_records: Dict[date, float] = dict(model.objects.filter(equity=self).values_list('date', data))
-        valid_records: Dict[date, float] = dict(model.objects.filter(equity=self).exclude(source=DataSource.ESTIMATE.value).values_list('date', data))
-
-        # value = first_record.price if model == EquityValue else first_record.value
-        next_date = start_date
-        last_date = None
-        value = 0  # To stop the warnings
-        while next_date <= end_date and next_date <= break_date:
-            if next_date in valid_records:
-                if last_date:  # Valid record month step
-                    months = ((next_date.year - last_date.year) * 12 + next_date.month - last_date.month)  # How many months
-                    change_increment = (valid_records[next_date] - value) / months
-                    est_month = last_date + relativedelta(months=1)
-                    est_value = value + change_increment
-                    while est_month < next_date:
-                        if est_month not in all_records or all_records[est_month] != est_value:
-                            model.get_or_create(equity=self, date=est_month, amount=est_value, source=DataSource.ESTIMATE.value)
-                        est_month = est_month + relativedelta(months=1)
-                        est_value += change_increment
-                value = valid_records[next_date]
-                last_date = next_date
-            next_date = next_date + relativedelta(months=1)
-
-        while last_date <= end_date:
-            if last_date not in all_records or all_records[last_date] != value:
-                model.get_or_create(equity=self, date=last_date, amount=value, source=DataSource.ESTIMATE.value)
-            last_date = last_date + relativedelta(months=1)
+        records['date'] = pd.to_datetime(records['date'])
+        records = records.set_index('date')
+
+        valid = records.loc[(records['source'] != DataSource.ESTIMATE.value) & (records.index <= pd.Timestamp(end_date)), data].dropna()
+        if valid.empty:
+            logger.error('Can not fill holes on %s - Only estimated records found' % self)
+            return
+
+        months = month_range(valid.index.min().date(), end_date)
+        estimates = valid.reindex(months).interpolate(limit_area='inside').ffill()
+        estimates = estimates.loc[~estimates.index.isin(valid.index)]
+
+        existing = records.reindex(estimates.index)
+        missing = existing['id'].isna()
+        changed = ~missing & (existing['source'] == DataSource.ESTIMATE.value) & ~np.isclose(existing[data], estimates)
+
+        new_records = [model(equity=self, date=month.date(), real_date=month.date(), source=DataSource.ESTIMATE.value, **{data: value})
+                       for month, value in estimates.loc[missing].items()]
+        changed_records = [model(id=int(record_id), **{data: value}) for record_id, value in zip(existing.loc[changed, 'id'], estimates.loc[changed])]
+        if new_records or changed_records:
+            with atomic():
+                model.objects.bulk_create(new_records, batch_size=500)
+                model.objects.bulk_update(changed_records, [data], batch_size=500)
+            logger.debug('%s: %s estimates created,  %s updated' % (self, len(new_records), len(changed_records)))
 
     def get_dividend_dates(self) -> dict[date: date]:
         if API.status('ypfinance'):
@@ -566,73 +835,89 @@ class Equity(models.Model):
                     return {normalize_date(dt.date()): dt.date() for dt in series.to_dict().keys()}
         return {}
 
-    def yp_update(self, period='1y') -> Dict[date, List]:
+    def yp_update(self, period='1y', pause=None, force: bool = False) -> Dict[date, List]:
         """
         Build a dictionary key on Date with two values [close price,  dividends per share]
         kwargs
             period: str default = "1y",   How many months of data to retrieve
+            force: bool default = False,   reload it even if the response cache has it
+            pause: callable(name, reason) default API.pause,  called when Yahoo rate limits us
         """
+        pause = pause if pause else API.pause
         result ={}
         if API.status('ypfinance'):  # Currently set manually in admin tool
             if self.equity_type == 'Equity':
-                try:
-                    df = yf.Ticker(self.key).history(interval='1mo', period=period, auto_adjust=False)
-                except yf.exceptions.YFRateLimitError:
-                    logger.error('YF rate limit error')
-                    API.pause('ypfinance', 'Rate Limit Exceeded')
-                    return result
-                if isinstance(df, pd.DataFrame) and not df.empty:
-                    data = df[['Close', 'Dividends']].to_records()
-                    if len(data):
-                        for record in data:
-                            if len(record) == 3:
-                                result[record[0].date()] = (float(record[1]), float(record[2]))
+                def load(since):
+                    loaded = {}
+                    try:
+                        df = yf.Ticker(self.key).history(interval='1mo', period='1mo' if since else period, auto_adjust=False)
+                    except yf.exceptions.YFRateLimitError:
+                        logger.error('YF rate limit error')
+                        pause('ypfinance', 'Rate Limit Exceeded')
+                        return loaded
+                    if isinstance(df, pd.DataFrame) and not df.empty:
+                        data = df[['Close', 'Dividends']].to_records()
+                        if len(data):
+                            for record in data:
+                                if len(record) == 3:
+                                    loaded[record[0].date()] = (float(record[1]), float(record[2]))
+                    return loaded
+
+                result = cached_series('ypfinance', {'symbol': self.key, 'period': period}, load, refresh=force)
         else:
             logger.info('ypfinance API is down:%s' % API.status('ypfinance'))
         return result
 
-    def av_update(self, key: str, force:bool = False) -> Dict[date, List]:
+    def av_update(self, key: str, force:bool = False, pause=None) -> Dict[date, List]:
         """
         Build a dictionary key on Date with two values [close price,  dividends per share]
         args:
             0 - api key, used for alphavantage
         kwargs
             force: bool default = False,   setting to True will force an update even if this equity was already updated today
+                                           (or the response cache has it)
+            pause: callable(name, reason) default API.pause,  called when we are out of Alphavantage calls
 
         """
+        pause = pause if pause else API.pause
         results = {}
         if key and self.equity_type == 'Equity' and self.searchable:
             now = datetime.now().date()
-            if now == self.last_updated.date() and not force:
+            if self.last_updated and now == self.last_updated.date() and not force:
                 logger.info('%s - Already updated %s' % (self, now))
                 return results
             else:
-                data_key = 'Monthly Adjusted Time Series'
-                result = API.get('AVURL', f'TIME_SERIES_MONTHLY_ADJUSTED&symbol={self.key}&apikey={key}')
-                if not result.status_code == 200:
-                    logger.warning('AVURL Result is %s - %s' % (result.status_code, result.reason))
-                    return results
-                data = result.json()
-                if data_key in data:  # if not,  we timed out our API key
-                    for entry in data[data_key]:
-                        try:
-                            date_value = datetime.strptime(entry, '%Y-%m-%d').date()
-                        except ValueError:
-                            logger.error('Invalid date format in: %s' % entry)
-                            return results
-                        if date_value >= EPOCH:
-                            price = float(data[data_key][entry]['4. close'])
-                            dividend = float(data[data_key][entry]['7. dividend amount'])
-                            results[date_value] = (price, dividend)
-                else:
-                    if 'Information' in data and data['Information'].startswith('Thank you for using'):
-                        logger.warning("Too many calls to AVURL")
-                        API.pause("AVURL")
+                def load(since):  # Alphavantage only has the whole series
+                    loaded = {}
+                    data_key = 'Monthly Adjusted Time Series'
+                    result = API.get('AVURL', f'TIME_SERIES_MONTHLY_ADJUSTED&symbol={self.key}&apikey={key}')
+                    if not result.status_code == 200:
+                        logger.warning('AVURL Result is %s - %s' % (result.status_code, result.reason))
+                        return loaded
+                    data = result.json()
+                    if data_key in data:  # if not,  we timed out our API key
+                        for entry in data[data_key]:
+                            try:
+                                date_value = datetime.strptime(entry, '%Y-%m-%d').date()
+                            except ValueError:
+                                logger.error('Invalid date format in: %s' % entry)
+                                return loaded
+                            if date_value >= EPOCH:
+                                price = float(data[data_key][entry]['4. close'])
+                                dividend = float(data[data_key][entry]['7. dividend amount'])
+                                loaded[date_value] = (price, dividend)
                     else:
-                        logger.warning('Invalid Response: %s' % data)
+                        if 'Information' in data and data['Information'].startswith('Thank you for using'):
+                            logger.warning("Too many calls to AVURL")
+                            pause('AVURL', 'Too many calls')
+                        else:
+                            logger.warning('Invalid Response: %s' % data)
+                    return loaded
+
+                results = cached_series('alphavantage', {'symbol': self.key}, load, refresh=force)
         return results
 
-    def update_external_equity_data(self, force: bool = False, key: str = None, daily: bool = False):
+    def update_external_equity_data(self, force: bool = False, key: str = None, daily: bool = False, fetched: Tuple = None):
         """
         Go to either Yahoo Finance or www.alphavantage to update equity and dividend data.
 
@@ -641,6 +926,7 @@ class Equity(models.Model):
                                          When True will also use alphavantage data even if we already update today.
            key:  str default None, The API key for alphavantage if it is not provided then we will never try alphavantage
            daily:  boolean default False,  When True will set the last update value (used to limit alphavantage API calls)
+           fetched: tuple default None,  The result of fetch_external_equity_data if that was already done
 
         side effect:
             All records (EquityValue and EquityEvent (Dividend) records not source by an API or lower, are deleted
@@ -653,46 +939,94 @@ class Equity(models.Model):
             logger.debug('Safety Valve: Can not update non "Equity" equities or not searchable values')
             return
 
-        if force:
-            period = '20y'
-        else:
-            period = '1y'
+        results_api, results, dividend_dates = fetched if fetched else self.fetch_external_equity_data(force=force, key=key)
+        return self.apply_external_equity_data(results_api, results, dividend_dates, daily=daily)
+
+    def fetch_external_equity_data(self, force: bool = False, key: str = None, throttle=None, pause=None) -> Tuple[int, Dict[date, Tuple], Dict[date, date]]:
+        """
+        The network half of update_external_equity_data.   A worker thread passes pause so it makes no database writes,
+        the provider pauses are applied by the caller (stocks.refresh).
+        Returns (api used,  {date: (price, dividend)},  {date: dividend date})
+
+        kwargs:
+           throttle: callable(api) called before each provider call,  returning False skips that provider
+           pause: callable(name, reason) default API.pause,  called when a provider asks us to back off
+        """
+        throttle = throttle if throttle else lambda api: True
+        period = '20y' if force else '1y'
 
         results_api = self.ypfinance
-        results = self.yp_update(period=period)
-        if not results and key:
+        results = self.yp_update(period=period, pause=pause, force=force) if throttle(self.ypfinance) else {}
+        if not results and key and throttle(self.alphavantage):
             results_api = self.alphavantage
-            results = self.av_update(key, force=force)
-
-        if results:
-            existing_price = {e['date']: e for e in EquityValue.objects.filter(equity=self).values('date', 'price', 'api', 'split_fixed')}
-            existing_dividends = {e['date']: e for e in EquityEvent.objects.filter(equity=self, event_type='Dividend').values('date', 'real_date', 'value', 'api', 'split_fixed')}
-            dividend_dates = self.get_dividend_dates()
-            for result_key in results:
-                if result_key in existing_price:
-                    #  has not been 'fixed' and used api is better or equal to existing api AND existing price != new API price
-                    if not existing_price[result_key]['split_fixed'] and results_api <= existing_price[result_key]['api'] and results[result_key][0] != existing_price[result_key]['price']:
-                        EquityValue.objects.filter(date=result_key, equity=self).update(price=results[result_key][0], api=results_api, source=DataSource.API.value)
-                else:
-                    EquityValue.objects.create(date=result_key, equity=self, real_date=result_key,
-                                               source=DataSource.API.value, api=results_api, price=results[result_key][0])
-
-                if result_key in existing_dividends:
-                    real_date = dividend_dates[result_key] if result_key in dividend_dates else existing_dividends[result_key]['real_date']  # If our search for a real_date worked,  use it else keep the same
-                    if not existing_dividends[result_key]['split_fixed'] and results_api <= existing_dividends[result_key]['api'] and results[result_key][1] != existing_dividends[result_key]['value']:
-                        EquityEvent.objects.filter(date=result_key, equity=self, event_type='Dividend').update(value=results[result_key][1], real_date=real_date, api=results_api)
-                    elif real_date != existing_dividends[result_key]['real_date']:
-                        EquityEvent.objects.filter(date=result_key, equity=self, event_type='Dividend').update(real_date=real_date)
-                else:  # This is a new record
-                    if results[result_key][1] != 0:  # if we got a useful dividend - aka not 0
-                        real_date = dividend_dates[result_key] if result_key in dividend_dates else result_key  # If our search for a real_date worked, use it else use the normalized date
-                        EquityEvent.objects.create(date=result_key, equity=self, event_type='Dividend', api=results_api,
-                                                   real_date=real_date, source=DataSource.API.value, value=results[result_key][1])
+            results = self.av_update(key, force=force, pause=pause)
+        dividend_dates = self.get_dividend_dates() if results and throttle(self.ypfinance) else {}
+        return results_api, results, dividend_dates
+
+    def apply_external_equity_data(self, results_api: int, results: Dict[date, Tuple], dividend_dates: Dict[date, date], daily: bool = False) -> Dict[str, Union[int, date]]:
+        """
+        The database half of update_external_equity_data,  see fetch_external_equity_data for the arguments.
+        The results are diffed against the existing EquityValue and EquityEvent (Dividend) rows in frames,  then written
+        with bulk_create/bulk_update in one transaction.   An existing row is only changed when it has not been split
+        fixed and the results API is as good or better than the one that set it.
+
+        Returns the number of rows inserted,  updated and left unchanged and since,  the first month written (or None)
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'since': None}
+        if not results:
+            return counts
+
+        incoming = pd.DataFrame([(normalize_date(key), key, value[0], value[1]) for key, value in results.items()],
+                                columns=['date', 'real_date', 'price', 'dividend']).drop_duplicates('date', keep='last')
+        incoming['dividend'] = incoming['dividend'].fillna(0)
+        incoming['paid'] = incoming['date'].map(lambda month: dividend_dates.get(month))  # The real dividend date,  if we found it
+
+        prices = pd.DataFrame.from_records(EquityValue.objects.filter(equity=self).values('id', 'date', 'price', 'api', 'split_fixed'),
+                                           columns=['id', 'date', 'price', 'api', 'split_fixed'])
+        prices = incoming.merge(prices.drop_duplicates('date', keep='last'), on='date', how='left', suffixes=('', '_old'))
+        prices = prices.loc[prices['price'].notna()]
+        known = prices['id'].notna()
+        better = known & ~prices['split_fixed'].eq(True) & (results_api <= prices['api']) & (prices['price'] != prices['price_old'])
+        new_prices = [EquityValue(equity=self, date=row.date, real_date=row.real_date, source=DataSource.API.value, api=results_api, price=row.price)
+                      for row in prices.loc[~known].itertuples()]
+        changed_prices = [EquityValue(id=int(row.id), price=row.price, api=results_api, source=DataSource.API.value) for row in prices.loc[better].itertuples()]
+        changed_months = list(prices.loc[better, 'date'])
+
+        events = pd.DataFrame.from_records(EquityEvent.objects.filter(equity=self, event_type='Dividend').values('id', 'date', 'real_date', 'value', 'api', 'split_fixed'),
+                                           columns=['id', 'date', 'real_date', 'value', 'api', 'split_fixed'])
+        events = incoming.merge(events.drop_duplicates('date', keep='last'), on='date', how='left', suffixes=('', '_old'))
+        known = events['id'].notna()
+        found = events['paid'].notna()
+        events['pay_date'] = events['paid'].where(found, events['real_date_old'])  # Keep the one we have
+        better = known & ~events['split_fixed'].eq(True) & (results_api <= events['api']) & (events['dividend'] != events['value'])
+        moved = known & ~better & found & (events['paid'] != events['real_date_old'])
+        events['pay_date'] = events['pay_date'].where(known, events['paid'].where(found, events['real_date']))  # New,  else the month
+        events['better'] = better
+        new_events = [EquityEvent(equity=self, date=normalize_date(row.pay_date), real_date=row.pay_date, event_type='Dividend', api=results_api,
+                                  source=DataSource.API.value, value=row.dividend) for row in events.loc[~known & (events['dividend'] != 0)].itertuples()]
+        changed_events = [EquityEvent(id=int(row.id), value=row.dividend if row.better else row.value, real_date=row.pay_date, api=results_api if row.better else int(row.api))
+                          for row in events.loc[better | moved].itertuples()]
+
+        with atomic():
+            EquityValue.objects.bulk_create(new_prices, batch_size=500)
+            EquityValue.objects.bulk_update(changed_prices, ['price', 'api', 'source'], batch_size=500)
+            EquityEvent.objects.bulk_create(new_events, batch_size=500)
+            EquityEvent.objects.bulk_update(changed_events, ['value', 'real_date', 'api'], batch_size=500)
             if daily:
                 self.last_updated = datetime.now()
                 self.save()
 
-    def update(self, force: bool = False, key: str = None, daily=True):
+        counts['inserted'] = len(new_prices) + len(new_events)
+        counts['updated'] = len(changed_prices) + len(changed_events)
+        counts['unchanged'] = len(prices) + int(known.sum()) - counts['updated'] - len(new_prices)
+        months = [value.date for value in new_prices + new_events] + changed_months + list(events.loc[better | moved, 'date'])
+        counts['since'] = min(months) if months else None
+        if counts['since']:
+            CacheDependencies.invalidate([(self, counts['since'])])  # The holders' frames and snapshots from that month on
+        logger.debug('%s: %s' % (self, counts))
+        return counts
+
+    def update(self, force: bool = False, key: str = None, daily=True, fetched: Tuple = None):
         """
         Update the stocks closing price for the last day of the month (current day of current month)
         Update the dividend paid per share
@@ -702,11 +1036,13 @@ class Equity(models.Model):
                 Force with yfinance will try and take 20 years of data instead of 1 year.
            key: string Default None - the alphavantage API key
            daily: boolean Default True - Update the last update value on the equity
+           fetched: tuple Default None - Provider data already retrieved by fetch_external_equity_data (stocks.refresh)
 
-        The yfinance API is always tried first
+        The yfinance API is always tried first.   Returns the row counts from apply_external_equity_data (if it ran)
 
         """
         logger.debug('Updating %s' % self)
+        counts = None
         # Since this is searchable,  get rid of any data populated by means lesser than an API
 
         if self.equity_type == 'Equity':
@@ -714,16 +1050,14 @@ class Equity(models.Model):
                 self.set_equity_data()
                 self.save()
             if self.searchable:
-                clear_duplicates(EquityEvent, self, event_object=True)
-                clear_duplicates(EquityValue, self)
-                self.update_external_equity_data(force=force, key=key, daily=daily)
+                counts = self.update_external_equity_data(force=force, key=key, daily=daily, fetched=fetched)
         else:  # Cash and Value
-            clear_duplicates(FundValue, self)
             if not FundValue.objects.filter(equity=self).exclude(source=DataSource.ESTIMATE.value).exists():
                 logger.warning('Deleting Cash/Value Equity with only ESTIMATED values')
                 self.delete()
                 return
         self.fill_holes()
+        return counts
 
     def event_dict(self, start_date: datetime.date = None, event: str = None) -> Dict[datetime.date, float]:
         queryset = EquityEvent.objects.filter(equity=self)
@@ -868,6 +1202,39 @@ class EquityValue(models.Model):
             logger.debug('Created %s' % obj)
         return obj, created
 
+    @classmethod
+    def bulk_upsert(cls, values: List[Tuple[Equity, date, float]], source: int) -> List[Tuple[Equity, date]]:
+        """
+        get_or_create for many (equity, real_date, price) at once,  the latest real_date in a month wins.   Existing
+        rows are only replaced by a better source or a more recent date.   Returns the (equity, date) rows changed
+        """
+        latest: Dict[Tuple[int, date], Tuple[Equity, date, float]] = {}
+        for equity, real_date, price in values:
+            if np.isnan(price):
+                continue
+            key = (equity.id, normalize_date(real_date))
+            if key not in latest or latest[key][1] <= real_date:
+                latest[key] = (equity, real_date, price)
+        if not latest:
+            return []
+
+        existing = {(value.equity_id, value.date): value for value in
+                    cls.objects.filter(equity_id__in={key[0] for key in latest}, date__in={key[1] for key in latest})}
+        creates = []
+        updates = []
+        for key, (equity, real_date, price) in latest.items():
+            value = existing.get(key)
+            if not value:
+                creates.append(cls(equity=equity, date=key[1], real_date=real_date, price=price, source=source))
+            elif value.source > source or (value.source == source and (not value.real_date or value.real_date < real_date or
+                                                                      (value.real_date == real_date and value.price != price))):
+                value.price, value.real_date, value.source = price, real_date, source
+                updates.append(value)
+        with atomic():
+            cls.objects.bulk_create(creates, batch_size=500)
+            cls.objects.bulk_update(updates, ['price', 'real_date', 'source'], batch_size=500)
+        return [(value.equity, value.date) for value in creates + updates]
+
     @classmethod
     def lookup_price(cls, equity: Equity, this_date) -> float:
         try:
@@ -1106,13 +1473,20 @@ class BaseContainer(models.Model):
         else:
             return 0
 
+    @staticmethod
+    def cache_keys(class_name: str, pk: int) -> Tuple[str, str]:
+        """
+        The (container, component) cache keys for a container of class_name,  without needing the instance
+        """
+        return f'{class_name}:{pk}:Container', f'{class_name}:{pk}:Components'
+
     @property
     def container_cache_key(self):
-        return f'{self.__class__.__name__}:{self.id}:Container'
+        return self.cache_keys(self.__class__.__name__, self.id)[0]
 
     @property
     def component_cache_key(self):
-        return f'{self.__class__.__name__}:{self.id}:Components'
+        return self.cache_keys(self.__class__.__name__, self.id)[1]
 
     def reset(self):
         raise NotImplementedError
@@ -1363,13 +1737,9 @@ class Portfolio(BaseContainer):
 
     @property
     def p_pd(self) -> DataFrame:
-        new = get_cached_dataframe(self.container_cache_key)
-        try:
-            if not new.empty:
-                return new
-        except AttributeError:
-            pass  # get may return None
+        return get_or_build_dataframe(self.container_cache_key, self.build_p_pd)
 
+    def build_p_pd(self) -> DataFrame:
         alist = []
         new = pd.DataFrame(columns=ACCOUNT_COL)
         for account in self.account_set.all():
@@ -1381,12 +1751,9 @@ class Portfolio(BaseContainer):
 
     @property
     def e_pd(self) -> DataFrame:
-        new = get_cached_dataframe(self.component_cache_key)
-        try:
-            if not new.empty:
-                return new
-        except AttributeError as e:
-            pass   # get may return None
+        return get_or_build_dataframe(self.component_cache_key, self.build_e_pd)
+
+    def build_e_pd(self) -> DataFrame:
         first = True
         new = pd.DataFrame(columns=EQUITY_COL)
         for account in self.account_set.all():
@@ -1397,7 +1764,7 @@ class Portfolio(BaseContainer):
                     first = False
             else:
                 if not df.empty and not df.isna().all().all():
-                    new = pd.concat([new, df], axis=0)
+                    new = pd.concat([new, df], axis=0, ignore_index=True)
                 else:
                     logger.debug('Something fishing with account id %s' % account.id)
             pass
@@ -1587,15 +1954,17 @@ class Account(BaseContainer):
 
     @property
     def e_pd(self) -> DataFrame:
+        if not self.child == self:
+            return self.child.e_pd  # Cached under the child's key
 
-        df = get_cached_dataframe(self.component_cache_key)
-        try:
-            if not df.empty:
-                return df
-        except AttributeError:
-            pass   # get may return None
+        self.pending_refresh()
+        return get_or_build_dataframe(self.component_cache_key, self.build_e_pd)
 
-        df = self.child.equity_df()
+    def build_e_pd(self) -> DataFrame:
+        df = EquitySnapshot.frame(self) if Snapshot.is_current(self) else pd.DataFrame()
+        if df.empty:
+            df = self.child.equity_df()
+            EquitySnapshot.store(self, df)
         cache_dataframe(self.component_cache_key, df)
         return df
 
@@ -1632,6 +2001,29 @@ class Account(BaseContainer):
     def account_df(self) -> pd.DataFrame:
         return pd.DataFrame(columns=ACCOUNT_COL)
 
+    def monthly_totals(self, months: pd.DatetimeIndex) -> DataFrame:
+        """
+        One query,  sum the value of every transaction by normalized month and xa_action.
+        The result is indexed by months with one column per xa_action (0 when nothing happened that month)
+        """
+        actions = [action for action, _ in Transaction.TRANSACTION_TYPE]
+        data = pd.DataFrame(list(self.transactions.filter(date__gte=months[0].date(), date__lte=months[-1].date()).order_by().
+                                 values('date', 'xa_action').annotate(total=Sum('value'))), columns=['date', 'xa_action', 'total'])
+        if data.empty:
+            return pd.DataFrame(0.0, index=months, columns=actions)
+        data['date'] = pd.to_datetime(data['date'])
+        data['total'] = data['total'].astype(float).fillna(0)
+        totals = data.pivot_table(index='date', columns='xa_action', values='total', aggfunc='sum', fill_value=0)
+        return totals.reindex(index=months, columns=actions, fill_value=0).astype(float)
+
+    @staticmethod
+    def fund_values(equity: Equity, months: pd.DatetimeIndex) -> np.ndarray:
+        """
+        One query,  the FundValue for equity on each of months (0 when there is no value recorded)
+        """
+        values = dict(FundValue.objects.filter(equity=equity, date__gte=months[0].date(), date__lte=months[-1].date()).values_list('date', 'value')) if len(months) else {}
+        return pd.Series(values, dtype=float).rename(index=pd.Timestamp).reindex(months, fill_value=0).to_numpy(dtype=float)
+
     def equity_df(self):
         return pd.DataFrame(columns=EQUITY_COL)
 
@@ -1642,18 +2034,21 @@ class Account(BaseContainer):
         calculation is based on Account Type
         :return:
         """
+        if not self.child == self:
+            return self.child.p_pd  # Cached under the child's key
 
-        df = get_cached_dataframe(self.container_cache_key)
-        try:
-            if not df.empty:
-                return df
-        except AttributeError:
-            pass
+        self.pending_refresh()
+        return get_or_build_dataframe(self.container_cache_key, self.build_p_pd)
 
-        df = self.child.account_df
+    def build_p_pd(self) -> DataFrame:
+        df = AccountSnapshot.frame(self) if Snapshot.is_current(self) else pd.DataFrame()
+        if df.empty:
+            df = self.child.account_df
+            if not df.empty:
+                df['Date'] = pd.to_datetime(df['Date'])
+                df['Actual'] = df['Cash'] + df['Value']
+                AccountSnapshot.store(self, df)
         if not df.empty:
-            df['Date'] = pd.to_datetime(df['Date'])
-            df['Actual'] = df['Cash'] + df['Value']
             cache_dataframe(self.container_cache_key, df)
         return df
 
@@ -1662,9 +2057,32 @@ class Account(BaseContainer):
             self.child.reset()
         clear_cached_dataframe(self.container_cache_key)
         clear_cached_dataframe(self.component_cache_key)
+        AccountSnapshot.forget({self.id: None})
+        EquitySnapshot.forget({self.id: None})
         if self.portfolio:
             self.portfolio.reset()
 
+    def refresh(self, dirty_from: date):
+        """
+        Bring the cached frames up to date when only data from the dirty_from month onwards changed,  account types
+        that can not do better do a full reset
+        """
+        if not self.child == self:
+            return self.child.refresh(dirty_from)
+        self.reset()
+
+    def pending_refresh(self):
+        """
+        Apply a dirty mark left by CacheDependencies.invalidate,  the frames are recomputed from the marked month on
+        """
+        dirty_from = get_dirty_month(self.container_cache_key)
+        if dirty_from and acquire_frame_lease(self.container_cache_key):  # Else someone is on it,  use what is cached
+            try:
+                clear_dirty_month(self.container_cache_key)
+                self.refresh(dirty_from)
+            finally:
+                release_frame_lease(self.container_cache_key)
+
     def save(self, *args, **kwargs):
         if not self.account_name:
             self.account_name = self.name
@@ -1795,15 +2213,15 @@ class Account(BaseContainer):
         Ensure that each of my equities is updated
         :return:
         """
+        from stocks.refresh import refresh_equities  # It builds on these models
+
         key = self.user.profile.av_api_key if self.user.profile.av_api_key else None
-        for equity in self.equities:
-            if equity.update(force=False, key=key):
-                sleep(2)  # Any faster and my free API will fail
+        refresh_equities(self.equities, force=False, key=key)  # Rate limited per provider
         self.reset()
 
-    def update_static_values(self):
+    def update_static_values(self, dirty_from: date = None):
         """
-        Ensure that each of my equities is updated
+        Ensure that each of my equities is updated,  with dirty_from only months from then on are recomputed
         :return:
             cost: int = models.IntegerField(null=True, blank=True)  # Total cost of all shares ever purchased
             value: int = models.IntegerField(null=True, blank=True)  # of shares owned as of today
@@ -1813,7 +2231,10 @@ class Account(BaseContainer):
             end: date = models.DateField(null=True, blank=True)
 
         """
-        self.reset()
+        if dirty_from:
+            self.refresh(dirty_from)
+        else:
+            self.reset()
         df = self.p_pd
         self._cost = self.get_pattr('Cost', df=df)
         self._value = self.get_pattr('Value', df=df)
@@ -1838,58 +2259,52 @@ class InvestmentAccount(Account):
 
     @property
     def account_df(self) -> pd.DataFrame:
+        return self.account_frame()
+
+    def account_frame(self, since: date = None, cached: DataFrame = None) -> pd.DataFrame:
+        """
+        Build the account DF in one pass,  transactions are summed by month/xa_action with a single query and the
+        running totals (Funds, Cash, Effective...) are cumulative sums over the month axis.
+        Incremental mode - with since (a normalized month) and the cached account DF,  only rows from since onwards are
+        computed,  the running totals carry forward from the cached row for the month before.
+        """
         df = pd.DataFrame(columns=ACCOUNT_COL)
-        if not self.transactions:  # Account is new/empty
+        first = self.transactions.aggregate(first=Min('date'))['first']
+        if not first:  # Account is new/empty
             return df
         equity_df = self.e_pd
-        if self.e_pd.empty:
-            dividends = {}
+
+        months = month_range(first, self.end if self.end else normalize_today())
+        head = pd.DataFrame(columns=ACCOUNT_COL)
+        carry = {'Funds': 0, 'Redeemed': 0, 'TransIn': 0, 'TransOut': 0, 'Cash': 0, 'Effective': 0}
+        ratios = Inflation.monthly_ratios(months)
+        if since is not None and cached is not None and not cached.empty:
+            head = cached.loc[cached['Date'] < pd.Timestamp(since)].drop(columns=['Actual'], errors='ignore')
+            if not head.empty and head['Date'].iloc[-1] == pd.Timestamp(since) - pd.DateOffset(months=1):
+                carry = head.iloc[-1][list(carry.keys())].to_dict()
+                ratios = ratios[months >= head['Date'].iloc[-1]][1:]
+                months = months[months >= pd.Timestamp(since)]
+            else:  # Nothing usable to carry forward
+                head = pd.DataFrame(columns=ACCOUNT_COL)
+
+        totals = self.monthly_totals(months) if len(months) else pd.DataFrame(0.0, index=months, columns=[action for action, _ in Transaction.TRANSACTION_TYPE])
+        if equity_df.empty:
+            dividends = np.zeros(len(months))
         else:
-            # From chatgpt - most efficient method to build a dictionary of dividends received.
-            dividends_df = equity_df.groupby('Date', as_index=False)['Dividends'].sum()
-            dividends_df['Date'] = dividends_df['Date'].dt.date
-            dividends = dict(zip(dividends_df['Date'], dividends_df['Dividends']))
-
-        this_date = self.transactions.earliest('date').date
-        final_date = normalize_date(self.end) if self.end else normalize_today()
-        xas = self.transactions
-        xa_dates = list(self.transactions.values_list('date', flat=True).distinct())
-        funds = trans_in = withdraw = trans_out = 0  # These are cumulative totals
-        effective = cash = 0  # These are running totals
-        df_list = []
-        last_date = this_date
-        while this_date <= final_date:
-            effective = Inflation.inflated(effective, last_date, this_date)  # Adjust effective cost based on CPI inflation
-            last_date = this_date
-            new_cash = 0
-            if this_date in xa_dates:  # Maybe this should be more explicit since REDEEM on some accounts is monthly
-                new_funds = xas.filter(xa_action=Transaction.FUND, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_cash = xas.filter(xa_action=Transaction.INTEREST, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_trans_in = xas.filter(xa_action=Transaction.TRANS_IN, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_withdraw = xas.filter(xa_action=Transaction.REDEEM, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_trans_out = xas.filter(xa_action=Transaction.TRANS_OUT, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                delta = xas.filter(xa_action__in=[Transaction.BUY, Transaction.SELL], date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-
-                funds += new_funds
-                trans_in += new_trans_in
-                withdraw += new_withdraw
-                trans_out += new_trans_out
-
-                new_cash += new_funds + new_withdraw   # need to negate delta
-                effective += new_cash
-                new_cash += (delta * -1)   # Add in buy/sell changes
-
-            dividend = dividends[this_date] if this_date in dividends else 0
-            new_cash += dividend
-            cash += new_cash
-            # logger.debug('%s:funds:%s trans_in:%s withdraw:%s transout:%s delta:%s new:%s dividends: %s cash:%s' % (this_date, funds, trans_in, withdraw, trans_out, delta, new_cash, dividend, cash))
-            # Clear up floating errors
-            cash = 0 if (0 > cash < 1) else cash  # Fix floating point errors
-            df_list.append({'Date': this_date, 'Funds': funds, 'Redeemed': withdraw, 'TransIn': trans_in, 'TransOut': trans_out, 'NewCash': new_cash, 'Cash': cash, 'Effective': effective})
-            this_date = next_date(this_date)
-
-        df = pd.DataFrame(df_list)
-        df['Date'] = pd.to_datetime(df['Date'])
+            dividends = equity_df.groupby('Date')['Dividends'].sum().reindex(months, fill_value=0).to_numpy(dtype=float)
+
+        funding = (totals[Transaction.FUND] + totals[Transaction.REDEEM] + totals[Transaction.INTEREST]).to_numpy()
+        delta = (totals[Transaction.BUY] + totals[Transaction.SELL]).to_numpy()
+        new_cash = funding - delta + dividends
+
+        df = pd.DataFrame({'Date': months,
+                           'Funds': carry['Funds'] + totals[Transaction.FUND].cumsum().to_numpy(),
+                           'Redeemed': carry['Redeemed'] + totals[Transaction.REDEEM].cumsum().to_numpy(),
+                           'TransIn': carry['TransIn'] + totals[Transaction.TRANS_IN].cumsum().to_numpy(),
+                           'TransOut': carry['TransOut'] + totals[Transaction.TRANS_OUT].cumsum().to_numpy(),
+                           'NewCash': new_cash,
+                           'Cash': floored_cumsum(new_cash, carry['Cash']),  # Fix floating point errors,  cash can not go negative
+                           'Effective': compounded_cumsum(funding, ratios, carry['Effective'])})  # Effective cost is adjusted by CPI inflation
 
         if equity_df.empty:
             df['Cost'] = 0
@@ -1900,110 +2315,75 @@ class InvestmentAccount(Account):
             df = df.merge(equity_df.groupby(['Date']).agg({'Cost': 'sum', 'TotalDividends': 'sum', 'Dividends': 'sum', 'Value': 'sum'}).reset_index(),
                           on='Date', how='left')
 
-        df.replace(np.nan, 0, inplace=True)  # todo: Fix Downcasting behavior in `replace` is deprecated and will be removed in a future version.
-        return df
+        if not head.empty:
+            df = pd.concat([head[df.columns], df], ignore_index=True)
+        return df.fillna(0)
 
-    def extend_equity_df(self, equity: Equity, start_data: Dict) -> Dict:
-        """ New """
-        dividends: Dict[date, float]
-        entry: EquityValue
-        xas = self.transactions.filter(equity=equity)
-        first = xas.earliest('date').date
-
-        trades: QuerySet = xas.filter(xa_action__in=Transaction.SHARE_TRANSACTIONS).exclude(xa_action=Transaction.REDIV).order_by('date')
-        trade_dates = list(trades.order_by('date').values_list('date', flat=True).distinct())
-        redivs: dict[date, float] = dict(xas.filter(date__gte=first, equity=equity, xa_action=Transaction.REDIV).values_list('date', 'quantity'))
-        rediv_value: dict[date, float] = dict(xas.filter(date__gte=first, equity=equity, xa_action=Transaction.REDIV).values_list('date', 'currency_value'))
-
-        values = EquityValue.objects.filter(date__gte=first, equity=equity).order_by('date')
-
-        funded = dict(xas.filter(xa_action__in=[Transaction.FUND,]).annotate(month=TruncMonth('date')).values('month').annotate(sum=Sum('value')).values_list('month', 'sum'))
-        redeemed = dict(xas.filter(xa_action__in=[Transaction.REDEEM,]).annotate(month=TruncMonth('date')).values('month').annotate(sum=Sum('value')).values_list('month', 'sum'))
-        dividends = dict(EquityEvent.objects.filter(real_date__gte=first, equity=equity, event_type='Dividend').values_list('date', 'value'))
-        equity_dividends = {e['date']: e for e in EquityEvent.objects.filter(equity=equity, event_type='Dividend').values('date', 'real_date', 'value')}
-        shares_df = self.shares_df(equity)
-        if len(redivs) > 0 and not self.managed:
-            logger.error('Account %s has REDIVS but is not managed - The realized gains may be double counted')
-
-        # warning - we may record dividends (via the API) a month earlier then the REDIV, seems they hold onto our money
-        shares = cost = total_dividends = realized_gain = total_spend = total_redeem = avg_cost = 0
-        for entry in values:  # This is over every month you owned this equity.
-            cf = currency_factor(entry.date, equity.currency, self.currency)
-            start_cost = cost
-            start_shares = shares
-
-            # Step 1,  Update shares based on trades
-            if entry.date in trade_dates:  # We did something on this normalized day
-                for trade in trades.filter(date=entry.date):  # Over each trade on this day
-                    shares += trade.quantity
-                    if trade.currency_value > 0:
-                        total_spend += trade.currency_value
-                    else:
-                        if avg_cost != 0:
-                            realized_gain += (trade.currency_value * -1) - (trade.quantity * - 1 * avg_cost)
-                        else:
-                            realized_gain += (trade.currency_value * -1) - (trade.quantity * -1 * trade.price)
-                        total_redeem += trade.currency_value * -1
-                    cost += trade.currency_value
-
-            # Step 2, Update Dividends for non-managed
-            if not self.managed:
-                if entry.date in equity_dividends:
-                    on_date = self.shares_on_date(shares_df, equity_dividends[entry.date]['real_date'])
-                    dividend = equity_dividends[entry.date]['value'] * cf * on_date
-                else:
-                    dividend = 0
-                total_dividends += dividend
-                realized_gain += dividend
-            else:
-                dividend = 0
-
-            # Step 3,  Update shares and buy cost of any reinvested dividends for this month
-            if self.managed and entry.date in redivs:
-                shares += redivs[entry.date]  # update shares
-                total_spend += rediv_value[entry.date]  # We did buy them
-                realized_gain += rediv_value[entry.date]
-                cost += rediv_value[entry.date]
-
-            if equity.equity_type == 'Value' or equity.equity_type == 'Cash':
-                if equity.equity_type == 'Value':
-                    if entry.date in funded:
-                        cost += funded[entry.date]
-                        total_spend += funded[entry.date]
-                    if entry.date in redeemed:
-                        cost -= redeemed[entry.date]
-                        total_redeem += redeemed[entry.date]
-                    value = entry.value
-                else:  # Cost
-                    value = entry.value
-                    cost = value
-                    total_redeemed = 0
-                    total_cost = 0
-                this_price = 0
-                shares = 1
-            else:
-                this_price = entry.price
-
-            if shares < 1 and start_shares != 0:  # Do this once, less than 1 because floats sometimes give crazy .000000001 values for 0
-                if shares:
-                    logger.debug('%s:%s - %s Negative shares %s' % (self.name, equity, entry.date, shares))
-                value = entry.price * start_shares * cf if equity.equity_type == 'Equity' else value
-                relgp = (start_cost - realized_gain) * 100 / start_cost if start_cost else 0
-                unrealized_gain = total_redeem - total_spend
-                unrelgp = unrealized_gain * 100 / start_cost if start_cost else 0
-                shares = dividend = value = cost = 0
-            else:
-                value = entry.price * shares * cf if equity.equity_type == 'Equity' else value
-                relgp = 100 - (cost - realized_gain) * 100 / cost if cost else 0
-                unrealized_gain = value - total_spend + total_redeem if value else 0
-                unrelgp = unrealized_gain * 100 / cost if unrealized_gain  and cost else 0
-
-            avg_cost = total_spend / shares if shares or shares > 0 else 0  # Update average cost
+    def holdings_monthly(self, equities: List[Equity], since: date = None) -> Dict[int, DataFrame]:
+        """
+        Load everything needed to build the equity DF with a fixed number of queries (trades, prices, dividends),
+        the result is a DataFrame for each equity indexed by the months we have a price for,  with the holdings_scan inputs as columns.
+        With since,  only months from since onwards are loaded
+        """
+        xa_columns = ['equity_id', 'date', 'real_date', 'xa_action', 'price', 'quantity', 'currency_value']
+        xas = self.transactions.filter(equity__in=equities)
+        prior = {}  # equity_id -> first date, shares held before since
+        if since is not None:
+            prior = {entry['equity_id']: (entry['first'], entry['shares'] or 0) for entry in
+                     xas.filter(date__lt=since).order_by().values('equity_id').annotate(first=Min('date'), shares=Sum('quantity'))}
+            xas = xas.filter(date__gte=since)
+        xas = pd.DataFrame(list(xas.order_by('real_date', 'id').values(*xa_columns)), columns=xa_columns)
+        xas['currency_value'] = xas['currency_value'].fillna(0)
+        firsts = xas.groupby('equity_id')['date'].min().to_dict()
+        for equity_id, (first, _) in prior.items():
+            firsts[equity_id] = first
+        if not firsts:
+            return {}
+        start = max(min(firsts.values()), since) if since else min(firsts.values())
+
+        value_columns = ['equity_id', 'date', 'price']
+        values = pd.DataFrame(list(EquityValue.objects.filter(equity_id__in=firsts.keys(), date__gte=start).order_by('date').values(*value_columns)),
+                              columns=value_columns)
+        event_columns = ['equity_id', 'date', 'real_date', 'value']
+        events = pd.DataFrame(list(EquityEvent.objects.filter(equity_id__in=firsts.keys(), event_type='Dividend', date__gte=start).values(*event_columns)),
+                              columns=event_columns)
+
+        # Trades summed by equity/month,  a sale is anything that returned money (or cost nothing)
+        trades = xas[xas['xa_action'].isin([Transaction.BUY, Transaction.SELL, Transaction.TRANS_IN, Transaction.TRANS_OUT])]
+        sold = trades['currency_value'] <= 0
+        trades = pd.DataFrame({'equity_id': trades['equity_id'], 'date': trades['date'], 'quantity': trades['quantity'],
+                               'spend': trades['currency_value'].where(~sold, 0), 'redeem': (trades['currency_value'] * -1).where(sold, 0),
+                               'sold_qty': (trades['quantity'] * -1).where(sold, 0), 'sold_at_price': (trades['quantity'] * -1 * trades['price']).where(sold, 0)})
+        trades = trades.groupby(['equity_id', 'date']).sum()
+        redivs = xas[xas['xa_action'] == Transaction.REDIV].groupby(['equity_id', 'date'])[['quantity', 'currency_value']].sum()
+        redivs.columns = ['rediv_qty', 'rediv_value']
+        if not redivs.empty and not self.managed:
+            logger.error('Account %s has REDIVS but is not managed - The realized gains may be double counted' % self)
 
-            start_data.append({'Date': entry.date, 'Equity': equity.key, 'Object_ID': equity.id, 'Object_Type': 'Equity', 'Shares': shares, 'Cost': cost,
-                            'Price': this_price, 'Dividends': dividend, 'TotalDividends': total_dividends, 'Value': value, 'TBuy': total_spend,
-                            'TSell': total_redeem, 'RelGain': realized_gain, 'UnRelGain': unrealized_gain, 'RelGainPct': relgp, 'UnRelGainPct': unrelgp, 'AvgCost': avg_cost})
-        return start_data
+        result = {}
+        for equity in equities:
+            if equity.id not in firsts:
+                continue
+            prices = values[(values['equity_id'] == equity.id) & (values['date'] >= firsts[equity.id])]
+            monthly = pd.DataFrame({'price': prices['price'].to_numpy(dtype=float)}, index=pd.Index(prices['date'], name='date'))
+            monthly['factor'] = ExchangeRate.factors(monthly.index, equity.currency, self.currency)
+            monthly = monthly.join(trades.xs(equity.id) if equity.id in trades.index.get_level_values(0) else pd.DataFrame(columns=trades.columns))
+            monthly = monthly.join(redivs.xs(equity.id) if equity.id in redivs.index.get_level_values(0) else pd.DataFrame(columns=redivs.columns))
+            monthly = monthly.fillna(0).astype(float)
+
+            # Dividends are paid on the shares held on the real date of the event (including any reinvested shares)
+            monthly['dividends'] = 0.0
+            dividends = events[events['equity_id'] == equity.id].drop_duplicates('date', keep='last').set_index('date')
+            dividends = dividends[dividends.index.isin(monthly.index)]
+            if not dividends.empty:
+                held = xas[xas['equity_id'] == equity.id]
+                before = prior[equity.id][1] if equity.id in prior else 0
+                shares = before + held['quantity'].cumsum().to_numpy(dtype=float)
+                position = np.searchsorted(pd.to_datetime(held['real_date']).to_numpy(), pd.to_datetime(dividends['real_date']).to_numpy(), side='right') - 1
+                on_date = np.where(position >= 0, shares[np.maximum(position, 0)] if len(shares) else 0, before)
+                monthly.loc[dividends.index, 'dividends'] = dividends['value'].to_numpy(dtype=float) * on_date * monthly.loc[dividends.index, 'factor'].to_numpy()
+            result[equity.id] = monthly
+        return result
 
     @property
     def get_last_date(self):
@@ -2011,22 +2391,78 @@ class InvestmentAccount(Account):
             return self.transactions.latest('real_date').real_date
         return normalize_today()
 
-    def equity_df(self) -> pd.DataFrame:
-        now = datetime.now().date()
-        data = []
-        for equity in self.equities:
-            data = self.extend_equity_df(equity, data)
-        df = pd.DataFrame(data)
-        # new['Value'] = new['Shares'] * new['Price']
-        if not df.empty:
-            df['AvgCost'] = df['Cost'] / df['Shares']
-            df.replace([np.inf, -np.inf], 0, inplace=True) # Can not divide by 0 !
-            try:
-                df['Date'] = pd.to_datetime(df['Date'])
-            except:
-                logger.debug('DataFrame exception on date:%s' % df)
+    def equity_df(self, since: date = None, cached: DataFrame = None) -> pd.DataFrame:
+        """
+        Build the equity DF for every equity in the account,  the data is loaded once (holdings_monthly) and each
+        equity is a single pass over NumPy arrays (holdings_scan)
+        Incremental mode - with since (a normalized month) and the cached equity DF,  rows before since are kept and
+        each equity's scan starts from its last cached row.
+        """
+        equities = list(self.equities)
+        head = pd.DataFrame(columns=EQUITY_COL)
+        states = {}
+        if since is not None and cached is not None and not cached.empty:
+            head = cached.loc[cached['Date'] < pd.Timestamp(since)]
+            for equity_id, rows in head.groupby('Object_ID'):
+                last = rows.iloc[-1]
+                states[equity_id] = {'shares': last['Shares'], 'cost': last['Cost'], 'total_dividends': last['TotalDividends'],
+                                     'realized_gain': last['RelGain'], 'total_spend': last['TBuy'], 'total_redeem': last['TSell'],
+                                     'avg_cost': last['TBuy'] / last['Shares'] if last['Shares'] else 0}
+        else:
+            since = None
+
+        frames = []
+        monthly_data = self.holdings_monthly(equities, since)
+        for equity in equities:
+            if not head.empty:
+                frames.append(head.loc[head['Object_ID'] == equity.id])
+            if equity.id not in monthly_data:
+                continue
+            monthly = monthly_data[equity.id]
+            columns, _ = holdings_scan({name: monthly[name].to_numpy() for name in monthly.columns}, self.managed, states.get(equity.id))
+            frame = pd.DataFrame(columns)
+            frame.insert(0, 'Date', pd.to_datetime(monthly.index))
+            frame.insert(1, 'Equity', equity.key)
+            frame.insert(2, 'Object_ID', equity.id)
+            frame.insert(3, 'Object_Type', 'Equity')
+            frames.append(frame[EQUITY_COL])
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame(columns=EQUITY_COL)
+
+        df = pd.concat(frames, ignore_index=True)
+        df['AvgCost'] = df['Cost'] / df['Shares']
+        df.replace([np.inf, -np.inf], 0, inplace=True)  # Can not divide by 0 !
         return df
 
+    def refresh(self, dirty_from: date):
+        """
+        Recompute the cached frames from the dirty_from month onwards,  earlier rows are kept as is.
+        Without cached frames to build on this is a full rebuild.
+        """
+        dirty_from = normalize_date(dirty_from)
+        cached_p = get_cached_dataframe(self.container_cache_key)
+        cached_e = get_cached_dataframe(self.component_cache_key)
+        if cached_p.empty:  # Flushed from the cache,  build on the snapshot rows
+            cached_p = AccountSnapshot.frame(self)
+            cached_e = EquitySnapshot.frame(self)
+        if cached_p.empty or pd.Timestamp(dirty_from) <= cached_p['Date'].min():
+            return super().refresh(dirty_from)
+        dirty_from = min(dirty_from, next_date(cached_p['Date'].max().date()))  # The rows we build on must be complete
+
+        logger.debug('Refreshing %s from %s' % (self, dirty_from))
+        df = self.equity_df(since=dirty_from, cached=cached_e)
+        EquitySnapshot.store(self, df, since=dirty_from)
+        cache_dataframe(self.component_cache_key, df)
+        df = self.account_frame(since=dirty_from, cached=cached_p)
+        if not df.empty:
+            df['Date'] = pd.to_datetime(df['Date'])
+            df['Actual'] = df['Cash'] + df['Value']
+            AccountSnapshot.store(self, df, since=dirty_from)
+            cache_dataframe(self.container_cache_key, df)
+        if self.portfolio:
+            self.portfolio.reset()
+
     def close_actions(self, on_date, receiver):
         for equity in self.equities:
             self.transfer_equity(equity, receiver, on_date)
@@ -2048,7 +2484,7 @@ class ValueAccount(Account):
         Build a account DF based on Deposits, Withdraws and FundValue records
         """
         df = pd.DataFrame(columns=ACCOUNT_COL)
-        if not self.transactions:  # Account is new/empty
+        if not self.transactions.exists():  # Account is new/empty
             return df
         try:
             equity = Equity.objects.get(symbol=self.f_key)
@@ -2056,33 +2492,15 @@ class ValueAccount(Account):
             logger.error('Equity %s is missing for Account(%s) %s' % (self.f_key, self.id, self.name))
             return df
 
-        this_date = self.transactions.earliest('date').date
-        final_date = normalize_date(self.end) if self.end else normalize_today()
-
-        xas = self.transactions
-        xa_dates = list(self.transactions.values_list('date', flat=True).distinct())
-        values = dict(FundValue.objects.filter(equity=equity).values_list('date', 'value'))
-        funds = trans_in = withdraw = trans_out = 0
-        df_list = []
-        while this_date <= final_date:
-            if this_date in xa_dates:  # Maybe this should be more explicit since REDEEM on some accounts is monthly
-                new_funds = xas.filter(xa_action=Transaction.FUND, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_trans_in = xas.filter(xa_action=Transaction.TRANS_IN, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_withdraw = xas.filter(xa_action=Transaction.REDEEM, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                new_trans_out = xas.filter(xa_action=Transaction.TRANS_OUT, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-                delta = xas.filter(xa_action__in=[Transaction.BUY, Transaction.SELL], date=this_date).aggregate(Sum('value'))['value__sum'] or 0
-
-                funds += new_funds
-                trans_in += new_trans_in
-                withdraw += new_withdraw
-                trans_out += new_trans_out
-
-            value = values[this_date] if this_date in values else 0
-            df_list.append({'Date': this_date, 'Funds': funds, 'Redeemed': withdraw, 'TransIn': trans_in, 'TransOut': trans_out, 'Value': value})
-            this_date = next_date(this_date)
-
-        df = pd.DataFrame(df_list)
-        df['Date'] = pd.to_datetime(df['Date'])
+        first = self.transactions.aggregate(first=Min('date'))['first']
+        months = month_range(first, self.end if self.end else normalize_today())
+        totals = self.monthly_totals(months)
+        df = pd.DataFrame({'Date': months,
+                           'Funds': totals[Transaction.FUND].cumsum().to_numpy(),
+                           'Redeemed': totals[Transaction.REDEEM].cumsum().to_numpy(),
+                           'TransIn': totals[Transaction.TRANS_IN].cumsum().to_numpy(),
+                           'TransOut': totals[Transaction.TRANS_OUT].cumsum().to_numpy(),
+                           'Value': self.fund_values(equity, months)})
         df['Actual'] = df['Value']
         df['Cash'] = 0
         df['TotalDividends'] = 0
@@ -2147,21 +2565,13 @@ class CashAccount(Account):
             logger.error('Equity %s is missing for Account(%s) %s' % self.f_key, self.id, self.name)
             return pd.DataFrame(columns=ACCOUNT_COL)
 
-        if not FundValue.objects.filter(equity=equity).exists():
+        first = FundValue.objects.filter(equity=equity).aggregate(first=Min('date'))['first']
+        if not first:
             logger.error('No FundValue records for Equity %s Account(%s) %s' % (self.f_key, self.id, self.name))
             return pd.DataFrame(columns=ACCOUNT_COL)
 
-        this_date = FundValue.objects.filter(equity=equity).earliest('date').date
-        final_date = normalize_date(self.end) if self.end else normalize_today()
-
-        values = dict(FundValue.objects.filter(equity=equity).values_list('date', 'value'))
-        df_list = []
-        while this_date <= final_date:
-            value = values[this_date] if this_date in values else 0
-            df_list.append({'Date': this_date, 'Funds': 0, 'Redeemed': 0, 'TransIn': 0, 'TransOut': 0, 'Value': value})
-            this_date = next_date(this_date)
-
-        df = pd.DataFrame(df_list)
+        months = month_range(first, self.end if self.end else normalize_today())
+        df = pd.DataFrame({'Date': months.date, 'Funds': 0, 'Redeemed': 0, 'TransIn': 0, 'TransOut': 0, 'Value': self.fund_values(equity, months)})
         df['Actual'] = df['Value']
         df['Cash'] = 0
         df['TotalDividends'] = 0
@@ -2278,14 +2688,13 @@ class Transaction(models.Model):
             return True
         return False
 
-    def save(self, *args, **kwargs):
+    def normalize(self, factor: float = None):
         """
-        Do the logic to make sure value have the correct value
+        Set date,  the signs of quantity/value and currency_value the way they are stored.   Used by save and by the
+        bulk importers (that look up the currency factor for many transactions at once)
+        kwargs:
+            factor: float - equity currency to account currency,  looked up when None
         """
-
-        do_reset = False if 'reset' not in kwargs else kwargs.pop('reset')
-        source = DataSource.ESTIMATE.value if 'source' not in kwargs else kwargs.pop('source')
-
         if self.real_date:
             self.date = normalize_date(self.real_date)
         elif self.date:
@@ -2311,11 +2720,23 @@ class Transaction(models.Model):
 
         # todo: Why do I care about value on equity transactions.   I don't think I use it.
         if self.equity:
-            cf = currency_factor(self.date, self.equity.currency, self.account.currency)
+            cf = factor if factor is not None else currency_factor(self.date, self.equity.currency, self.account.currency)
             self.currency_value = self.value * cf
         else:
             self.currency_value = self.value
+
+    def save(self, *args, **kwargs):
+        """
+        Do the logic to make sure value have the correct value
+        """
+
+        do_reset = False if 'reset' not in kwargs else kwargs.pop('reset')
+        source = DataSource.ESTIMATE.value if 'source' not in kwargs else kwargs.pop('source')
+
+        self.normalize()
         super(Transaction, self).save(*args, **kwargs)
+        if self.equity:
+            CacheDependencies.note(self.equity.id, self.account.id)
 
         if self.price != 0 and self.equity and not self.equity.searchable:
             try:
@@ -2329,13 +2750,11 @@ class Transaction(models.Model):
                 EquityValue.objects.create(source=source, equity=self.equity, price=self.price, real_date=self.real_date, date=self.date)
 
             if do_reset:
-                if self.equity:
-                    for account in Account.objects.filter(id__in=Transaction.objects.filter(equity=self.equity).values_list('account', flat=True).distinct()):
-                        account.reset()
+                CacheDependencies.invalidate([(self.equity, self.date)])  # The price is seen by every holder
 
         else:
             if do_reset:
-                self.account.reset()
+                CacheDependencies.invalidate([(self.account, self.date)])
 
     @classmethod
     def transaction_value(cls, xa_string: str) -> int:
@@ -2343,3 +2762,249 @@ class Transaction(models.Model):
             if value == xa_string:
                 return key
         raise AssertionError(f'Invalid transaction string: {xa_string}')
+
+
+class Snapshot(models.Model):
+    """
+    A cached container DataFrame persisted one row per month,  the tier behind the Redis cache.   So the monthly
+    numbers survive a cache flush and can be read with plain SQL.   Rows are written as the frames are built and
+    removed from the first stale month onwards when the frames are invalidated,  so a snapshot that reaches the
+    account's last month and was built within SNAPSHOT_TTL is current.   Like the Redis cache it is not used when
+    NO_CACHE is set.
+    """
+    COLUMNS: Dict[str, str] = {}  # DataFrame column -> field
+
+    account = models.ForeignKey('Account', on_delete=models.CASCADE)
+    date: date = models.DateField()
+    built: datetime = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def forget(cls, since: Dict[int, Union[date, None]]):
+        """
+        Remove the rows of each account id in since from its month onwards (all of them for None)
+        """
+        if settings.NO_CACHE or not since:
+            return
+        query = Q()
+        for account_id, month in since.items():
+            query |= Q(account_id=account_id, date__gte=month) if month else Q(account_id=account_id)
+        cls.objects.filter(query).delete()
+
+    @classmethod
+    def extra_fields(cls, df: DataFrame) -> Dict[str, np.ndarray]:
+        return {}
+
+    @classmethod
+    def store(cls, account, df: DataFrame, since: date = None):
+        """
+        Replace the rows from since onwards (or all of them) with those in df
+        """
+        if settings.NO_CACHE:
+            return
+        cls.forget({account.id: since})
+        if since:
+            df = df.loc[df['Date'] >= pd.Timestamp(since)]
+        if df.empty:
+            return
+        fields = {'date': pd.to_datetime(df['Date']).dt.date.to_numpy()}
+        fields.update(cls.extra_fields(df))
+        for column, field in cls.COLUMNS.items():
+            if column in df.columns:
+                values = df[column].to_numpy(dtype=float)
+                fields[field] = np.where(np.isnan(values), None, values)
+        names = list(fields)
+        cls.objects.bulk_create([cls(account_id=account.id, **dict(zip(names, row))) for row in zip(*fields.values())], batch_size=1000)
+
+    @classmethod
+    def records(cls, account) -> DataFrame:
+        return pd.DataFrame.from_records(cls.objects.filter(account=account).order_by('date').values('date', *cls.COLUMNS.values()))
+
+    @classmethod
+    def frame(cls, account) -> DataFrame:
+        """
+        The stored rows back as a DataFrame,  columns the account type does not produce (all null) are left out
+        """
+        if settings.NO_CACHE:
+            return pd.DataFrame()
+        df = cls.records(account)
+        if df.empty:
+            return df
+        df = df.rename(columns={field: column for column, field in cls.COLUMNS.items()}).rename(columns={'date': 'Date'})
+        df['Date'] = pd.to_datetime(df['Date'])
+        df = df.dropna(axis='columns', how='all')
+        return df.astype({column: float for column in cls.COLUMNS if column in df.columns})
+
+    @staticmethod
+    def is_current(account) -> bool:
+        """
+        True when the account's snapshot reaches its last month (today's month unless it is closed) and that month
+        was built within SNAPSHOT_TTL
+        """
+        if settings.NO_CACHE:
+            return False
+        last = AccountSnapshot.objects.filter(account=account).order_by('-date').values('date', 'built').first()
+        return (last is not None and last['date'] >= normalize_date(account.end if account.end else normalize_today()) and
+                last['built'] >= timezone.now() - timedelta(seconds=SNAPSHOT_TTL))
+
+
+class AccountSnapshot(Snapshot):
+    """
+    One row per account and month of the account DataFrame (p_pd)
+    """
+    COLUMNS = {'Funds': 'funds', 'Redeemed': 'redeemed', 'TransIn': 'trans_in', 'TransOut': 'trans_out', 'NewCash': 'new_cash',
+               'Cash': 'cash', 'Effective': 'effective', 'Cost': 'cost', 'TotalDividends': 'total_dividends', 'Dividends': 'dividends',
+               'Value': 'value', 'Actual': 'actual'}
+
+    funds: float = models.FloatField(null=True)
+    redeemed: float = models.FloatField(null=True)
+    trans_in: float = models.FloatField(null=True)
+    trans_out: float = models.FloatField(null=True)
+    new_cash: float = models.FloatField(null=True)
+    cash: float = models.FloatField(null=True)
+    effective: float = models.FloatField(null=True)
+    cost: float = models.FloatField(null=True)
+    total_dividends: float = models.FloatField(null=True)
+    dividends: float = models.FloatField(null=True)
+    value: float = models.FloatField(null=True)
+    actual: float = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = (('account', 'date'),)
+
+    def __str__(self):
+        return f'{self.account} - {self.date}'
+
+
+class EquitySnapshot(Snapshot):
+    """
+    One row per account,  equity and month of the equity DataFrame (e_pd)
+    """
+    COLUMNS = {'Shares': 'shares', 'Cost': 'cost', 'Price': 'price', 'Dividends': 'dividends', 'TotalDividends': 'total_dividends',
+               'Value': 'value', 'TBuy': 'total_buy', 'TSell': 'total_sell', 'RelGain': 'realized_gain', 'UnRelGain': 'unrealized_gain',
+               'RelGainPct': 'realized_gain_pct', 'UnRelGainPct': 'unrealized_gain_pct', 'AvgCost': 'avg_cost'}
+
+    equity = models.ForeignKey(Equity, on_delete=models.CASCADE)
+    shares: float = models.FloatField(null=True)
+    cost: float = models.FloatField(null=True)
+    price: float = models.FloatField(null=True)
+    dividends: float = models.FloatField(null=True)
+    total_dividends: float = models.FloatField(null=True)
+    value: float = models.FloatField(null=True)
+    total_buy: float = models.FloatField(null=True)
+    total_sell: float = models.FloatField(null=True)
+    realized_gain: float = models.FloatField(null=True)
+    unrealized_gain: float = models.FloatField(null=True)
+    realized_gain_pct: float = models.FloatField(null=True)
+    unrealized_gain_pct: float = models.FloatField(null=True)
+    avg_cost: float = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = (('account', 'equity', 'date'),)
+        indexes = [models.Index(fields=['account', 'date'])]
+
+    def __str__(self):
+        return f'{self.account} - {self.equity} - {self.date}'
+
+    @classmethod
+    def extra_fields(cls, df: DataFrame) -> Dict[str, np.ndarray]:
+        return {'equity_id': df['Object_ID'].to_numpy(dtype=int)}
+
+    @classmethod
+    def records(cls, account) -> DataFrame:
+        df = pd.DataFrame.from_records(cls.objects.filter(account=account).order_by('equity__symbol', 'date').values('date', 'equity_id', *cls.COLUMNS.values()))
+        if not df.empty:
+            keys = {equity.id: equity.key for equity in Equity.objects.filter(id__in=df['equity_id'].unique())}
+            df.insert(1, 'Equity', df['equity_id'].map(keys))
+            df.insert(2, 'Object_ID', df.pop('equity_id'))
+            df.insert(3, 'Object_Type', 'Equity')
+        return df
+
+
+class CacheDependencies:
+    """
+    The reverse index from an equity to the accounts that traded it (and from an account to its portfolio),  used to
+    find the minimal set of cached frames a change makes stale.   Each equity's account ids are held in the cache,
+    built from one query on a miss and dropped when a transaction adds an account the index has not seen.
+    """
+
+    @staticmethod
+    def equity_key(equity_id: int) -> str:
+        return f'Equity:{equity_id}:Accounts'
+
+    @classmethod
+    def accounts_for(cls, equity_ids) -> Dict[int, set]:
+        """
+        Return {equity_id: set of account ids} for equity_ids
+        """
+        keys = {cls.equity_key(equity_id): equity_id for equity_id in equity_ids}
+        found = {keys[key]: accounts for key, accounts in get_simple_cache_many(list(keys)).items()}
+        missing = set(keys.values()) - set(found)
+        if missing:
+            built = {equity_id: set() for equity_id in missing}
+            for equity_id, account_id in Transaction.objects.filter(equity_id__in=missing).values_list('equity_id', 'account_id').distinct():
+                built[equity_id].add(account_id)
+            set_simple_cache_many({cls.equity_key(equity_id): accounts for equity_id, accounts in built.items()}, timeout=None)
+            found.update(built)
+        return found
+
+    @classmethod
+    def note(cls, equity_id: int, account_id: int):
+        """
+        A transaction for equity was saved on account,  forget the index entry if it does not know the account yet
+        (a rebuild from the database is safer than a read-modify-write racing another worker)
+        """
+        accounts = get_simple_cache(cls.equity_key(equity_id))
+        if accounts is not None and account_id not in accounts:
+            clear_simple_cache(cls.equity_key(equity_id))
+
+    @classmethod
+    def invalidate(cls, changes, keep=()):
+        """
+        Mark the cached frames made stale by changes,  a list of (Equity or Account, first changed date).   A date of
+        None means the history changed and the frames are dropped,  otherwise accounts are marked dirty and the next
+        read recomputes them from that month onwards (InvestmentAccount.refresh).   Portfolios are always dropped,
+        they are only a sum over their accounts.
+
+        kwargs:
+            keep: account ids whose frames are known to be current
+        """
+        since: Dict[int, Union[date, None]] = {}
+        equities: Dict[int, Union[date, None]] = {}
+
+        def merge(target: dict, pk: int, month):
+            if pk in target and (target[pk] is None or month is None):
+                target[pk] = None
+            else:
+                target[pk] = min(target[pk], month) if pk in target else month
+
+        for item, changed in changes:
+            month = normalize_date(changed) if changed else None
+            merge(equities if isinstance(item, Equity) else since, item.id, month)
+        for equity_id, accounts in cls.accounts_for(list(equities)).items():
+            for account_id in accounts:
+                merge(since, account_id, equities[equity_id])
+        for account_id in keep:
+            since.pop(account_id, None)
+        if not since:
+            return
+
+        drop = set()
+        dirty = {}
+        portfolios = set()
+        for account_id, account_type, portfolio_id in Account.objects.filter(id__in=since).values_list('id', 'account_type', 'portfolio_id'):
+            container, component = BaseContainer.cache_keys(f'{account_type}Account', account_id)
+            if since[account_id] is None:
+                drop.update([container, component])
+            else:
+                dirty[container] = since[account_id]
+            if portfolio_id:
+                portfolios.add(portfolio_id)
+        for portfolio_id in portfolios:
+            drop.update(BaseContainer.cache_keys('Portfolio', portfolio_id))
+        logger.debug('Invalidating %s accounts and %s portfolios' % (len(since), len(portfolios)))
+        invalidate_cached_dataframes(drop, dirty)
+        AccountSnapshot.forget(since)
+        EquitySnapshot.forget(since)
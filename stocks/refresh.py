@@ -0,0 +1,461 @@
+"""
+Concurrent equity price refresh for the daily update.
+
+Yahoo Finance equities are fetched in batches (yahoo_history),  whatever that misses goes to the per equity Yahoo calls
+on a bounded thread pool.   What Yahoo could not provide is ranked (av_priority) and given as much of the Alphavantage
+daily allowance as is left (av_schedule,  recorded in base.models.APIBudget).   Each provider is behind a token bucket.
+The results are applied to the database on the calling thread as they arrive,  so all writes stay single threaded.
+
+intraday_refresh is the light weight version for the hourly task,  just this month's price for the equities people hold.
+"""
+import logging
+import pandas as pd
+import threading
+import yfinance as yf
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from time import monotonic, sleep
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.transaction import atomic
+
+from base import response_cache
+from base.models import API, APIBudget, Profile
+from base.utils import normalize_date, normalize_today
+from stocks.models import Account, Equity, EquityValue, DataSource, CacheDependencies, Transaction
+
+YAHOO_BATCH = 50  # Tickers per yf.download
+AV_DAILY_LIMIT = getattr(settings, 'ALPHAVANTAGE_DAILY_LIMIT', 25)  # Calls per key per day
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket,  rate tokens per second up to capacity tokens banked
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.stamp) * self.rate)  # A clock step back adds nothing
+        self.stamp = now
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self) -> float:
+        """
+        Block until a token is available,  returns the seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+
+# Per process pacing.   Yahoo does not publish a limit,  it throttles bursts.   The Alphavantage daily allowance is
+# kept in the database (APIBudget),  this only spaces the calls out.
+BUCKETS: Dict[int, TokenBucket] = {
+    Equity.ypfinance: TokenBucket(getattr(settings, 'YAHOO_REQUESTS_PER_SECOND', 2), getattr(settings, 'YAHOO_REQUEST_BURST', 5)),
+    Equity.alphavantage: TokenBucket(getattr(settings, 'ALPHAVANTAGE_REQUESTS_PER_MINUTE', 5) / 60, getattr(settings, 'ALPHAVANTAGE_REQUESTS_PER_MINUTE', 5)),
+}
+
+
+API_NAMES = {Equity.ypfinance: 'ypfinance', Equity.alphavantage: 'AVURL'}  # The API rows behind each provider
+
+
+class RefreshStats:
+    """
+    Counters for one refresh run,  updated from the worker threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.equities = 0
+        self.fetched = 0
+        self.calls: Dict[int, int] = {Equity.ypfinance: 0, Equity.alphavantage: 0}
+        self.skipped = 0  # Provider calls dropped because the bucket was empty
+        self.wait = 0.0
+        self.failures = 0
+        self.rows = {'inserted': 0, 'updated': 0, 'unchanged': 0}  # EquityValue/EquityEvent rows written
+        self.changed: Dict[Equity, date] = {}  # The first month written for each equity
+        self.paused: Dict[str, str] = {}  # API name -> reason,  applied by the refresh thread once the workers are done
+
+    def add(self, name: str, value):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def pause(self, name: str, reason: str = 'Undefined'):
+        with self.lock:
+            self.paused.setdefault(name, reason)
+
+    def call(self, api: int):
+        with self.lock:
+            self.calls[api] += 1
+
+    def written(self, counts: Dict[str, int], equity: Equity = None):
+        with self.lock:
+            for name in self.rows:
+                self.rows[name] += counts[name]
+            if equity and counts.get('since'):
+                self.changed[equity] = counts['since']
+
+    @property
+    def elapsed(self) -> float:
+        return monotonic() - self.start
+
+    def __str__(self):
+        return ('%s equities (%s fetched) in %.1fs,  %.2f equities/sec,  %s Yahoo and %s Alphavantage calls,  '
+                '%s skipped,  %.1fs waiting on rate limits,  %s failures,  rows %s inserted %s updated %s unchanged' %
+                (self.equities, self.fetched, self.elapsed, self.equities / self.elapsed if self.elapsed else 0,
+                 self.calls[Equity.ypfinance], self.calls[Equity.alphavantage], self.skipped, self.wait, self.failures,
+                 self.rows['inserted'], self.rows['updated'], self.rows['unchanged']))
+
+
+def yahoo_history(equities: List[Equity], period: str = '1y') -> pd.DataFrame:
+    """
+    Monthly close and dividends for many equities from two yf.download calls (monthly bars,  and daily bars for the
+    dividend pay dates).   A tidy frame,  one row per (Object_ID, Date) with Close, Dividends and DividendDate
+    (the real dividend date or None)
+    """
+    columns = ['Object_ID', 'Date', 'Close', 'Dividends', 'DividendDate']
+    symbols = {equity.key: equity.id for equity in equities}
+    if not symbols:
+        return pd.DataFrame(columns=columns)
+
+    options = {'period': period, 'actions': True, 'auto_adjust': False, 'group_by': 'ticker', 'progress': False, 'multi_level_index': True}
+    monthly = yf.download(list(symbols), interval='1mo', **options)
+    daily = yf.download(list(symbols), interval='1d', **options)
+    monthly_symbols = set(monthly.columns.get_level_values(0)) if isinstance(monthly, pd.DataFrame) else set()
+    daily_symbols = set(daily.columns.get_level_values(0)) if isinstance(daily, pd.DataFrame) else set()
+
+    frames = []
+    for symbol, equity_id in symbols.items():
+        if symbol not in monthly_symbols:
+            continue
+        prices = monthly[symbol].dropna(subset=['Close'])
+        if prices.empty:
+            continue
+        pay_dates = {}
+        if symbol in daily_symbols:
+            paid = daily[symbol]['Dividends']
+            pay_dates = {normalize_date(stamp.date()): stamp.date() for stamp in paid[paid > 0].index}
+        months = [stamp.date() for stamp in prices.index]
+        frames.append(pd.DataFrame({'Object_ID': equity_id,
+                                    'Date': months,
+                                    'Close': prices['Close'].astype(float).to_numpy(),
+                                    'Dividends': prices['Dividends'].fillna(0).astype(float).to_numpy(),
+                                    'DividendDate': [pay_dates.get(normalize_date(month)) for month in months]}, columns=columns))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def yahoo_results(history: pd.DataFrame) -> Dict[int, Tuple]:
+    """
+    Split a yahoo_history frame into the per equity fetch_external_equity_data result
+    """
+    results = {}
+    for equity_id, rows in history.groupby('Object_ID'):
+        prices = {month: (close, dividend) for month, close, dividend in zip(rows['Date'], rows['Close'], rows['Dividends'])}
+        pay_dates = {month: paid for month, paid in zip(rows['Date'], rows['DividendDate']) if paid is not None and not pd.isna(paid)}
+        results[equity_id] = (Equity.ypfinance, prices, pay_dates)
+    return results
+
+
+def yahoo_cached(equities: List[Equity], period: str) -> Dict[int, Tuple]:
+    """
+    The fetch_external_equity_data results the response cache already has for a batch,  the same entries yp_update
+    reads (and the pay dates yahoo_store kept with them)
+    """
+    results = {}
+    for equity in equities:
+        params = {'symbol': equity.key, 'period': period}
+        if response_cache.is_cached('ypfinance', params):
+            prices = response_cache.cached_series('ypfinance', params, lambda since: {})
+            dividends = {**params, 'dividends': True}
+            pay_dates = response_cache.cached_series('ypfinance', dividends, lambda since: {}) if response_cache.is_cached('ypfinance', dividends) else {}
+            results[equity.id] = (Equity.ypfinance, prices, pay_dates)
+    return results
+
+
+def yahoo_store(equities: List[Equity], results: Dict[int, Tuple], period: str):
+    """
+    Write a batch download to the response cache,  so the equities are cached the same way whichever path fetched them
+    """
+    if not response_cache.ENABLED:
+        return
+    for equity in equities:
+        if equity.id in results:
+            _, prices, pay_dates = results[equity.id]
+            params = {'symbol': equity.key, 'period': period}
+            response_cache.cached_series('ypfinance', params, lambda since: prices, refresh=True)
+            response_cache.cached_series('ypfinance', {**params, 'dividends': True}, lambda since: pay_dates, refresh=True)
+
+
+def fetch(equity: Equity, force: bool, key: str, stats: RefreshStats, yahoo: bool = True, alphavantage: bool = False):
+    """
+    The worker thread half,  provider calls only (API status is read via this thread's own DB connection).
+    Yahoo is skipped when the equity already missed in a batch,  Alphavantage is only called when av_schedule gave
+    the equity a call (the allowance is already recorded).   An Alphavantage answer from the response cache is not
+    rate limited or counted.   A provider that asks us to back off is recorded in stats.paused and not called again.
+    """
+    def throttle(api: int) -> bool:
+        if (api == Equity.ypfinance and not yahoo) or (api == Equity.alphavantage and not alphavantage):
+            return False
+        if API_NAMES[api] in stats.paused:
+            return False
+        if api == Equity.alphavantage and not force and response_cache.is_cached('alphavantage', {'symbol': equity.key}):
+            return True
+        stats.add('wait', BUCKETS[api].acquire())
+        stats.call(api)
+        return True
+
+    try:
+        return equity.fetch_external_equity_data(force=force, key=key, throttle=throttle, pause=stats.pause)
+    finally:
+        connection.close()
+
+
+def av_keys(key: str = None) -> List[str]:
+    """
+    The Alphavantage keys a refresh can spend,  key and (with ALPHAVANTAGE_PROFILE_KEYS) every user's profile key
+    """
+    keys = [key] if key else []
+    if getattr(settings, 'ALPHAVANTAGE_PROFILE_KEYS', False):
+        keys += Profile.objects.exclude(av_api_key__isnull=True).exclude(av_api_key='').values_list('av_api_key', flat=True)
+    return list(dict.fromkeys(keys))
+
+
+def av_priority(equities: List[Equity], yahoo_failed: Iterable[int]) -> List[Equity]:
+    """
+    Rank the equities for an Alphavantage call.   Those Yahoo failed on come first,  then by the value held in open
+    accounts weighted by how stale the last API price is (months),  then by staleness alone.
+    """
+    today = normalize_today()
+    ids = [equity.id for equity in equities]
+    prices = EquityValue.objects.filter(equity=OuterRef('pk')).order_by('-date')
+    latest = Equity.objects.filter(id__in=ids).annotate(
+        price=Subquery(prices.values('price')[:1]),
+        updated=Subquery(prices.filter(source__lte=DataSource.API.value).values('real_date')[:1])).values_list('id', 'price', 'updated')
+    shares = dict(Transaction.objects.filter(equity_id__in=ids, account__in=Account.objects.filter(_end__isnull=True),
+                                             xa_action__in=Transaction.SHARE_TRANSACTIONS).values('equity_id').annotate(
+        shares=Sum('quantity')).values_list('equity_id', 'shares'))
+
+    scores = {}
+    for equity_id, price, updated in latest:
+        stale = (today - updated).days / 30 if updated else 120  # Months,  never from an API is ten years stale
+        value = max(shares.get(equity_id, 0), 0) * (price if price else 0)
+        scores[equity_id] = (value * (1 + stale), stale)
+    failed = set(yahoo_failed)
+    return sorted(equities, key=lambda equity: (equity.id not in failed, -scores.get(equity.id, (0, 0))[0], -scores.get(equity.id, (0, 0))[1]))
+
+
+def av_schedule(equities: List[Equity], yahoo_failed: Iterable[int], keys: List[str], limit: int = None) -> Dict[int, str]:
+    """
+    Give the best ranked equities (av_priority) one Alphavantage call each,  from whichever key has the most of
+    today's allowance left.   The calls are recorded in APIBudget before they are made.   Returns {equity id: key}
+    """
+    limit = limit if limit else AV_DAILY_LIMIT
+    remaining = {key: APIBudget.remaining('AVURL', key, limit) for key in keys}
+    schedule = {}
+    for equity in av_priority(equities, yahoo_failed):
+        key = max(remaining, key=remaining.get) if remaining else None
+        if not key or not remaining[key]:
+            break
+        if APIBudget.spend('AVURL', key, limit):
+            schedule[equity.id] = key
+            remaining[key] -= 1
+        else:  # Another worker spent it
+            remaining[key] = 0
+    return schedule
+
+
+def refresh_equities(equities: Iterable[Equity], force: bool = False, key: str = None, daily: bool = True, workers: int = None,
+                     keys: List[str] = None) -> RefreshStats:
+    """
+    Equity.update for every equity,  with the provider calls made concurrently
+    kwargs:
+        key: str - the Alphavantage key
+        keys: list - the Alphavantage keys to share out,  default av_keys(key)
+    """
+    workers = workers if workers else getattr(settings, 'PRICE_REFRESH_WORKERS', 4)
+    keys = keys if keys is not None else av_keys(key)
+    stats = RefreshStats()
+    remote = []
+    local = []
+    for equity in equities:
+        if equity.equity_type == 'Equity' and equity.searchable and equity.validated:
+            remote.append(equity)
+        else:
+            local.append(equity)  # Nothing to fetch (or set_equity_data has to run first)
+
+    yahoo_up = bool(API.status('ypfinance'))
+    batched: Dict[int, Tuple] = {}
+    missed = set()
+    if remote and yahoo_up:
+        period = '20y' if force else '1y'
+        for start in range(0, len(remote), YAHOO_BATCH):
+            chunk = remote[start:start + YAHOO_BATCH]
+            if not force:  # Like yp_update,  the response cache first unless forced
+                cached = yahoo_cached(chunk, period)
+                batched.update(cached)
+                chunk = [equity for equity in chunk if equity.id not in cached]
+                if not chunk:
+                    continue
+            for _ in range(2):  # The monthly and the daily download
+                stats.add('wait', BUCKETS[Equity.ypfinance].acquire())
+                stats.call(Equity.ypfinance)
+            try:
+                downloaded = yahoo_results(yahoo_history(chunk, period=period))
+            except Exception as e:
+                logger.error('Batched Yahoo download failed: %s' % e)
+                continue
+            yahoo_store(chunk, downloaded, period)
+            batched.update(downloaded)
+            missed.update(equity.id for equity in chunk)
+        missed -= set(batched)
+
+    def apply(this: Equity, fetched=None):
+        try:
+            counts = this.update(force=force, key=key, daily=daily, fetched=fetched)
+            if counts:
+                stats.written(counts, this)
+        except Exception as e:
+            logger.error('Update of %s failed: %s' % (this, e))
+            stats.add('failures', 1)
+        stats.add('equities', 1)
+
+    def collect(futures, empty=None):
+        for future in as_completed(futures):
+            equity = futures[future]
+            try:
+                fetched = future.result()
+            except Exception as e:
+                logger.error('Fetch of %s failed: %s' % (equity, e))
+                stats.add('failures', 1)
+                stats.add('equities', 1)
+                continue
+            if fetched[1] or empty is None:
+                stats.add('fetched', 1)
+                apply(equity, fetched)
+            else:
+                empty.append(equity)
+
+    unfetched = [equity for equity in remote if equity.id in missed or (equity.id not in batched and not yahoo_up)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, equity, force, key, stats): equity for equity in remote
+                   if yahoo_up and equity.id not in batched and equity.id not in missed}
+        for equity in local:
+            apply(equity)
+        for equity in remote:
+            if equity.id in batched:
+                stats.add('fetched', 1)
+                apply(equity, batched[equity.id])
+        collect(futures, unfetched)
+
+        # What Yahoo did not have,  in priority order for the Alphavantage allowance (not twice in a day unless forced)
+        today = datetime.now().date()
+        candidates = [equity for equity in unfetched if force or not equity.last_updated or equity.last_updated.date() != today]
+        failed = {equity.id for equity in unfetched} if yahoo_up else set()  # Yahoo was tried and had nothing
+        schedule = {}
+        if candidates and keys:  # The response cache answers some without spending the allowance (never when forced)
+            cached = {equity.id for equity in candidates if not force and response_cache.is_cached('alphavantage', {'symbol': equity.key})}
+            schedule = av_schedule([equity for equity in candidates if equity.id not in cached], failed, keys)
+            schedule.update({equity_id: keys[0] for equity_id in cached})
+        futures = {pool.submit(fetch, equity, force, schedule[equity.id], stats, False, True): equity for equity in unfetched if equity.id in schedule}
+        for equity in unfetched:
+            if equity.id not in schedule:
+                stats.add('skipped', 1)
+                apply(equity, (Equity.ypfinance, {}, {}))  # Still fill the holes
+        collect(futures)
+
+    for name, reason in stats.paused.items():
+        API.pause(name, reason)
+    logger.info('Price refresh: %s' % stats)
+    return stats
+
+
+def yahoo_quotes(equities: List[Equity]) -> Dict[int, Tuple[date, float]]:
+    """
+    The latest close (and its date) for many equities from one yf.download call
+    """
+    symbols = {equity.key: equity.id for equity in equities}
+    if not symbols:
+        return {}
+    daily = yf.download(list(symbols), period='5d', interval='1d', auto_adjust=False, group_by='ticker', progress=False, multi_level_index=True)
+    found = set(daily.columns.get_level_values(0)) if isinstance(daily, pd.DataFrame) else set()
+    quotes = {}
+    for symbol, equity_id in symbols.items():
+        if symbol in found:
+            closes = daily[symbol]['Close'].dropna()
+            if not closes.empty:
+                quotes[equity_id] = (closes.index[-1].date(), float(closes.iloc[-1]))
+    return quotes
+
+
+def intraday_refresh() -> int:
+    """
+    This month's price for every searchable equity held in an open account,  from batched Yahoo downloads.
+    Only the current month EquityValue rows are written and only the accounts holding a changed equity are marked
+    dirty (from this month).   Returns the number of prices written
+    """
+    if not API.status('ypfinance'):
+        logger.info('Intraday refresh skipped,  ypfinance API is down')
+        return 0
+
+    month = normalize_today()
+    equities = list(Equity.objects.filter(equity_type='Equity', searchable=True, validated=True,
+                                          transaction__account__in=Account.objects.filter(_end__isnull=True)).distinct())
+    quotes = {}
+    for start in range(0, len(equities), YAHOO_BATCH):
+        BUCKETS[Equity.ypfinance].acquire()
+        try:
+            quotes.update(yahoo_quotes(equities[start:start + YAHOO_BATCH]))
+        except Exception as e:
+            logger.error('Intraday Yahoo download failed: %s' % e)
+    quotes = {equity_id: quote for equity_id, quote in quotes.items() if normalize_date(quote[0]) == month}
+
+    existing = {value.equity_id: value for value in EquityValue.objects.filter(equity_id__in=quotes, date=month)}
+    created = []
+    updated = []
+    for equity_id, (real_date, price) in quotes.items():
+        value = existing.get(equity_id)
+        if not value:
+            created.append(EquityValue(equity_id=equity_id, date=month, real_date=real_date, price=price, source=DataSource.API.value, api=Equity.ypfinance))
+        elif not value.split_fixed and value.source >= DataSource.API.value and value.api >= Equity.ypfinance and \
+                (value.price != price or value.source != DataSource.API.value):
+            value.price, value.real_date, value.source, value.api = price, real_date, DataSource.API.value, Equity.ypfinance
+            updated.append(value)
+    with atomic():
+        EquityValue.objects.bulk_create(created, batch_size=500)
+        EquityValue.objects.bulk_update(updated, ['price', 'real_date', 'source', 'api'], batch_size=500)
+
+    changed = {value.equity_id for value in created + updated}
+    if changed:
+        closed = Account.objects.filter(_end__isnull=False).values_list('id', flat=True)
+        CacheDependencies.invalidate([(equity, month) for equity in equities if equity.id in changed], keep=set(closed))
+    logger.info('Intraday refresh: %s equities,  %s quotes,  %s created,  %s updated' %
+                (len(equities), len(quotes), len(created), len(updated)))
+    return len(changed)
@@ -1,17 +1,22 @@
+import csv
 import logging
 import os
 import time
 
 from celery import shared_task
-from datetime import datetime
+from datetime import date, datetime
+from dateutil.relativedelta import relativedelta
+from typing import Dict
 from django.conf import settings
 from django.core.cache import cache
 
 from django.contrib.auth.models import User
-from base.models import Profile
-from base.utils import get_simple_cache
+from base.models import Profile, ImportJob
+from base.utils import DIYImportException, get_simple_cache, normalize_today
 
-from stocks.models import Equity, Inflation, ExchangeRate, Account, Portfolio, Transaction
+from stocks.importers import importer_for
+from stocks.models import Equity, Inflation, ExchangeRate, Account, Portfolio, Transaction, CacheDependencies, remove_duplicates
+from stocks.refresh import refresh_equities, intraday_refresh
 
 logger = logging.getLogger(__name__)
 
@@ -24,10 +29,12 @@ def cleanup_uploads():
 
     cutoff_time = time.time() - 600 # 10 minutes
     directory = settings.MEDIA_ROOT.joinpath('uploads')
+    importing = {os.path.basename(name) for name in
+                 ImportJob.objects.exclude(phase__in=[ImportJob.DONE, ImportJob.FAILED]).values_list('file', flat=True)}
 
     # Process files
     for filename in os.listdir(directory):
-        if get_simple_cache(f'file:{filename}'):
+        if get_simple_cache(f'file:{filename}') or filename in importing:
             continue
 
         file_path = os.path.join(directory, filename)
@@ -39,28 +46,74 @@ def cleanup_uploads():
             os.remove(file_path)
 
 
+@shared_task
+def stock_import(job_id: int):
+    """
+    Import the file of a stocks ImportJob,  then recompute what it touched.   The job records the phase,  row counts
+    and warnings as it goes
+    """
+    job = ImportJob.objects.get(id=job_id)
+    try:
+        job.set_phase(ImportJob.PARSING)
+        with open(settings.MEDIA_ROOT.joinpath(job.file), encoding='utf-8') as upload:
+            reader = csv.reader(upload.read().splitlines())
+        importer = importer_for(job.options.get('csv_type'), job.options.get('currency'), reader, job.user)
+        job.set_phase(ImportJob.APPLYING, rows=len(importer.pd), warnings=importer.warnings)
+        importer.process(bulk=True, recompute=False)
+
+        job.set_phase(ImportJob.RECOMPUTING, applied=importer.applied)
+        importer.recompute()
+        # recompute() rebuilt its own accounts,  anyone else holding the updated equities is now stale
+        equities = {equity for account in importer.accounts.values() for equity in account.equities}
+        CacheDependencies.invalidate([(equity, None) for equity in equities],
+                                     keep=[account.id for account in importer.accounts.values()])
+        job.set_phase(ImportJob.DONE)
+    except UnicodeDecodeError:
+        job.set_phase(ImportJob.FAILED, error='File is invalid.')
+    except DIYImportException as e:
+        job.set_phase(ImportJob.FAILED, error=str(e))
+    except Exception as e:
+        logger.exception('Import job %s failed' % job_id)
+        job.set_phase(ImportJob.FAILED, error=f'Unexpected error: {e}')
+
+
 @shared_task
 def daily_update():
     # Your cleanup logic here
     key = settings.ALPHAVANTAGEAPI_KEY if settings.ALPHAVANTAGEAPI_KEY else None
-    for equity in Equity.objects.all().order_by('last_updated'):
-        # Find useless transactions
+    remove_duplicates()  # Once for every equity,  instead of inside each Equity.update
+    stats = refresh_equities(Equity.objects.all().order_by('last_updated'), force=True, key=key, daily=True)
+
+    # A forced refresh can rewrite any month,  so each account is recomputed from the first month written for an
+    # equity it holds (never later than last month),  or from the first month the BOC data could have changed
+    dirty_from = normalize_today() - relativedelta(months=1)
+    boc_from = min(Inflation.since(), ExchangeRate.since())
+    if Inflation.update() + ExchangeRate.update():
+        dirty_from = min(dirty_from, boc_from)
+
+    changed: Dict[int, date] = {}
+    holders = CacheDependencies.accounts_for([equity.id for equity in stats.changed])
+    for equity, since in stats.changed.items():
+        for account_id in holders.get(equity.id, ()):
+            changed[account_id] = min(since, changed.get(account_id, since))
 
-        equity.update(force=True, key=key, daily=True)
+    for account in Account.objects.all():
+        account_from = min(dirty_from, changed.get(account.id, dirty_from))
+        logger.debug('Refreshing account(%s) %s from %s' % (account.id, account, account_from))
+        account.update_static_values(dirty_from=account_from)
 
-    Inflation.update()
-    ExchangeRate.update()
 
-    for account in Account.objects.all():
-        logger.debug('Resetting account(%s) %s' % (account.id, account))
-        account.reset()
-        account.update_static_values()
+@shared_task
+def remove_duplicate_values():
+    """
+    The duplicate cleanup on its own,  for an ad hoc run (daily_update already does it)
+    """
+    return remove_duplicates()
 
 
 @shared_task
 def hourly_update():
-    for equity in Equity.objects.filter(searchable=True):
-        equity.yp_update(daily=False)
+    intraday_refresh()
 
 
 @shared_task
@@ -79,6 +132,6 @@ def add_to_cache(user_id):
 def equity_new_estimates(equity_id):
     try:
         equity = Equity.objects.get(id=equity_id)
-        equity.fill_equity_value_holes()
+        equity.fill_holes()
     except Equity.DoesNotExist:
         logger.error('Failed to update estimates for equity id %s' % equity_id)
\ No newline at end of file
@@ -1,20 +1,30 @@
 import logging
+import os
+import tempfile
 import numpy as np
 import pandas as pd
+import threading
+import time
 
 from datetime import datetime, date
+from pathlib import Path
 from dateutil.relativedelta import relativedelta
 from freezegun import freeze_time
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 from pandas import Timestamp
 
-from django.test import SimpleTestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.contrib.auth.models import User
 
 from stocks.models import ExchangeRate, Inflation, Equity, EquityEvent, EquityValue, FundValue, Account, Transaction, DataSource, Portfolio, InvestmentAccount, ValueAccount, CashAccount
-from base.models import Profile
+from base import http, response_cache
+from base.models import Profile, API
 
-from base.utils import normalize_date, next_date, normalize_today
+from django.core.cache import cache
+
+from base.utils import normalize_date, next_date, normalize_today, encode_dataframe, decode_dataframe, CACHE_CODECS, CACHE_COMPRESSORS, \
+    cache_dataframe, get_cached_dataframe, clear_cached_dataframe, frame_lru, frame_version_key, get_or_build_dataframe, acquire_frame_lease, \
+    get_stale_dataframe, invalidate_cached_dataframes, stale_grace
 
 from stocks.testing.setup import BasicSetup
 
@@ -117,4 +127,250 @@ class SimpleTests(SimpleTestCase):
     def test_StringTranslations(self):
         self.assertEqual(Transaction.transaction_value('Deposit'), Transaction.FUND)
 
+    def test_dataframe_codec(self):
+        df = pd.DataFrame({'Date': pd.date_range('2022-01-01', periods=3, freq='MS'), 'Equity': ['A', 'B', 'C'], 'Value': [1.5, 2, 3.25]})
+        for codec in CACHE_CODECS:
+            for compression in CACHE_COMPRESSORS:
+                pd.testing.assert_frame_equal(decode_dataframe(encode_dataframe(df, codec, compression)), df)
+        with patch('base.utils.unavailable_codecs', set()), self.assertLogs('base.utils', level='WARNING') as captured:
+            for _ in range(2):
+                payload = encode_dataframe(df, 'missing', 'missing')
+                pd.testing.assert_frame_equal(decode_dataframe(payload), df)  # Falls back to pickle
+        self.assertEqual(payload[len(b'DIYF') + 1:len(b'DIYF') + 3], bytes([CACHE_CODECS['pickle'][0], CACHE_COMPRESSORS['zlib'][0]]))
+        self.assertEqual(len(captured.records), 2)  # Once for the codec and once for the compression
+        self.assertEqual(list(decode_dataframe(df.to_json())['Value']), [1.5, 2, 3.25], 'Original JSON is still readable')
+        with self.assertRaises(TypeError):
+            decode_dataframe(b'junk')
+
+
+
+
+@override_settings(NO_CACHE=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FrameCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        frame_lru.clear()
+        self.builds = 0
+        self.df = pd.DataFrame({'Date': pd.date_range('2022-01-01', periods=3, freq='MS'), 'Value': [1.0, 2.0, 3.0]})
+
+    def test_process_copy(self):
+        cache_dataframe('frame', self.df)
+        with patch('base.utils.decode_dataframe') as decode:
+            first = get_cached_dataframe('frame')
+            first['Extra'] = 1  # Callers may add columns,  it does not leak into the cached copy
+            second = get_cached_dataframe('frame')
+            decode.assert_not_called()
+        pd.testing.assert_frame_equal(second, self.df)
+
+    def test_in_place_changes(self):
+        cache_dataframe('frame', self.df)
+        frame_lru.clear()
+        for _ in range(2):  # Decoded from the cache,  then from the process copy
+            changed = get_cached_dataframe('frame')
+            changed.loc[changed['Value'] > 1, 'Value'] = 0.0
+        pd.testing.assert_frame_equal(get_cached_dataframe('frame'), self.df)
+
+    def test_other_worker_invalidates(self):
+        cache_dataframe('frame', self.df)
+        get_cached_dataframe('frame')
+        cache.set('frame', encode_dataframe(self.df.assign(Value=10.0)))  # Another worker rebuilt it
+        cache.set(frame_version_key('frame'), 1)
+        with patch('base.utils.decode_dataframe', wraps=decode_dataframe) as decode:
+            self.assertEqual(list(get_cached_dataframe('frame')['Value']), [10.0, 10.0, 10.0])
+            get_cached_dataframe('frame')
+            self.assertEqual(decode.call_count, 1)
+
+        clear_cached_dataframe('frame')
+        self.assertTrue(get_cached_dataframe('frame').empty)
+
+    def test_legacy_entry(self):
+        cache.set('frame', encode_dataframe(self.df))  # Cached before frames had a version
+        pd.testing.assert_frame_equal(get_cached_dataframe('frame'), self.df)
+        self.assertIsNotNone(cache.get(frame_version_key('frame')))
+        with patch('base.utils.decode_dataframe') as decode:
+            get_cached_dataframe('frame')
+            decode.assert_not_called()
+
+        clear_cached_dataframe('frame')  # A cleared frame is not mistaken for a legacy one
+        self.assertTrue(get_cached_dataframe('frame').empty)
+
+    def test_dropped_stale_copy(self):
+        with freeze_time('2023-05-17 10:00:00') as frozen:
+            cache_dataframe('frame', self.df)
+            invalidate_cached_dataframes(drop=['frame'])
+            self.assertTrue(get_cached_dataframe('frame').empty)
+            pd.testing.assert_frame_equal(get_stale_dataframe('frame'), self.df)  # Within the grace window
+            frozen.tick(stale_grace() + 1)
+            self.assertTrue(get_stale_dataframe('frame').empty)
+            self.assertTrue(get_cached_dataframe('frame').empty)
+
+    def test_byte_limit(self):
+        size = int(self.df.memory_usage(index=True).sum())
+        with self.settings(DATAFRAME_LRU_BYTES=size * 2):
+            for key in ['a', 'b', 'c']:
+                cache_dataframe(key, self.df)
+            self.assertEqual(list(frame_lru.frames.keys()), ['b', 'c'])
+            self.assertEqual(frame_lru.bytes, size * 2)
+
+    def slow_build(self):
+        self.builds += 1
+        time.sleep(0.2)
+        cache_dataframe('frame', self.df)
+        return self.df
+
+    def test_single_flight(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_build_dataframe('frame', self.slow_build))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(len(results), 8)
+        for result in results:
+            pd.testing.assert_frame_equal(result, self.df)
+
+    def test_stale_while_rebuilding(self):
+        cache_dataframe('frame', self.df.assign(Value=10.0))
+        clear_cached_dataframe('frame')
+        self.assertTrue(acquire_frame_lease('frame'))  # Another worker is building it
+        self.assertEqual(list(get_or_build_dataframe('frame', self.slow_build)['Value']), [10.0, 10.0, 10.0])
+        self.assertEqual(self.builds, 0)
+
+        cache.clear()  # No stale copy and a builder that never finishes,  wait out the lease and build it
+        self.assertTrue(acquire_frame_lease('frame'))
+        with self.settings(DATAFRAME_BUILD_LEASE=0.2):
+            pd.testing.assert_frame_equal(get_or_build_dataframe('frame', self.slow_build), self.df)
+        self.assertEqual(self.builds, 1)
+
+
+@patch('base.http.sleep')
+class APIClientTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        http.reset_stats()
+        API.objects.create(name='BOC', base='http://foo/', _active=True)
+
+    @patch('requests.Session.get')
+    def test_retry(self, get, _):
+        get.side_effect = [Mock(status_code=503), Mock(status_code=200)]
+        self.assertEqual(API.get('BOC', 'bar').status_code, 200)
+        get.assert_called_with('http://foo/bar', timeout=http.TIMEOUT)
+        stats = API.stats()['BOC']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (2, 1, 1))
+
+    @patch('requests.Session.get')
+    def test_gives_up(self, get, pause):
+        get.side_effect = http.requests.exceptions.ReadTimeout('hung')
+        result = API.get('BOC', 'bar')
+        self.assertEqual((result.status_code, result.reason), (500, 'Read Timeout'))
+        self.assertEqual(get.call_count, http.RETRIES + 1)
+        self.assertEqual(API.stats()['BOC']['errors'], http.RETRIES + 1)
+        self.assertFalse(API.status('BOC'))  # Paused
+
+    def test_session(self, _):
+        self.assertIs(http.session('BOC'), http.session('BOC'))
+        self.assertIsNot(http.session('BOC'), http.session('AVURL'))
+
+    def test_status_ttl(self, _):
+        with patch.object(API, 'STATUS_TTL', 60):
+            API.LOADED.clear()
+            self.assertTrue(API.status('BOC'))
+            API.objects.filter(name='BOC').update(_active=False, _last_fail=datetime.now())  # Behind the model's back
+            self.assertTrue(API.status('BOC'))  # Still the copy in memory
+            API.pause('BOC', 'Testing')  # Through the model
+            self.assertFalse(API.status('BOC'))
+            API.LOADED.clear()
+
+    @override_settings(NO_CACHE=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_pause_other_process(self, _):
+        cache.clear()
+        with patch.object(API, 'STATUS_TTL', 60):
+            API.LOADED.clear()
+            self.assertTrue(API.status('BOC'))
+            loaded = dict(API.LOADED)
+            API.pause('BOC', 'Rate Limit Exceeded')  # In another worker,  it only drops its own copy
+            API.LOADED.update(loaded)
+            self.assertFalse(API.status('BOC'))  # The version in the shared cache moved on
+            API.LOADED.clear()
+
+
+@freeze_time('2023-05-17')
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = patch.multiple(response_cache, ENABLED=True, DIRECTORY=Path(self.directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+        self.calls = []
+
+    def load(self, since):
+        self.calls.append(since)
+        series = {date(2023, 3, 1): 1.0, date(2023, 4, 1): 2.0, date(2023, 5, 1): 3.0 + len(self.calls)}
+        return {key: value for key, value in series.items() if not since or key >= since}
+
+    def test_cached(self):
+        first = response_cache.cached_series('boc', {'series': 'X'}, self.load)
+        self.assertEqual(first[date(2023, 5, 1)], 4.0)
+        self.assertEqual(response_cache.cached_series('boc', {'series': 'X'}, self.load), first)
+        self.assertEqual(self.calls, [None])
+        response_cache.cached_series('boc', {'series': 'Y'}, self.load)  # Different parameters
+        self.assertEqual(self.calls, [None, None])
+
+    def test_current_expires(self):
+        response_cache.cached_series('ypfinance', {'symbol': 'X'}, self.load)
+        with freeze_time('2023-05-17 02:00:00'):  # Past the ypfinance TTL,  the history is still good
+            result = response_cache.cached_series('ypfinance', {'symbol': 'X'}, self.load)
+        self.assertEqual(self.calls, [None, date(2023, 5, 1)])
+        self.assertEqual(result, {date(2023, 3, 1): 1.0, date(2023, 4, 1): 2.0, date(2023, 5, 1): 5.0})
+        with freeze_time('2023-06-02'):  # A new month,  May is history now
+            response_cache.cached_series('ypfinance', {'symbol': 'X'}, self.load)
+        self.assertEqual(self.calls[-1], None)
+
+    def test_partial_load_merged(self):
+        def load(since):
+            self.calls.append(since)
+            series = {date(2003, 1, 1): 1.0, date(2023, 4, 1): 2.0 + len(self.calls), date(2023, 5, 1): 3.0}
+            return {key: value for key, value in series.items() if not since or key >= date(2023, 4, 1)}  # Like Yahoo's 1mo
+
+        response_cache.cached_series('ypfinance', {'symbol': 'X'}, load)
+        for hour in (2, 4):  # The current part expires twice
+            with freeze_time(f'2023-05-17 0{hour}:00:00'):
+                result = response_cache.cached_series('ypfinance', {'symbol': 'X'}, load)
+            self.assertEqual(set(result), {date(2003, 1, 1), date(2023, 4, 1), date(2023, 5, 1)})  # Still the full series
+        self.assertEqual(self.calls, [None, date(2023, 5, 1), date(2023, 5, 1)])
+        self.assertEqual(result[date(2023, 4, 1)], 5.0)  # The newer copy of last month
+
+    def test_refresh(self):
+        history = {date(2023, 3, 1): 1.0, date(2023, 4, 1): 2.0}
+
+        def load(since):
+            self.calls.append(since)
+            return {**history, date(2023, 5, 1): 3.0}
+
+        response_cache.cached_series('boc', {'series': 'X'}, load)
+        history[date(2023, 3, 1)] = 1.5  # The provider corrected a past month
+        self.assertEqual(response_cache.cached_series('boc', {'series': 'X'}, load)[date(2023, 3, 1)], 1.0)
+        self.assertEqual(response_cache.cached_series('boc', {'series': 'X'}, load, refresh=True)[date(2023, 3, 1)], 1.5)
+        self.assertEqual(response_cache.cached_series('boc', {'series': 'X'}, load)[date(2023, 3, 1)], 1.5)  # Rewritten
+        self.assertEqual(self.calls, [None, None])
+
+    def test_empty_not_cached(self):
+        self.assertEqual(response_cache.cached_series('boc', {}, lambda since: {}), {})
+        self.assertEqual(list(Path(self.directory.name).glob('*.pickle')), [])
 
+    def test_evict(self):
+        response_cache.cached_series('boc', {'series': 'X'}, self.load)
+        entries = list(Path(self.directory.name).glob('*.pickle'))
+        for entry in entries:
+            os.utime(entry, (1, 1))  # Long ago
+        with patch.object(response_cache, 'MAX_BYTES', sum(entry.stat().st_size for entry in entries)):
+            response_cache.cached_series('boc', {'series': 'Y'}, self.load)
+        self.assertFalse(any(entry.exists() for entry in entries))  # The least recently used went
+        self.assertEqual(response_cache.read('boc', {'series': 'Y'}, 'current'), {date(2023, 5, 1): 5.0})
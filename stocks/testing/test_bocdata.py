@@ -1,12 +1,13 @@
 import logging
 
 from datetime import datetime
+from freezegun import freeze_time
 from unittest.mock import patch
 
 from django.test import TestCase
 
-from base.models import API
-from stocks.models import ExchangeRate, Equity, EquityValue
+from base.models import API, DIY_EPOCH
+from stocks.models import ExchangeRate, Equity, EquityValue, Inflation, DataSource
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +31,19 @@ class ExchangeRateTest(TestCase):
         self.assertEqual(ExchangeRate.can_to_us_rate(datetime(2023, 4, 1).date()), 1)
         self.assertEqual(ExchangeRate.us_to_can_rate(datetime(2023, 4, 1).date()), 1)
 
-    @patch('requests.get')
+    def test_convert(self):
+        dates = [datetime(2023, 4, 1).date(), datetime(2023, 5, 1).date(), datetime(2023, 6, 1).date(), datetime(2023, 7, 1).date()]
+        self.assertEqual(list(ExchangeRate.convert([10, 10, 10, 10], dates, 'USD', 'CAD')), [10, 11, 12, 13])
+        self.assertEqual(list(ExchangeRate.convert([10, 10, 10, 10], dates, 'CAD', 'USD')), [10, 9.09, 8.33, 7.69])
+        self.assertEqual(list(ExchangeRate.convert([10, 10, 10, 10], dates, 'CAD', 'CAD')), [10, 10, 10, 10])
+
+        ExchangeRate.objects.create(date=datetime(2023, 4, 1).date(), us_to_can=1.0, can_to_us=1.0)  # New data,  no stale table
+        self.assertEqual(ExchangeRate.us_to_can_rate(datetime(2023, 4, 1).date()), 1.0)
+        ExchangeRate.objects.filter(date=datetime(2023, 4, 1).date()).update(us_to_can=1.05)
+        ExchangeRate._reset()
+        self.assertEqual(ExchangeRate.us_to_can_rate(datetime(2023, 4, 1).date()), 1.05)
+
+    @patch('requests.Session.get')
     def test_update(self, my_request):
         json_data = {
             "terms": {"url": "not_used"},
@@ -55,6 +68,24 @@ class ExchangeRateTest(TestCase):
         self.assertEqual(ExchangeRate.can_to_us_rate(test_date), 0.7443)
         self.assertEqual(ExchangeRate.us_to_can_rate(test_date), 1.3435)
 
+    @patch('requests.Session.get')
+    def test_incremental(self, my_request):
+        observations = [{"d": "2023-08-25", "FXCADUSD": {"v": "0.7510"}, "FXUSDCAD": {"v": "1.3315"}},
+                        {"d": "2023-07-31", "FXCADUSD": {"v": "0.769"}, "FXUSDCAD": {"v": "1.3"}}]
+        my_request.return_value.status_code = 200
+        my_request.return_value.json.return_value = {"observations": observations}
+
+        self.assertEqual(ExchangeRate.since(), DIY_EPOCH)  # Nothing from the API yet
+        self.assertEqual(ExchangeRate.update(), 2)  # A new August,  July is now from the API
+        self.assertIn('start_date=2014-01-01', my_request.call_args.args[0])
+        self.assertEqual(ExchangeRate.since(), datetime(2023, 6, 1).date())
+        self.assertEqual(ExchangeRate.update(), 0)  # Nothing changed
+        self.assertIn('start_date=2023-06-01', my_request.call_args.args[0])
+
+        observations[0]["FXCADUSD"]["v"] = "0.7520"  # A revision
+        self.assertEqual(ExchangeRate.update(), 1)
+        self.assertEqual(ExchangeRate.can_to_us_rate(datetime(2023, 8, 1).date()), 0.752)
+
 
 class InflationRateTest(TestCase):
 
@@ -75,3 +106,22 @@ class InflationRateTest(TestCase):
 
         e = Equity.objects.create(symbol='FOO', name='bar', searchable=False, validated=True)
         EquityValue.objects.create(equity=e, date=datetime(2023,5, 1).date(), price=10.0)
+
+    @freeze_time('2022-04-15')
+    @patch('requests.Session.get')
+    def test_update(self, my_request):
+        API.objects.create(name='BOC', base='foo', _active=True)
+        my_request.return_value.status_code = 200
+        my_request.return_value.json.return_value = self.default_data
+        self.assertEqual(Inflation.update(), 4)  # Three months and this month's estimate
+        self.assertAlmostEqual(Inflation.objects.get(date=datetime(2022, 3, 1).date()).inflation, 1.430517711)
+        self.assertEqual(Inflation.objects.get(date=datetime(2022, 4, 1).date()).source, DataSource.ESTIMATE.value)
+
+        self.assertEqual(Inflation.update(), 0)
+        self.assertIn('start_date=2022-01-01', my_request.call_args.args[0])
+
+        my_request.return_value.json.return_value = {"observations": self.default_data['observations'] + [
+            {"d": "2022-04-01", "STATIC_INFLATIONCALC": {"v": "149.90000000"}}]}
+        self.assertEqual(Inflation.update(), 1)  # The estimate is replaced
+        april = Inflation.objects.get(date=datetime(2022, 4, 1).date())
+        self.assertEqual((april.source, april.cost), (DataSource.API.value, 149.9))
@@ -0,0 +1,444 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Sum
+from django.test import override_settings
+from django.utils import timezone
+from pandas.testing import assert_frame_equal
+from unittest.mock import patch, PropertyMock
+
+from stocks.models import Inflation, Transaction, Equity, EquityValue, EquityEvent, FundValue, CacheDependencies, AccountSnapshot, EquitySnapshot, Snapshot, currency_factor, floored_cumsum, compounded_cumsum
+from base.utils import normalize_date, normalize_today, next_date, frame_lru, get_cached_dataframe, get_dirty_month
+
+from stocks.testing.setup import BasicSetup
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_account_df(account) -> pd.DataFrame:
+    """
+    The original month by month InvestmentAccount.account_df,  kept here so we can prove the vectorized version matches it.
+    """
+    equity_df = account.e_pd
+    if equity_df.empty:
+        dividends = {}
+    else:
+        dividends_df = equity_df.groupby('Date', as_index=False)['Dividends'].sum()
+        dividends_df['Date'] = dividends_df['Date'].dt.date
+        dividends = dict(zip(dividends_df['Date'], dividends_df['Dividends']))
+
+    this_date = account.transactions.earliest('date').date
+    final_date = normalize_date(account.end) if account.end else normalize_today()
+    xas = account.transactions
+    xa_dates = list(account.transactions.values_list('date', flat=True).distinct())
+    funds = trans_in = withdraw = trans_out = 0
+    effective = cash = 0
+    df_list = []
+    last_date = this_date
+    while this_date <= final_date:
+        effective = Inflation.inflated(effective, last_date, this_date)
+        last_date = this_date
+        new_cash = 0
+        if this_date in xa_dates:
+            new_funds = xas.filter(xa_action=Transaction.FUND, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+            new_cash = xas.filter(xa_action=Transaction.INTEREST, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+            new_trans_in = xas.filter(xa_action=Transaction.TRANS_IN, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+            new_withdraw = xas.filter(xa_action=Transaction.REDEEM, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+            new_trans_out = xas.filter(xa_action=Transaction.TRANS_OUT, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+            delta = xas.filter(xa_action__in=[Transaction.BUY, Transaction.SELL], date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+
+            funds += new_funds
+            trans_in += new_trans_in
+            withdraw += new_withdraw
+            trans_out += new_trans_out
+
+            new_cash += new_funds + new_withdraw
+            effective += new_cash
+            new_cash += (delta * -1)
+
+        new_cash += dividends[this_date] if this_date in dividends else 0
+        cash += new_cash
+        cash = 0 if (0 > cash < 1) else cash
+        df_list.append({'Date': this_date, 'Funds': funds, 'Redeemed': withdraw, 'TransIn': trans_in, 'TransOut': trans_out, 'NewCash': new_cash, 'Cash': cash, 'Effective': effective})
+        this_date = next_date(this_date)
+
+    df = pd.DataFrame(df_list)
+    df['Date'] = pd.to_datetime(df['Date'])
+    df = df.merge(equity_df.groupby(['Date']).agg({'Cost': 'sum', 'TotalDividends': 'sum', 'Dividends': 'sum', 'Value': 'sum'}).reset_index(),
+                  on='Date', how='left')
+    return df.fillna(0)
+
+
+def legacy_equity_df(account) -> pd.DataFrame:
+    """
+    The original equity by equity,  month by month,  InvestmentAccount.equity_df
+    """
+    data = []
+    for equity in account.equities:
+        xas = account.transactions.filter(equity=equity)
+        if not xas.exists():
+            continue
+        first = xas.earliest('date').date
+        trades = xas.filter(xa_action__in=Transaction.SHARE_TRANSACTIONS).exclude(xa_action=Transaction.REDIV).order_by('date')
+        trade_dates = list(trades.values_list('date', flat=True).distinct())
+        redivs = dict(xas.filter(xa_action=Transaction.REDIV).values_list('date', 'quantity'))
+        rediv_value = dict(xas.filter(xa_action=Transaction.REDIV).values_list('date', 'currency_value'))
+        equity_dividends = {e['date']: e for e in EquityEvent.objects.filter(equity=equity, event_type='Dividend').values('date', 'real_date', 'value')}
+        shares_df = account.shares_df(equity)
+
+        shares = cost = total_dividends = realized_gain = total_spend = total_redeem = avg_cost = 0
+        for entry in EquityValue.objects.filter(date__gte=first, equity=equity).order_by('date'):
+            cf = currency_factor(entry.date, equity.currency, account.currency)
+            start_cost = cost
+            start_shares = shares
+            if entry.date in trade_dates:
+                for trade in trades.filter(date=entry.date):
+                    shares += trade.quantity
+                    if trade.currency_value > 0:
+                        total_spend += trade.currency_value
+                    else:
+                        if avg_cost != 0:
+                            realized_gain += (trade.currency_value * -1) - (trade.quantity * - 1 * avg_cost)
+                        else:
+                            realized_gain += (trade.currency_value * -1) - (trade.quantity * -1 * trade.price)
+                        total_redeem += trade.currency_value * -1
+                    cost += trade.currency_value
+            dividend = 0
+            if not account.managed:
+                if entry.date in equity_dividends:
+                    on_date = account.shares_on_date(shares_df, equity_dividends[entry.date]['real_date'])
+                    dividend = equity_dividends[entry.date]['value'] * cf * on_date
+                total_dividends += dividend
+                realized_gain += dividend
+            if account.managed and entry.date in redivs:
+                shares += redivs[entry.date]
+                total_spend += rediv_value[entry.date]
+                realized_gain += rediv_value[entry.date]
+                cost += rediv_value[entry.date]
+
+            if shares < 1 and start_shares != 0:
+                relgp = (start_cost - realized_gain) * 100 / start_cost if start_cost else 0
+                unrealized_gain = total_redeem - total_spend
+                unrelgp = unrealized_gain * 100 / start_cost if start_cost else 0
+                shares = dividend = value = cost = 0
+            else:
+                value = entry.price * shares * cf
+                relgp = 100 - (cost - realized_gain) * 100 / cost if cost else 0
+                unrealized_gain = value - total_spend + total_redeem if value else 0
+                unrelgp = unrealized_gain * 100 / cost if unrealized_gain and cost else 0
+            avg_cost = total_spend / shares if shares else 0
+            data.append({'Date': entry.date, 'Equity': equity.key, 'Object_ID': equity.id, 'Object_Type': 'Equity', 'Shares': shares, 'Cost': cost,
+                         'Price': entry.price, 'Dividends': dividend, 'TotalDividends': total_dividends, 'Value': value, 'TBuy': total_spend,
+                         'TSell': total_redeem, 'RelGain': realized_gain, 'UnRelGain': unrealized_gain, 'RelGainPct': relgp, 'UnRelGainPct': unrelgp, 'AvgCost': avg_cost})
+    df = pd.DataFrame(data)
+    df['AvgCost'] = df['Cost'] / df['Shares']
+    df.replace([np.inf, -np.inf], 0, inplace=True)
+    df['Date'] = pd.to_datetime(df['Date'])
+    return df
+
+
+def legacy_value_df(account) -> pd.DataFrame:
+    """
+    The original month by month ValueAccount.account_df
+    """
+    equity = Equity.objects.get(symbol=account.f_key)
+    this_date = account.transactions.earliest('date').date
+    final_date = normalize_date(account.end) if account.end else normalize_today()
+    xas = account.transactions
+    values = dict(FundValue.objects.filter(equity=equity).values_list('date', 'value'))
+    funds = trans_in = withdraw = trans_out = 0
+    df_list = []
+    while this_date <= final_date:
+        funds += xas.filter(xa_action=Transaction.FUND, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+        trans_in += xas.filter(xa_action=Transaction.TRANS_IN, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+        withdraw += xas.filter(xa_action=Transaction.REDEEM, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+        trans_out += xas.filter(xa_action=Transaction.TRANS_OUT, date=this_date).aggregate(Sum('value'))['value__sum'] or 0
+        value = values[this_date] if this_date in values else 0
+        df_list.append({'Date': this_date, 'Funds': funds, 'Redeemed': withdraw, 'TransIn': trans_in, 'TransOut': trans_out, 'Value': value})
+        this_date = next_date(this_date)
+
+    df = pd.DataFrame(df_list)
+    df['Date'] = pd.to_datetime(df['Date'])
+    df['Actual'] = df['Value']
+    df['Cash'] = 0
+    df['TotalDividends'] = 0
+    return df
+
+
+class AccountDataFrameTest(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.account = self.investment_account
+        self.account._end = self.months[-1]
+        self.account.save()
+
+    def compare(self):
+        self.account.reset()
+        generated = self.account.account_df
+        expected = legacy_account_df(self.account)
+        numbers = {col: float for col in expected.columns if col != 'Date'}
+        assert_frame_equal(generated[expected.columns].astype(numbers).reset_index(drop=True),
+                           expected.astype(numbers).reset_index(drop=True), check_dtype=False, rtol=1e-9)
+
+    def compare_equities(self):
+        generated = self.account.equity_df()
+        expected = legacy_equity_df(self.account)
+        numbers = {col: float for col in expected.columns if col not in ['Date', 'Equity', 'Object_Type']}
+        assert_frame_equal(generated[expected.columns].astype(numbers), expected.astype(numbers), check_dtype=False, rtol=1e-9)
+
+    def test_basic(self):
+        self.compare()
+        self.compare_equities()
+
+    def test_mixed_activity(self):
+        """
+        Money in/out,  a sale that drives cash negative (clamped to 0),  interest and transfers across the window
+        """
+        Transaction.objects.create(account=self.account, real_date=self.months[1], value=250, xa_action=Transaction.FUND)
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[2], price=20, quantity=60, xa_action=Transaction.BUY)
+        Transaction.objects.create(account=self.account, real_date=self.months[2], value=12.5, xa_action=Transaction.INTEREST)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[3], price=11, quantity=20, xa_action=Transaction.SELL)
+        Transaction.objects.create(account=self.account, real_date=self.months[3], value=-300, xa_action=Transaction.REDEEM)
+        Transaction.objects.create(account=self.account, real_date=self.months[4], value=400, xa_action=Transaction.FUND)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[4], price=10, quantity=5, xa_action=Transaction.TRANS_IN)
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[5], price=20, quantity=10, xa_action=Transaction.TRANS_OUT)
+        self.compare()
+        self.compare_equities()
+
+    def test_sold_out(self):
+        """
+        Sell everything (US equity,  so the exchange rate applies) and buy back in,  with dividends paid in between
+        """
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[1], price=20, quantity=20, xa_action=Transaction.BUY)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[2], price=12, quantity=20, xa_action=Transaction.SELL)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[3], price=13, quantity=30, xa_action=Transaction.SELL)
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[4], price=21, quantity=20, xa_action=Transaction.SELL)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[5], price=9, quantity=10, xa_action=Transaction.BUY)
+        self.compare_equities()
+
+    def test_managed(self):
+        self.account.managed = True
+        self.account.save()
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[2], price=10, quantity=0.25, xa_action=Transaction.REDIV)
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[4], price=10, quantity=0.5, xa_action=Transaction.REDIV)
+        self.compare_equities()
+
+    def test_running_totals(self):
+        values = np.array([100, -250, 50, 75, -10, -400, 1000], dtype=float)
+        cash = 0
+        expected = []
+        for value in values:
+            cash = max(0, cash + value)
+            expected.append(cash)
+        np.testing.assert_allclose(floored_cumsum(values), expected)
+
+        ratios = np.array([1, 1.01, 1.02, 1, 0.99, 1.05, 1], dtype=float)
+        effective = 0
+        expected = []
+        for value, ratio in zip(values, ratios):
+            effective = effective * ratio + value
+            expected.append(effective)
+        np.testing.assert_allclose(compounded_cumsum(values, ratios), expected)
+
+
+@override_settings(NO_CACHE=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class IncrementalRefreshTest(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        frame_lru.clear()
+        self.account = self.investment_account
+        self.account._end = self.months[-1]
+        self.account.save()
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[1], price=20, quantity=20, xa_action=Transaction.BUY)
+
+    def refreshed_matches_rebuild(self, dirty_from):
+        self.account.refresh(dirty_from)
+        refreshed_p = self.account.p_pd
+        refreshed_e = self.account.e_pd
+        self.account.reset()
+        rebuilt_p = self.account.p_pd
+        rebuilt_e = self.account.e_pd
+        assert_frame_equal(refreshed_p.reset_index(drop=True), rebuilt_p.reset_index(drop=True), check_dtype=False, rtol=1e-9)
+        assert_frame_equal(refreshed_e.reset_index(drop=True), rebuilt_e.reset_index(drop=True), check_dtype=False, rtol=1e-9)
+
+    def test_unchanged(self):
+        _ = self.account.p_pd, self.account.e_pd
+        self.refreshed_matches_rebuild(self.months[3])
+
+    def test_late_activity(self):
+        _ = self.account.p_pd, self.account.e_pd
+        Transaction.objects.create(account=self.account, equity=self.equities[0], real_date=self.months[3], price=12, quantity=20, xa_action=Transaction.SELL)
+        Transaction.objects.create(account=self.account, real_date=self.months[3], value=500, xa_action=Transaction.FUND)
+        Transaction.objects.create(account=self.account, real_date=self.months[4], value=-100, xa_action=Transaction.REDEEM)
+        EquityValue.objects.filter(equity=self.equities[1], date__gte=self.months[4]).update(price=25)
+        self.refreshed_matches_rebuild(self.months[3])
+
+    def test_first_month(self):
+        """
+        A dirty month at (or before) the start is just a full rebuild
+        """
+        _ = self.account.p_pd, self.account.e_pd
+        Transaction.objects.create(account=self.account, real_date=self.months[0], value=50, xa_action=Transaction.FUND)
+        self.refreshed_matches_rebuild(self.months[0])
+
+
+@override_settings(NO_CACHE=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheDependencyTest(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        frame_lru.clear()
+        self.accounts = [self.investment_account, self.target_investment_account]
+        Transaction.objects.create(account=self.target_investment_account, real_date=self.months[0], value=500, xa_action=Transaction.FUND)
+        Transaction.objects.create(account=self.target_investment_account, equity=self.equities[0], real_date=self.months[2], price=10, quantity=20, xa_action=Transaction.BUY)
+        for account in self.accounts:
+            account._end = self.months[-1]
+            account.portfolio = self.portfolio
+            account.save()
+            _ = account.p_pd, account.e_pd
+        _ = self.portfolio.p_pd
+
+    def test_equity_change(self):
+        EquityValue.objects.filter(equity=self.equities[0], date__gte=self.months[3]).update(price=12)
+        CacheDependencies.invalidate([(self.equities[0], self.months[3]), (self.investment_account, self.months[4])])
+        for account in self.accounts:
+            self.assertEqual(get_dirty_month(account.container_cache_key), self.months[3])
+        self.assertTrue(get_cached_dataframe(self.portfolio.container_cache_key).empty)
+
+        for account in self.accounts:
+            refreshed = account.p_pd
+            self.assertIsNone(get_dirty_month(account.container_cache_key))
+            account.reset()
+            assert_frame_equal(refreshed.reset_index(drop=True), account.p_pd.reset_index(drop=True), check_dtype=False, rtol=1e-9)
+
+    def test_history_change(self):
+        CacheDependencies.invalidate([(self.equities[0], self.months[2]), (self.investment_account, None)])
+        self.assertTrue(get_cached_dataframe(self.investment_account.container_cache_key).empty)
+        self.assertTrue(get_cached_dataframe(self.investment_account.component_cache_key).empty)
+        self.assertEqual(get_dirty_month(self.target_investment_account.container_cache_key), self.months[2])
+
+    def test_keep(self):
+        CacheDependencies.invalidate([(self.equities[0], None)], keep=[self.investment_account.id])
+        self.assertFalse(get_cached_dataframe(self.investment_account.container_cache_key).empty)
+        self.assertTrue(get_cached_dataframe(self.target_investment_account.container_cache_key).empty)
+
+    def test_index(self):
+        accounts = {self.investment_account.id, self.target_investment_account.id}
+        self.assertEqual(CacheDependencies.accounts_for([self.equities[0].id]), {self.equities[0].id: accounts})
+        Transaction.objects.create(account=self.value_account, equity=self.equities[0], real_date=self.months[3], price=10, quantity=1, xa_action=Transaction.BUY)
+        self.assertEqual(CacheDependencies.accounts_for([self.equities[0].id]), {self.equities[0].id: accounts | {self.value_account.id}})
+
+
+@override_settings(NO_CACHE=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SnapshotTest(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        frame_lru.clear()
+        self.account = self.investment_account
+        self.account._end = self.months[-1]
+        self.account.save()
+        Transaction.objects.create(account=self.account, equity=self.equities[1], real_date=self.months[2], price=20, quantity=20, xa_action=Transaction.BUY)
+        self.built_p = self.account.p_pd
+        self.built_e = self.account.e_pd
+
+    def flush(self):
+        cache.clear()
+        frame_lru.clear()
+
+    def test_stored(self):
+        self.assertEqual(AccountSnapshot.objects.filter(account=self.account).count(), len(self.built_p))
+        self.assertEqual(EquitySnapshot.objects.filter(account=self.account).count(), len(self.built_e))
+
+    def test_survives_flush(self):
+        self.flush()
+        with patch('stocks.models.InvestmentAccount.account_df', new_callable=PropertyMock) as account_df, \
+                patch('stocks.models.InvestmentAccount.equity_df') as equity_df:
+            assert_frame_equal(self.account.p_pd, self.built_p, check_like=True, check_dtype=False)
+            assert_frame_equal(self.account.e_pd, self.built_e, check_like=True, check_dtype=False)
+            account_df.assert_not_called()
+            equity_df.assert_not_called()
+
+    def test_invalidated(self):
+        CacheDependencies.invalidate([(self.equities[1], self.months[3])])
+        self.assertFalse(AccountSnapshot.objects.filter(account=self.account, date__gte=self.months[3]).exists())
+        self.assertTrue(AccountSnapshot.objects.filter(account=self.account, date__lt=self.months[3]).exists())
+
+        self.flush()  # Lose the dirty mark too,  the incomplete snapshot is not served
+        Transaction.objects.create(account=self.account, real_date=self.months[4], value=100, xa_action=Transaction.FUND)
+        self.assertEqual(self.account.p_pd['Funds'].iloc[-1], self.built_p['Funds'].iloc[-1] + 100)
+
+    def test_expired(self):
+        self.assertTrue(Snapshot.is_current(self.account))
+        AccountSnapshot.objects.filter(account=self.account).update(built=timezone.now() - timedelta(days=3))
+        self.assertFalse(Snapshot.is_current(self.account))
+
+    def test_price_apply_forgets(self):
+        self.equities[1].apply_external_equity_data(Equity.ypfinance, {self.months[4]: (99.0, 0.0)}, {})
+        self.assertFalse(AccountSnapshot.objects.filter(account=self.account, date__gte=self.months[4]).exists())
+        self.assertTrue(AccountSnapshot.objects.filter(account=self.account, date__lt=self.months[4]).exists())
+
+    def test_refresh_after_flush(self):
+        EquityValue.objects.filter(equity=self.equities[1], date__gte=self.months[4]).update(price=25)
+        CacheDependencies.invalidate([(self.equities[1], self.months[4])])
+        self.flush()
+        self.account.refresh(self.months[4])
+        refreshed_p, refreshed_e = self.account.p_pd, self.account.e_pd
+        self.account.reset()
+        assert_frame_equal(refreshed_p, self.account.p_pd, check_like=True, check_dtype=False)
+        assert_frame_equal(refreshed_e, self.account.e_pd, check_like=True, check_dtype=False)
+
+
+class FundDataFrameTest(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        for account in [self.value_account, self.cash_account]:
+            account._end = self.months[-1]
+            account.save()
+
+    def test_value_account(self):
+        Transaction.objects.create(account=self.value_account, real_date=self.months[2], value=250, xa_action=Transaction.FUND)
+        Transaction.objects.create(account=self.value_account, real_date=self.months[3], value=-100, xa_action=Transaction.REDEEM)
+        Transaction.objects.create(account=self.value_account, real_date=self.months[4], value=75, xa_action=Transaction.TRANS_IN)
+        FundValue.objects.filter(equity=self.value_equity, date=self.months[3]).delete()  # A hole is a 0 value
+
+        generated = self.value_account.account_df
+        expected = legacy_value_df(self.value_account)
+        assert_frame_equal(generated[expected.columns], expected, check_dtype=False)
+
+    def test_cash_account(self):
+        FundValue.objects.filter(equity=self.cash_equity, date=self.months[2]).delete()
+        generated = self.cash_account.account_df
+        self.assertEqual(list(generated['Date']), self.months)
+        self.assertEqual(list(generated['Value']), [500, 500, 0, 500, 500, 500])
+        self.assertEqual(list(generated['Effective']), list(generated['Value']))
+        self.assertEqual(list(generated['Funds']), [0] * 6)
+
+
+class InflationIndexTest(BasicSetup):
+
+    def test_inflate(self):
+        values = np.array([100, 200, 300, 400, 500, 600], dtype=float)
+        result = Inflation.inflate(values, self.months[0], self.months)
+        expected = [value + value * (inflation['cost'] - 145.3) / 145.3 for value, inflation in zip(values, self.inflation)]
+        np.testing.assert_allclose(result, expected)
+
+        self.assertAlmostEqual(Inflation.inflated(100, self.months[1], self.months[5]), 100 * 152.9 / 146.8)
+        self.assertEqual(Inflation.inflated(100, self.months[1], next_date(self.months[5])), 100, 'No CPI, no change')
+        np.testing.assert_allclose(Inflation.monthly_ratios(pd.DatetimeIndex(self.months + [next_date(self.months[5])])),
+                                   [1, 146.8 / 145.3, 148.9 / 146.8, 149.8 / 148.9, 151.9 / 149.8, 152.9 / 151.9, 1])
+
+    def test_reload(self):
+        Inflation.cpi_index()
+        Inflation.objects.create(date=next_date(self.months[5]), cost=160, inflation=4.6)
+        self.assertAlmostEqual(Inflation.inflated(100, self.months[5], next_date(self.months[5])), 100 * 160 / 152.9)
@@ -6,7 +6,7 @@ from unittest.mock import patch, Mock
 
 from django.test import TestCase
 
-from stocks.models import Equity, EquityEvent, EquityValue, DataSource, FundValue, Account
+from stocks.models import Equity, EquityEvent, EquityValue, DataSource, FundValue, Account, remove_duplicates
 from stocks.testing.setup import DEFAULT_LOOKUP, DEFAULT_QUERY
 
 logger = logging.getLogger(__name__)
@@ -110,3 +110,60 @@ class BasicSetup(TestCase):
             self.equity.fill_holes()
             mock_save.assert_not_called()
 
+    @freeze_time("2023-02-01")
+    def test_fill_stale_estimates(self):
+        self.equity.fill_holes()
+        EquityValue.objects.filter(equity=self.equity, date=datetime(2022, 6, 1).date()).update(price=16.0)  # A better price arrived
+        EquityValue.objects.filter(equity=self.equity, date=datetime(2023, 2, 1).date()).delete()
+        with patch.object(EquityValue, 'save', autospec=True) as mock_save:
+            self.equity.fill_holes()
+            mock_save.assert_not_called()  # Bulk writes only
+        prices = dict(EquityValue.objects.filter(equity=self.equity).values_list('date', 'price'))
+        self.assertEqual(prices[datetime(2022, 4, 1).date()], 12.0)
+        self.assertEqual(prices[datetime(2022, 5, 1).date()], 14.0)
+        self.assertEqual(prices[datetime(2022, 9, 1).date()], 11.5)
+        self.assertEqual(prices[datetime(2023, 2, 1).date()], 7.0)
+        self.assertEqual(EquityValue.objects.get(equity=self.equity, date=datetime(2022, 4, 1).date()).source, DataSource.ESTIMATE.value)
+
+    def test_apply_external_data(self):
+        months = [datetime(2022, month, 1).date() for month in [3, 6, 9, 12]]
+        EquityValue.objects.filter(equity=self.equity).update(api=Equity.ypfinance)
+        EquityValue.objects.filter(equity=self.equity, date=months[1]).update(split_fixed=True)
+        EquityEvent.objects.create(equity=self.equity, real_date=datetime(2022, 3, 10).date(), value=0.5, event_type='Dividend',
+                                   api=Equity.ypfinance, source=DataSource.API.value)
+        results = {months[0]: (11.0, 0.5),  # Better price,  same dividend paid on a different day
+                   months[1]: (25.0, 0.0),  # Split fixed,  leave it alone
+                   months[2]: (14.0, 0.2),  # New price and dividend
+                   months[3]: (7.0, 0.0)}   # Nothing changed
+        with patch.object(EquityValue, 'save') as value_save, patch.object(EquityEvent, 'save') as event_save:
+            counts = self.equity.apply_external_equity_data(Equity.ypfinance, results, {months[0]: datetime(2022, 3, 15).date()})
+            value_save.assert_not_called()  # All bulk writes
+            event_save.assert_not_called()
+        self.assertEqual(counts, {'inserted': 2, 'updated': 2, 'unchanged': 2, 'since': months[0]})
+
+        prices = dict(EquityValue.objects.filter(equity=self.equity).values_list('date', 'price'))
+        self.assertEqual(prices, {months[0]: 11.0, months[1]: 13.0, months[2]: 14.0, months[3]: 7.0})
+        events = {event.date: (event.real_date, event.value) for event in EquityEvent.objects.filter(equity=self.equity)}
+        self.assertEqual(events, {months[0]: (datetime(2022, 3, 15).date(), 0.5), months[2]: (months[2], 0.2)})
+
+        counts = self.equity.apply_external_equity_data(Equity.alphavantage, {months[0]: (12.0, 0.75)}, {})  # A lesser API
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'unchanged': 2, 'since': None})
+        self.assertEqual(EquityValue.objects.get(equity=self.equity, date=months[0]).price, 11.0)
+
+    def test_remove_duplicates(self):
+        other = Equity.objects.create(symbol='o', equity_type='Equity', name='other', searchable=False, validated=True)
+        def dividend(equity, real_date, source, value):
+            return EquityEvent.objects.create(equity=equity, real_date=real_date, value=value, event_type='Dividend', source=source)
+
+        early = dividend(self.equity, datetime(2022, 3, 2).date(), DataSource.USER.value, 0.1)
+        best = dividend(self.equity, datetime(2022, 3, 5).date(), DataSource.API.value, 0.2)  # Best source wins
+        dividend(self.equity, datetime(2022, 3, 20).date(), DataSource.ESTIMATE.value, 0.3)
+        dividend(other, datetime(2022, 3, 2).date(), DataSource.API.value, 0.4)
+        latest = dividend(other, datetime(2022, 3, 9).date(), DataSource.API.value, 0.5)  # Same source,  latest wins
+        single = dividend(other, datetime(2022, 4, 9).date(), DataSource.API.value, 0.6)
+        EquityEvent.objects.create(equity=self.equity, real_date=early.real_date, value=2, event_type='Split', source=DataSource.API.value)
+
+        self.assertEqual(remove_duplicates(), {'EquityValue': 0, 'FundValue': 0, 'EquityEvent': 3})
+        self.assertEqual(set(EquityEvent.objects.filter(event_type='Dividend').values_list('id', flat=True)), {best.id, latest.id, single.id})
+        self.assertEqual(EquityEvent.objects.filter(event_type='Split').count(), 1)
+        self.assertEqual(remove_duplicates()['EquityEvent'], 0)
@@ -1,14 +1,24 @@
 import csv
+import io
 import logging
+import os
 
 from copy import deepcopy
 from datetime import datetime
 from freezegun import freeze_time
 from unittest.mock import patch, Mock
 
-from django.test import TestCase
-from stocks.importers import QuestTrade, FUND, BUY, SELL, DIV, REDEEM, JUNK, SPLIT
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.test import Client, SimpleTestCase, TestCase
+from django.urls import reverse
+from stocks.importers import Manulife, QuestTrade, SymbolResolver, FUND, BUY, SELL, DIV, REDEEM, JUNK, SPLIT
+from stocks.management.commands.import_benchmark import Command as ImportBenchmark
+from base.models import ImportJob, Profile
 from stocks.models import Equity, EquityAlias, EquityEvent, EquityValue, Account, Transaction, DataSource
+from stocks.tasks import stock_import
 from stocks.testing.setup import DEFAULT_QUERY, DEFAULT_LOOKUP
 
 logger = logging.getLogger(__name__)
@@ -118,7 +128,7 @@ class BasicSetup(TestCase):
         self.assertEqual(my_obj.pd.iloc[1]['XAType'], Transaction.FUND, 'Funding record parsed')
         self.assertEqual(my_obj.pd.iloc[1]['Amount'], 1000.0, 'Funding amount parsed')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_lookups_1(self, get):
         """
         When I use the API,  it will return a different discription.    I should make an alias with both the
@@ -137,7 +147,7 @@ class BasicSetup(TestCase):
         self.assertEqual(len(my_obj.equities), 2, 'Added one')
 
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_equities_1(self, get):
         data = [self.csv_header, '2020-03-03 12:00:00 AM,Buy,MYE.TO,x,BCE,50.0,10.0,-5.0,-505.0,CAD,123,Trades,x']
         get.side_effect = [self.mock_lookup, self.mock_empty, self.mock_empty]
@@ -146,7 +156,7 @@ class BasicSetup(TestCase):
         my_obj.process()
         self.assertEqual(len(my_obj.equities), 1, 'Added one')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_equities_2(self, get):
         data = [self.csv_header,
                 '2020-03-22 12:00:00 AM,Buy,MYE.TO,x,BCE,50.0,10.0,-5.0,-505.0,CAD,123,Trades,x',
@@ -158,7 +168,7 @@ class BasicSetup(TestCase):
         my_obj.process()
         self.assertEqual(len(my_obj.equities), 1, 'Added just one')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_XAs(self, get):
         data_text = [
             self.csv_header,
@@ -186,7 +196,7 @@ class BasicSetup(TestCase):
         self.assertTrue(e.validated)
         self.assertTrue(e.searchable)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_rebuy1(self, get):
         data_text = [
             self.csv_header,
@@ -206,7 +216,7 @@ class BasicSetup(TestCase):
         self.assertEqual(Transaction.objects.count(), 2, 'Initial extra BUYS')
 
     @freeze_time('2022-12-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_import_split_fail(self, get):
         data = [
             'Transaction Date,Settlement Date,Action,Symbol,Description,Quantity,Price,Gross Amount,Commission,Net Amount,Currency,Account #,Activity Type,Account Type',
@@ -225,7 +235,7 @@ class BasicSetup(TestCase):
         self.assertEqual(len(my_obj.warnings), 1, 'Split ignored')
 
     @freeze_time('2022-12-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_import_nostub_fail(self, get):
         data = [
             'Transaction Date,Settlement Date,Action,Symbol,Description,Quantity,Price,Gross Amount,Commission,Net Amount,Currency,Account #,Activity Type,Account Type',
@@ -245,7 +255,7 @@ class BasicSetup(TestCase):
         self.assertEqual(p.name, 'k', 'No STUB value expected')
 
     @freeze_time('2020-12-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_import_search_fail(self, get):
         data = [
             'Transaction Date,Settlement Date,Action,Symbol,Description,Quantity,Price,Gross Amount,Commission,Net Amount,Currency,Account #,Activity Type,Account Type',
@@ -278,7 +288,7 @@ class BasicSetup(TestCase):
                          'Estimate the rest')
 
     @freeze_time('2020-09-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_equity_alias(self, get):
         'MYE this is better Inc'
         data_text = [
@@ -315,7 +325,7 @@ class BasicSetup(TestCase):
         self.assertEqual(Equity.objects.filter(symbol='MYF').count(), 2, '2 MYFs')
 
     @freeze_time('2020-09-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_buy_and_sell(self, get):
         data_text = [
             self.csv_header,
@@ -348,7 +358,7 @@ class BasicSetup(TestCase):
         self.assertEqual(e.source, DataSource.ESTIMATE.value)
 
     @freeze_time('2020-09-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_div_api(self, get):
         data_text = [
             self.csv_header,
@@ -377,7 +387,7 @@ class BasicSetup(TestCase):
         self.assertEqual(ev.source, DataSource.API.value)
 
     @freeze_time('2020-09-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_div_bad(self, get):
         data_text = [
             self.csv_header,
@@ -392,7 +402,7 @@ class BasicSetup(TestCase):
             self.assertEqual(str(context.exception), "Failed to lookup OTHER - Other Equity")
 
     @freeze_time('2020-09-01')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_div_upload(self, get):
         data_text = [
             self.csv_header,
@@ -626,3 +636,160 @@ class ParsingQT(TestCase):
             self.assertEqual(len(captured.records), 1, 'Log an error')
             self.assertEqual(captured.records[0].levelname, 'ERROR', 'Error')
             self.assertTrue(captured.records[0].msg.startswith('Unexpected XA value'), 'Error in log')
+
+
+class ImporterFrameTest(SimpleTestCase):
+
+    def test_questtrade(self):
+        importer = QuestTrade('CAD', csv.reader(io.StringIO(ImportBenchmark.questtrade(300))), None)
+        self.assertEqual(len(importer.pd), 300)
+        self.assertTrue(importer.pd['Date'].is_monotonic_increasing)
+        self.assertEqual(set(importer.pd['XAType']), {BUY, SELL, DIV})
+        row = next(importer.pd.itertuples(index=False))
+        self.assertEqual(importer.pd_date(row), datetime(2010, 1, 4).date())
+        self.assertIsInstance(importer.pd_xa_type(row), int)
+        self.assertTrue(importer.pd_account_key(row).startswith('QuestTrade_'))
+        self.assertFalse(importer.pd_symbol(row).startswith('.'))
+        self.assertEqual(row.Fees, '-9.95' if row.XAType != DIV else '0')  # Extra columns come along
+
+    def test_manulife(self):
+        importer = Manulife('CAD', csv.reader(io.StringIO(ImportBenchmark.manulife(300))), None)
+        self.assertEqual(len(importer.pd), 300)
+        self.assertEqual(ImportBenchmark.walk(importer), 300)
+
+    def test_benchmark(self):
+        output = io.StringIO()
+        call_command('import_benchmark', rows=50, repeat=1, stdout=output)
+        self.assertIn('QuestTrade', output.getvalue())
+        self.assertIn('Manulife', output.getvalue())
+
+
+class BulkProcessTest(TestCase):
+
+    data = ['Settlement Date,Action,Symbol,Description,Quantity,Price,Commission,Net Amount,Currency,Account #,Activity Type,Account Type',
+            '2020-01-02 12:00:00 AM,,,,0,0,0,1000,CAD,123,Deposits,TFSA',
+            '2020-01-15 12:00:00 AM,Buy,AAA,AAA Corp,10,20,-5,-205,CAD,123,Trades,TFSA',
+            '2020-02-10 12:00:00 AM,Buy,BBB,BBB Fund,5,30,0,-150,USD,123,Trades,TFSA',
+            '2020-03-05 12:00:00 AM,Sell,AAA,AAA Corp,-5,25,-5,120,CAD,123,Trades,TFSA']
+
+    def setUp(self):
+        super().setUp()
+        Equity.objects.create(symbol='AAA.TO', name='AAA Corp', currency='CAD', region='Canada', searchable=True, validated=True)
+        Equity.objects.create(symbol='BBB', name='BBB Fund', currency='USD', region='US', searchable=False, validated=True)
+
+    def imported(self, username: str, bulk: bool):
+        user = User.objects.create(username=username)
+        Profile.objects.create(user=user)
+        with patch.object(Equity, 'fill_holes'), patch.object(Account, 'update_static_values'):
+            importer = QuestTrade('CAD', csv.reader(self.data), user)
+            importer.process(bulk=bulk)
+        return list(Transaction.objects.filter(user=user).order_by('real_date', 'id').values_list(
+            'equity__symbol', 'real_date', 'date', 'xa_action', 'quantity', 'price', 'value', 'currency_value'))
+
+    def test_bulk_matches(self):
+        bulk = self.imported('bulk', True)
+        value = EquityValue.objects.get(equity__symbol='BBB')
+        self.assertEqual((value.date, value.real_date, value.price, value.source),
+                         (datetime(2020, 2, 1).date(), datetime(2020, 2, 10).date(), 30.0, DataSource.UPLOAD.value))
+        self.assertEqual(Account.objects.get(user__username='bulk').last_import, datetime(2020, 3, 5).date())
+
+        self.assertEqual(len(bulk), 4)
+        self.assertEqual(bulk, self.imported('row', False))  # Row by row gives the same transactions
+        self.assertEqual(EquityValue.objects.filter(equity__symbol='BBB').count(), 1)
+
+
+class SymbolResolverTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.aaa = Equity.objects.create(symbol='AAA.TO', name='AAA Corp', currency='CAD', region='Canada', searchable=True)
+        self.bbb = Equity.objects.create(symbol='BBB', name='BBB Fund', currency='USD', region='US', searchable=False)
+        self.xlu = Equity.objects.create(symbol='XLU', name='Utilities', currency='USD', region='US', searchable=True)
+        EquityAlias.objects.create(symbol='S007135', name='BBB FUND SERIES F', region='US', equity=self.bbb)
+        EquityAlias.objects.create(symbol='XLU.US', name='SELECT SECTOR SPDR TRUST', region='US', equity=self.xlu)
+
+    def test_index(self):
+        resolver = SymbolResolver()
+        with self.assertNumQueries(2):
+            resolver.index([('AAA.TO', 'AAA Corp', 'Canada'), ('S007135', 'whatever', 'US'), ('', 'SELECT SECTOR SPDR TRUST', 'US'),
+                            ('ZZZ', 'Nobody', 'US')])
+            self.assertEqual(resolver.find('AAA.TO', 'AAA Corp', 'Canada'), self.aaa)
+            self.assertEqual(resolver.find('S007135', 'whatever', 'US'), self.bbb)  # By alias symbol
+            self.assertEqual(resolver.find('', 'SELECT SECTOR SPDR TRUST', 'US'), self.xlu)  # By alias name
+            self.assertIsNone(resolver.find('', 'SELECT SECTOR SPDR TRUST', 'Canada'))
+            self.assertIsNone(resolver.find('ZZZ', 'Nobody', 'US'))
+
+    def test_create(self):
+        resolver = SymbolResolver(workers=2)
+        new = [('AAA.TO', 'AAA Corp', 'CAD', 'Canada'), ('NEW', 'New Co', 'USD', 'US'), ('NEW', 'NEW CO INC', 'USD', 'US'),
+               ('OTHER', 'Other ETF', 'USD', 'US')]
+        resolver.index([(symbol, name, region) for symbol, name, _, region in new])
+        with patch.object(Equity, 'lookup', side_effect=lambda symbol, region: f'{symbol}X') as lookup:
+            resolver.create(new, False)
+        self.assertEqual(sorted(call.args for call in lookup.call_args_list), [('NEW', 'US'), ('OTHER', 'US')])  # Only the unknown,  once
+        self.assertEqual(Equity.objects.filter(symbol='NEWX').count(), 1)
+        self.assertEqual(resolver.find('OTHER', 'Other ETF', 'US').symbol, 'OTHERX')
+
+        resolver.alias('NEW.US', 'New Co', 'US', resolver.find('NEW', 'New Co', 'US'))
+        resolver.alias('NEW.US', 'New Co', 'US', resolver.find('NEW', 'New Co', 'US'))
+        resolver.alias('XLU.US', 'SELECT SECTOR SPDR TRUST', 'US', self.xlu)  # Already there
+        with self.assertNumQueries(2):
+            resolver.save()
+        self.assertEqual(EquityAlias.objects.filter(symbol='NEW.US').count(), 1)
+        self.assertEqual(EquityAlias.objects.filter(symbol='XLU.US').count(), 1)
+
+
+class ImportJobTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        Equity.objects.create(symbol='AAA.TO', name='AAA Corp', currency='CAD', region='Canada', searchable=True, validated=True)
+        Equity.objects.create(symbol='BBB', name='BBB Fund', currency='USD', region='US', searchable=False, validated=True)
+        self.user = User.objects.create(username='importer')
+        Profile.objects.create(user=self.user)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def upload(self, content: bytes) -> ImportJob:
+        upload = SimpleUploadedFile('upload.csv', content, content_type='text/plain')
+        with patch('stocks.views.stock_import.delay') as delay:
+            result = self.client.post(reverse('portfolio_upload'), {'csv_type': 'QuestTrade', 'new_account_currency': 'CAD', 'csv_file': upload})
+        job = ImportJob.objects.latest('id')
+        self.assertEqual(result.url, reverse('import_job', kwargs={'pk': job.id}))
+        delay.assert_called_once_with(job.id)
+        self.addCleanup(os.remove, settings.MEDIA_ROOT.joinpath(job.file))
+        return job
+
+    def test_upload(self):
+        job = self.upload('\n'.join(BulkProcessTest.data).encode())
+        self.assertEqual((job.phase, Transaction.objects.count()), (ImportJob.QUEUED, 0))  # Nothing done in the request
+
+        with patch.object(Equity, 'fill_holes'), patch.object(Account, 'update_static_values') as recompute:
+            stock_import(job.id)
+        recompute.assert_called_once()
+        status = self.client.get(reverse('import_job_status', kwargs={'pk': job.id})).json()
+        self.assertEqual((status['phase'], status['finished'], status['rows'], status['applied']), (ImportJob.DONE, True, 4, 4))
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(self.client.get(reverse('import_job', kwargs={'pk': job.id})).status_code, 200)
+
+    def test_recompute_refresh(self):
+        self.user.profile.av_api_key = 'AVKEY'
+        self.user.profile.save()
+        job = self.upload('\n'.join(BulkProcessTest.data).encode())
+        with patch('stocks.importers.refresh_equities') as refresh, patch.object(Account, 'update_static_values'):
+            stock_import(job.id)
+        refresh.assert_called_once()
+        equities, = refresh.call_args.args
+        self.assertTrue(equities)
+        self.assertEqual(len(equities), len({equity.id for equity in equities}))  # Each equity once
+        self.assertEqual(refresh.call_args.kwargs, {'key': 'AVKEY', 'daily': False})
+
+    def test_failed(self):
+        job = self.upload(b'\xff\xfe not text')
+        stock_import(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.phase, job.error), (ImportJob.FAILED, 'File is invalid.'))
+
+        other = User.objects.create(username='other')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('import_job_status', kwargs={'pk': job.id})).status_code, 404)
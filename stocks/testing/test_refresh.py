@@ -0,0 +1,265 @@
+import logging
+import pandas as pd
+import tempfile
+import threading
+
+from datetime import datetime
+from pathlib import Path
+from freezegun import freeze_time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from base import response_cache
+from base.models import API, APIBudget
+from stocks.models import Equity, EquityValue, EquityEvent, InvestmentAccount, Transaction, DataSource
+from stocks.refresh import (TokenBucket, RefreshStats, av_priority, av_schedule, fetch, intraday_refresh, refresh_equities,
+                            yahoo_history, yahoo_results)
+from stocks.tasks import daily_update
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertGreater(bucket.acquire(), 0)  # Waits ~1/20s for the next token
+
+    def test_throttled_fetch(self):
+        equity = Equity(symbol='FOO', equity_type='Equity', searchable=True, validated=True)
+        stats = RefreshStats()
+        buckets = {Equity.ypfinance: TokenBucket(rate=100, capacity=1), Equity.alphavantage: TokenBucket(rate=100, capacity=1)}
+        with patch('stocks.refresh.BUCKETS', buckets), patch.object(Equity, 'yp_update', return_value={}) as yp, \
+                patch.object(Equity, 'av_update') as av:
+            self.assertEqual(fetch(equity, False, 'key', stats), (Equity.ypfinance, {}, {}))
+            yp.assert_called_once()
+            av.assert_not_called()  # Not scheduled for an Alphavantage call
+        self.assertEqual(stats.calls[Equity.ypfinance], 1)
+        self.assertEqual(stats.calls[Equity.alphavantage], 0)
+
+
+class YahooHistoryTest(SimpleTestCase):
+
+    @staticmethod
+    def download(tickers, interval, **kwargs):
+        """
+        What yf.download(group_by='ticker') returns,  NaN rows where a ticker has no data for a date
+        """
+        if interval == '1mo':
+            index = pd.to_datetime(['2023-04-01', '2023-05-01', '2023-06-01'])
+            frames = {'AAA': pd.DataFrame({'Close': [10.0, 11.0, 12.0], 'Dividends': [0.0, 0.5, 0.0]}, index=index),
+                      'BBB': pd.DataFrame({'Close': [float('nan'), 20.0, 21.0], 'Dividends': [0.0, 0.0, 0.0]}, index=index)}
+        else:
+            index = pd.to_datetime(['2023-05-12', '2023-05-15', '2023-06-01'])
+            frames = {'AAA': pd.DataFrame({'Close': [11.0, 11.0, 12.0], 'Dividends': [0.5, 0.0, 0.0]}, index=index),
+                      'BBB': pd.DataFrame({'Close': [20.0, 20.0, 21.0], 'Dividends': [0.0, 0.0, 0.0]}, index=index)}
+        return pd.concat({ticker: frames[ticker] for ticker in tickers if ticker in frames}, axis=1)
+
+    def test_history(self):
+        equities = [Equity(id=1, symbol='AAA', equity_type='Equity'), Equity(id=2, symbol='BBB', equity_type='Equity'),
+                    Equity(id=3, symbol='CCC', equity_type='Equity')]
+        with patch('stocks.refresh.yf.download', side_effect=self.download) as download:
+            history = yahoo_history(equities)
+        self.assertEqual(download.call_count, 2)
+        self.assertEqual(list(history['Object_ID']), [1, 1, 1, 2, 2])
+
+        results = yahoo_results(history)
+        self.assertEqual(set(results), {1, 2})
+        api, prices, pay_dates = results[1]
+        self.assertEqual(api, Equity.ypfinance)
+        self.assertEqual(prices[datetime(2023, 5, 1).date()], (11.0, 0.5))
+        self.assertEqual(pay_dates, {datetime(2023, 5, 1).date(): datetime(2023, 5, 12).date()})
+        self.assertEqual(results[2][2], {})
+
+
+class RefreshEquitiesTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.month = datetime(2023, 5, 1).date()
+        self.equities = [Equity.objects.create(symbol=f'EQ{n}', name=f'eq{n}', searchable=True, validated=True) for n in range(6)]
+        for equity in self.equities:
+            EquityValue.objects.create(equity=equity, date=self.month, real_date=self.month, price=10.0)
+
+    @staticmethod
+    def fake_fetch(equity, force=False, key=None, throttle=None, pause=None):
+        if equity.symbol == 'EQ3':
+            raise ValueError('Provider choked')
+        return Equity.ypfinance, {datetime(2023, 5, 1).date(): (float(equity.symbol[-1]) + 1, 0.25)}, {}
+
+    def test_refresh(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        with patch('stocks.refresh.yahoo_history', side_effect=ValueError('Batch choked')), \
+                patch.object(Equity, 'fetch_external_equity_data', autospec=True, side_effect=self.fake_fetch):
+            stats = refresh_equities(Equity.objects.all(), workers=3)
+
+        self.assertEqual(stats.equities, 6)
+        self.assertEqual(stats.fetched, 5)
+        self.assertEqual(stats.failures, 1)
+        prices = dict(EquityValue.objects.filter(date=self.month).values_list('equity__symbol', 'price'))
+        self.assertEqual(prices, {'EQ0': 1.0, 'EQ1': 2.0, 'EQ2': 3.0, 'EQ3': 10.0, 'EQ4': 5.0, 'EQ5': 6.0})
+        self.assertEqual(EquityEvent.objects.filter(date=self.month).count(), 5)
+        self.assertEqual({equity.symbol: since for equity, since in stats.changed.items()},
+                         {'EQ0': self.month, 'EQ1': self.month, 'EQ2': self.month, 'EQ4': self.month, 'EQ5': self.month})
+
+    def test_batched(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        batch = pd.DataFrame({'Object_ID': [equity.id for equity in self.equities[:4]], 'Date': self.month, 'Close': 7.0,
+                              'Dividends': 0.0, 'DividendDate': None})
+        with patch('stocks.refresh.yahoo_history', return_value=batch), \
+                patch.object(Equity, 'fetch_external_equity_data', autospec=True, side_effect=self.fake_fetch) as single:
+            stats = refresh_equities(Equity.objects.all(), workers=3, key='AVKEY')
+
+        self.assertEqual(sorted(call.args[0].symbol for call in single.call_args_list), ['EQ4', 'EQ5'])  # Missed by the batch
+        self.assertEqual({call.kwargs['key'] for call in single.call_args_list}, {'AVKEY'})  # On Alphavantage
+        self.assertEqual(APIBudget.remaining('AVURL', 'AVKEY', 25), 23)
+        self.assertEqual(stats.equities, 6)
+        self.assertEqual(stats.failures, 0)
+        prices = dict(EquityValue.objects.filter(date=self.month).values_list('equity__symbol', 'price'))
+        self.assertEqual(prices, {'EQ0': 7.0, 'EQ1': 7.0, 'EQ2': 7.0, 'EQ3': 7.0, 'EQ4': 5.0, 'EQ5': 6.0})
+
+    def test_rate_limited(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        threads = []
+
+        def rate_limited(equity, period='1y', pause=None, force=False):
+            pause('ypfinance', 'Rate Limit Exceeded')
+            return {}
+
+        def paused(name, reason='Undefined'):
+            threads.append(threading.current_thread())
+            original(name, reason)
+
+        original = API.pause
+        with patch('stocks.refresh.yahoo_history', side_effect=ValueError('Batch choked')), \
+                patch.object(Equity, 'yp_update', autospec=True, side_effect=rate_limited) as yahoo, \
+                patch.object(API, 'pause', side_effect=paused):
+            refresh_equities(Equity.objects.all(), workers=1)
+        self.assertEqual(yahoo.call_count, 1)  # Not called again once it asked us to back off
+        self.assertEqual(threads, [threading.main_thread()])  # Written by the refresh thread,  not a worker
+        self.assertFalse(API.objects.get(name='ypfinance')._active)
+
+    def test_cached_alphavantage(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        batch = pd.DataFrame({'Object_ID': [equity.id for equity in self.equities[:4]], 'Date': self.month, 'Close': 7.0,
+                              'Dividends': 0.0, 'DividendDate': None})
+        cached = self.equities[4].key
+        with patch('stocks.refresh.yahoo_history', return_value=batch), \
+                patch('stocks.refresh.response_cache.is_cached', side_effect=lambda endpoint, params: endpoint == 'alphavantage' and params['symbol'] == cached), \
+                patch.object(Equity, 'fetch_external_equity_data', autospec=True, side_effect=self.fake_fetch) as single:
+            stats = refresh_equities(Equity.objects.all(), workers=3, key='AVKEY')
+
+        self.assertEqual(sorted(call.args[0].symbol for call in single.call_args_list), ['EQ4', 'EQ5'])
+        self.assertEqual(APIBudget.remaining('AVURL', 'AVKEY', 25), 24)  # Only EQ5 spent a call
+        self.assertEqual(stats.skipped, 0)
+
+    def test_batch_response_cache(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        chunk = self.equities[:4]
+        batch = pd.DataFrame({'Object_ID': [equity.id for equity in chunk], 'Date': self.month, 'Close': 7.0,
+                              'Dividends': 0.5, 'DividendDate': datetime(2023, 5, 12).date()})
+        with patch.multiple(response_cache, ENABLED=True, DIRECTORY=Path(directory.name)), \
+                patch('stocks.refresh.yahoo_history', return_value=batch) as yahoo:
+            refresh_equities(chunk, workers=1)
+            self.assertEqual(response_cache.cached_series('ypfinance', {'symbol': chunk[0].key, 'period': '1y'}, lambda since: {}),
+                             {self.month: (7.0, 0.5)})  # The entry yp_update reads
+            with patch.object(Equity, 'apply_external_equity_data', autospec=True) as apply:
+                refresh_equities(chunk, workers=1)
+            self.assertEqual(yahoo.call_count, 1)  # Answered from the cache
+            self.assertEqual(apply.call_args.args[1:], (Equity.ypfinance, {self.month: (7.0, 0.5)}, {self.month: datetime(2023, 5, 12).date()}))
+            refresh_equities(chunk, workers=1, force=True)
+            self.assertEqual(yahoo.call_count, 2)  # Forced past it
+
+    def test_no_allowance(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        with patch('stocks.refresh.yahoo_history', return_value=pd.DataFrame(columns=['Object_ID', 'Date', 'Close', 'Dividends', 'DividendDate'])), \
+                patch.object(Equity, 'fetch_external_equity_data', autospec=True, side_effect=self.fake_fetch) as single, \
+                patch('stocks.refresh.AV_DAILY_LIMIT', 2):
+            stats = refresh_equities(Equity.objects.all(), workers=3, keys=['A', 'B'])
+        self.assertEqual(single.call_count, 4)  # Two calls on each key
+        self.assertEqual(stats.skipped, 2)
+        self.assertEqual(stats.equities, 6)
+        self.assertEqual((APIBudget.remaining('AVURL', 'A', 2), APIBudget.remaining('AVURL', 'B', 2)), (0, 0))
+
+    @freeze_time('2023-05-17')
+    def test_intraday(self):
+        API.objects.create(name='ypfinance', base='foo', _active=True)
+        open_account = InvestmentAccount.objects.create(name='open', currency='CAD', managed=False)
+        closed_account = InvestmentAccount.objects.create(name='closed', currency='CAD', managed=False, _end=self.month)
+        for account, equity in ((open_account, self.equities[0]), (open_account, self.equities[1]), (open_account, self.equities[2]),
+                                (closed_account, self.equities[0]), (closed_account, self.equities[3])):
+            Transaction.objects.create(account=account, equity=equity, real_date=datetime(2023, 1, 10).date(), price=10, quantity=1, xa_action=Transaction.BUY)
+        EquityValue.objects.filter(equity=self.equities[1]).update(split_fixed=True)
+
+        def download(tickers, **kwargs):
+            index = pd.to_datetime(['2023-05-15', '2023-05-16'])
+            return pd.concat({ticker: pd.DataFrame({'Close': [11.0, 12.0]}, index=index) for ticker in tickers if ticker != 'EQ2'}, axis=1)
+
+        with patch('stocks.refresh.yf.download', side_effect=download) as yahoo, patch('stocks.refresh.CacheDependencies.invalidate') as invalidate:
+            self.assertEqual(intraday_refresh(), 1)
+        self.assertEqual(yahoo.call_count, 1)
+        self.assertEqual(sorted(yahoo.call_args.args[0]), ['EQ0', 'EQ1', 'EQ2'])  # Only what open accounts hold
+        changes, = invalidate.call_args.args
+        self.assertEqual(changes, [(self.equities[0], self.month)])
+        self.assertEqual(invalidate.call_args.kwargs['keep'], {closed_account.id})
+
+        prices = dict(EquityValue.objects.filter(date=self.month).values_list('equity__symbol', 'price'))
+        self.assertEqual(prices, {'EQ0': 12.0, 'EQ1': 10.0, 'EQ2': 10.0, 'EQ3': 10.0, 'EQ4': 10.0, 'EQ5': 10.0})
+        value = EquityValue.objects.get(equity=self.equities[0], date=self.month)
+        self.assertEqual((value.real_date, value.source, value.api), (datetime(2023, 5, 16).date(), DataSource.API.value, Equity.ypfinance))
+
+
+    @freeze_time('2023-05-17')
+    def test_daily_update(self):
+        changed = InvestmentAccount.objects.create(name='changed', currency='CAD', managed=False)
+        quiet = InvestmentAccount.objects.create(name='quiet', currency='CAD', managed=False)
+        Transaction.objects.create(account=changed, equity=self.equities[0], real_date=datetime(2020, 1, 10).date(), price=10, quantity=1, xa_action=Transaction.BUY)
+        Transaction.objects.create(account=quiet, equity=self.equities[1], real_date=datetime(2020, 1, 10).date(), price=10, quantity=1, xa_action=Transaction.BUY)
+        stats = RefreshStats()
+        stats.changed = {self.equities[0]: datetime(2021, 3, 1).date()}  # A forced reload rewrote an old month
+
+        with patch('stocks.tasks.refresh_equities', return_value=stats), patch('stocks.tasks.remove_duplicates'), \
+                patch('stocks.tasks.Inflation.update', return_value=0), patch('stocks.tasks.ExchangeRate.update', return_value=0), \
+                patch('stocks.models.Account.update_static_values', autospec=True) as update:
+            daily_update()
+        dirty = {call.args[0].id: call.kwargs['dirty_from'] for call in update.call_args_list}
+        self.assertEqual(dirty, {changed.id: datetime(2021, 3, 1).date(), quiet.id: datetime(2023, 4, 1).date()})
+
+
+class AlphavantageScheduleTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.account = InvestmentAccount.objects.create(name='open', currency='CAD', managed=False)
+        self.equities = {}
+        for symbol, price, shares, updated in (('CHEAP', 1.0, 10, datetime(2023, 4, 1)), ('RICH', 100.0, 10, datetime(2023, 4, 1)),
+                                               ('STALE', 100.0, 10, datetime(2022, 4, 1)), ('NONE', 100.0, 0, datetime(2020, 4, 1))):
+            equity = Equity.objects.create(symbol=symbol, name=symbol, searchable=True, validated=True)
+            EquityValue.objects.create(equity=equity, real_date=updated.date(), price=price, source=DataSource.API.value)
+            if shares:
+                Transaction.objects.create(account=self.account, equity=equity, real_date=datetime(2020, 1, 10).date(), price=price,
+                                           quantity=shares, xa_action=Transaction.BUY)
+            self.equities[symbol] = equity
+
+    @freeze_time('2023-05-17')
+    def test_priority(self):
+        equities = list(self.equities.values())
+        ranked = [equity.symbol for equity in av_priority(equities, [])]
+        self.assertEqual(ranked, ['STALE', 'RICH', 'CHEAP', 'NONE'])  # Value weighted by staleness,  then staleness alone
+        ranked = [equity.symbol for equity in av_priority(equities, [self.equities['CHEAP'].id])]
+        self.assertEqual(ranked[0], 'CHEAP')  # Yahoo failed on it
+
+    @freeze_time('2023-05-17')
+    def test_schedule(self):
+        equities = list(self.equities.values())
+        schedule = av_schedule(equities, [], ['A', 'B'], limit=1)
+        self.assertEqual({self.equities['STALE'].id, self.equities['RICH'].id}, set(schedule))
+        self.assertEqual(set(schedule.values()), {'A', 'B'})
+        self.assertEqual(av_schedule(equities, [], ['A', 'B'], limit=1), {})  # Spent,  a restart does not get it back
+        self.assertEqual(APIBudget.objects.get(key=APIBudget.fingerprint('A')).calls, 1)
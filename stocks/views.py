@@ -3,6 +3,7 @@ import csv
 import logging
 import os
 import json
+import uuid
 
 import numpy as np
 import pandas as pd
@@ -13,6 +14,8 @@ from typing import List, Dict
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.mail import EmailMessage
 from django.db.models import Sum, Avg
 from django.db.models.functions import TruncMonth
@@ -22,14 +25,14 @@ from django.urls import reverse
 from django.views.generic import ListView, DetailView, CreateView, DeleteView, UpdateView
 from django.views.generic.dates import DateMixin
 
-from base.utils import DIYImportException, normalize_today, normalize_date
-from base.models import Profile
+from base.utils import normalize_today, normalize_date
+from base.models import Profile, ImportJob
 from base.views import BaseDeleteView
 
-from .models import Account, Portfolio, Equity, EquityEvent, EquityValue, Transaction, BaseContainer, FundValue, DataSource, CashAccount, ValueAccount, InvestmentAccount
-from .tasks import equity_new_estimates
+from .models import Account, Portfolio, Equity, EquityEvent, EquityValue, Transaction, BaseContainer, FundValue, DataSource, CashAccount, ValueAccount, InvestmentAccount, CacheDependencies
+from .tasks import equity_new_estimates, stock_import
+from .refresh import refresh_equities
 from .forms import TransactionForm, PortfolioForm, AccountCloseForm, TransactionEditForm, AccountForm, UploadFileForm, AccountAddForm, TransactionSetValueForm, ManualUpdateEquityForm, AddEquityForm, SimpleCashReconcileFormSet, SimpleReconcileFormSet, ReconciliationFormSet
-from .importers import QuestTrade, Manulife, ManulifeWealth, StockImporter, HEADERS
 
 
 logger = logging.getLogger(__name__)
@@ -101,14 +104,11 @@ class StocksMain(LoginRequiredMixin, ListView):
         context = super().get_context_data(**kwargs)
         total_value = 0
         account_list_data = []
-        for portfolio in Portfolio.objects.filter(user=self.request.user):
-            account_list_data.append(portfolio.summary)
-            total_value += portfolio.summary['Value']
-            logger.debug('Total Value:%s added %s (%s)' % (total_value, portfolio, portfolio.summary['Value']))
-        for account in Account.objects.filter(user=self.request.user, portfolio__isnull=True):
-            account_list_data.append(account.summary)
-            total_value += account.summary['Value']
-            logger.debug('Total Value:%s added %s (%s)' % (total_value, account, account.summary['Value']))
+        for container in list(Portfolio.objects.filter(user=self.request.user)) + list(Account.objects.filter(user=self.request.user, portfolio__isnull=True)):
+            summary = container.summary  # Not cheap,  it is a property
+            account_list_data.append(summary)
+            total_value += summary['Value']
+            logger.debug('Total Value:%s added %s (%s)' % (total_value, container, summary['Value']))
 
 
         account_list_data = sorted(account_list_data, key=lambda x: x['Value'], reverse=True)
@@ -437,32 +437,18 @@ def account_update(request, pk):
 
 @login_required
 def upload_file(request):
+    """
+    Save the file and queue it as an ImportJob (stocks.tasks.stock_import),  the browser follows the job's progress
+    """
     if request.method == "POST":
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            bin_file = form.cleaned_data['csv_file'].read()
-            try:
-                text_file = bin_file.decode('utf-8')
-                reader = csv.reader(text_file.splitlines())
-                try:
-                    if form.cleaned_data["csv_type"] == 'QuestTrade':
-                        importer = QuestTrade(form.cleaned_data['new_account_currency'], reader, request.user)
-                    elif form.cleaned_data["csv_type"] == 'Manulife':
-                        importer = Manulife(form.cleaned_data['new_account_currency'], reader, request.user)
-                    elif form.cleaned_data["csv_type"] == 'Wealth':
-                        importer = ManulifeWealth(form.cleaned_data['new_account_currency'], reader, request.user)
-                    else:  # Must be generic
-                        importer = StockImporter(form.cleaned_data['new_account_currency'], reader, request.user, HEADERS, managed=False)
-                    importer.process()
-                    for account in Account.objects.filter(user=request.user):
-                        account.reset()  # Maybe overkill but how often do we import files
-                    if len(importer.warnings) != 0:
-                        return render(request, "stocks/uploadfile.html",
-                                      {"form": form, 'custom_warnings': importer.warnings})
-                except DIYImportException as e:
-                    return render(request, "stocks/uploadfile.html", {"form": form, 'custom_error': str(e)})
-            except UnicodeDecodeError:
-                return render(request, "stocks/uploadfile.html", {"form": form, 'custom_error': 'File is invalid.'})
+            saved_path = default_storage.save(os.path.join('uploads', f'{uuid.uuid4()}.csv'), ContentFile(form.cleaned_data['csv_file'].read()))
+            job = ImportJob.objects.create(user=request.user, kind='stocks', file=saved_path,
+                                           options={'csv_type': form.cleaned_data['csv_type'],
+                                                    'currency': form.cleaned_data['new_account_currency']})
+            stock_import.delay(job.id)
+            return HttpResponseRedirect(reverse('import_job', kwargs={'pk': job.id}))
     else:
         form = UploadFileForm()
     return render(request, "stocks/uploadfile.html", {"form": form})
@@ -727,10 +713,10 @@ def portfolio_update(request, pk):
     profile = Profile.objects.get(user=request.user)
     key = profile.av_api_key if profile.av_api_key else None
 
-    for equity in Equity.objects.filter(
-            searchable=True,
-            id__in=Transaction.objects.filter(account__portfolio=portfolio, account___end__isnull=True, xa_action__in=Transaction.SHARE_TRANSACTIONS)):
-        equity.update(key=key, daily=False)
+    refresh_equities(Equity.objects.filter(
+        searchable=True,
+        id__in=Transaction.objects.filter(account__portfolio=portfolio, account___end__isnull=True,
+                                          xa_action__in=Transaction.SHARE_TRANSACTIONS).values_list('equity_id', flat=True)), key=key, daily=False)
 
     for account in portfolio.account_set.filter(_end__isnull=True):
         account.update_static_values()
@@ -750,8 +736,7 @@ def equity_update(request,  id):
 
     equity = get_object_or_404(Equity, id=id)
     equity.update(daily=False)
-    for account in Account.objects.filter(id__in=Transaction.objects.filter(equity=equity).values_list('account', flat=True).distinct()):
-        account.reset()
+    CacheDependencies.invalidate([(equity, None)])
     return HttpResponse(status=200)
 
 